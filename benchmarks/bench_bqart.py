@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+BQART table micro-benchmark and equivalence check
+
+Synthesises catchment inputs with the same distributions as
+qs_data_sample.csv, with fault data, lithology values and fan-toe lengths,
+times the BQART table build and the CSV write, and checks the NumPy table
+against the scalar reference. Needs NumPy and cement, not arcpy.
+
+    python bench_bqart.py --sizes 1000,100000,10000000
+"""
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from cement.core import foundation, controller
+from cement.core.controller import expose
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import bqart
+from bench_workflow import current_commit
+from workflow_trace import sample_process
+
+SAMPLE_PATH = os.path.join(REPO_ROOT, 'qs_data_sample.csv')
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000, 10000000]
+DEFAULT_RESULTS = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bqart_results.jsonl')
+
+ROW_HEADERS = ['id', 'precipitation (mm/yr)', 'w', 'B', 'Discharge', 'Qw (m^3/s)', 'Qw (km^3/yr)', 'A (km^2)', 'A^0.5',
+               'R (km)', 'T(C)', 'Qs (MT/y)', 'porosity', 'density (kg/m^3)', 'Qs (m^3/yr)',
+               'erosion (m/yr)', 'erosion (mm/yr)', 'Slip max (mm/yr)', 'Slip min (mm/yr)', 'Qs tectonic min (m^3/yr)',
+               'Qs tectonic max (m^3/yr)', 'fault id', 'fault name', 'distance', 'fan length']
+
+
+class BenchController(controller.CementBaseController):
+    class Meta:
+        label = 'base'
+        description = 'Benchmark and check the BQART table on synthetic catchments'
+        arguments = [
+            ( ['--sizes'], dict(action='store', dest='sizes',
+                      help='comma separated catchment counts') ),
+            ( ['--seed'], dict(action='store', dest='seed', type=int, default=0,
+                      help='random seed for the synthetic catchments') ),
+            ( ['--check-limit'], dict(action='store', dest='check_limit', type=int, default=1000000,
+                      help='above this many catchments only a sample is checked against the reference') ),
+            ( ['--check-sample'], dict(action='store', dest='check_sample', type=int, default=100000,
+                      help='catchments checked when over the check limit') ),
+            ( ['--results'], dict(action='store', dest='results', default=DEFAULT_RESULTS,
+                      help='JSON lines file the results are appended to') ),
+            ]
+
+    @expose(hide=True, aliases=['run'])
+    def default(self):
+        pass
+
+
+class BenchApp(foundation.CementApp):
+
+    class Meta:
+        label = 'BQART_Benchmarks'
+        base_controller = BenchController
+
+
+def sample_distributions(path = SAMPLE_PATH):
+    # Log-normal fits for the positive quantities, a normal fit for temperature
+    data = np.genfromtxt(path, delimiter=',', names=True)
+    names = data.dtype.names
+
+    def column(prefix):
+        return data[[n for n in names if n.startswith(prefix)][0]]
+
+    precip = column('precipitation')
+    area = column('A_km')
+    relief = column('R_km')
+    temp = column('TC')
+    distance = column('distance')
+
+    def log_fit(values):
+        logs = np.log(values[values > 0])
+        return [float(logs.mean()), float(logs.std())]
+
+    return {
+        'precip': log_fit(precip),
+        'area_km2': log_fit(area),
+        'relief_km': log_fit(relief),
+        'temp': [float(temp.mean()), float(temp.std())],
+        'distance': log_fit(distance)
+    }
+
+
+def synthetic_catchments(n, distributions, seed = 0, n_faults = 12):
+    rng = np.random.RandomState(seed)
+    ids = np.arange(1, n + 1)
+
+    precip = rng.lognormal(*distributions['precip'], size=n)
+    area_m2 = rng.lognormal(*distributions['area_km2'], size=n) * 1000000
+    relief_m = rng.lognormal(*distributions['relief_km'], size=n) * 1000
+    min_relief = rng.uniform(0, 2000, n)
+    # WorldClim style temperatures, C x 10
+    temp = rng.normal(*distributions['temp'], size=n) * 10
+    lith = rng.uniform(0.5, 2.0, n)
+    fault = rng.randint(0, n_faults, n)
+    distance = rng.lognormal(*distributions['distance'], size=n)
+    fan_length = rng.uniform(100, 5000, n)
+
+    id_list = ids.tolist()
+    fault_meta_data = {}
+    for f in range(n_faults):
+        slip_min = round(float(rng.uniform(0.05, 0.5)), 3)
+        fault_meta_data[f] = {'name': 'fault_' + str(f), 'slip_min': slip_min,
+                              'slip_max': slip_min + round(float(rng.uniform(0.1, 1.0)), 3)}
+
+    # Same shapes do_bqart and save_data_to_csv get from the cursors and CSVs
+    return {
+        'ids': id_list,
+        'precips': dict(zip(id_list, precip.tolist())),
+        'temps': dict(zip(id_list, temp.tolist())),
+        'areas': dict(zip(id_list, area_m2.tolist())),
+        'max_reliefs': dict(zip(id_list, (min_relief + relief_m).tolist())),
+        'min_reliefs': dict(zip(id_list, min_relief.tolist())),
+        'l_values': dict(zip(id_list, lith.tolist())),
+        'fault_data_output': dict((str(k), [str(f), repr(d)]) for k, f, d in
+                                  zip(id_list, fault.tolist(), distance.tolist())),
+        'fault_meta_data': fault_meta_data,
+        'fan_toe_lengths': dict((str(k), repr(l)) for k, l in zip(id_list, fan_length.tolist())),
+        'uplift_rate': 0.1
+    }
+
+
+def table_args(catchments, ids):
+    return (ids, catchments['precips'], catchments['temps'], catchments['areas'],
+            catchments['max_reliefs'], catchments['min_reliefs'], catchments['l_values'],
+            catchments['fault_data_output'], catchments['fault_meta_data'], catchments['uplift_rate'])
+
+
+def compare_rows(reference, rows):
+    # Largest relative difference over the numeric columns, and any mismatch
+    # in the text columns
+    if len(reference) != len(rows):
+        return float('inf'), 'row counts differ: ' + str(len(reference)) + ' vs ' + str(len(rows))
+
+    worst = 0.0
+    for r, v in zip(reference, rows):
+        if len(r) != len(v):
+            return float('inf'), 'row lengths differ for catchment ' + str(r[0])
+        for i, (a, b) in enumerate(zip(r, v)):
+            if isinstance(a, str) or isinstance(b, str):
+                if a != b:
+                    return float('inf'), 'column ' + ROW_HEADERS[i] + ' differs for catchment ' + str(r[0])
+            elif a != b:
+                worst = max(worst, abs(a - b) / max(abs(a), abs(b)))
+
+    return worst, ''
+
+
+def timed(function, *args):
+    before = sample_process()
+    result = function(*args)
+    after = sample_process()
+
+    return result, after['wall'] - before['wall'], after['cpu'] - before['cpu']
+
+
+def run_size(n, seed, check_limit, check_sample, work_dir):
+    print('Synthesising ' + str(n) + ' catchments')
+    catchments = synthetic_catchments(n, sample_distributions(), seed)
+    ids = catchments['ids']
+
+    rows, table_wall, table_cpu = timed(bqart.bqart_table, *table_args(catchments, ids))
+
+    data_path = os.path.join(work_dir, 'bench_' + str(n) + '_data.csv')
+    _, write_wall, write_cpu = timed(bqart.save_table, rows, data_path, ROW_HEADERS, False, 0,
+                                     catchments['fan_toe_lengths'])
+
+    # Checked on a fresh table, save_table appends the fan lengths to its rows
+    check_ids = ids
+    if n > check_limit:
+        check_ids = sorted(np.random.RandomState(seed).choice(ids, check_sample, replace=False).tolist())
+    reference, reference_wall, _ = timed(bqart.bqart_rows, *table_args(catchments, check_ids))
+    checked = bqart.bqart_table(*table_args(catchments, check_ids))
+    worst, mismatch = compare_rows(reference, checked)
+
+    peak_rss = sample_process()['peak_rss']
+
+    print('  table    ' + ('%.3f' % table_wall).rjust(9) + ' s  ' + ('%.0f' % (n / max(table_wall, 1e-9))).rjust(12) + ' catchments/s')
+    print('  write    ' + ('%.3f' % write_wall).rjust(9) + ' s  ' + ('%.0f' % (n / max(write_wall, 1e-9))).rjust(12) + ' catchments/s')
+    print('  reference' + ('%.3f' % reference_wall).rjust(9) + ' s  for ' + str(len(check_ids)) + ' catchments')
+    if mismatch:
+        print('  MISMATCH: ' + mismatch)
+    else:
+        print('  max relative difference ' + repr(worst))
+
+    return {
+        'commit': current_commit(),
+        'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'catchments': n,
+        'table_wall': table_wall,
+        'table_cpu': table_cpu,
+        'write_wall': write_wall,
+        'write_cpu': write_cpu,
+        'reference_wall': reference_wall,
+        'checked': len(check_ids),
+        'max_relative_difference': worst,
+        'mismatch': mismatch,
+        'peak_rss_mb': (peak_rss or 0) / 1048576.0
+    }
+
+
+if __name__ == '__main__':
+    app = BenchApp()
+    try:
+        app.setup()
+        app.run()
+
+        sizes = DEFAULT_SIZES
+        if app.pargs.sizes:
+            sizes = [int(s) for s in app.pargs.sizes.split(',')]
+
+        work_dir = tempfile.mkdtemp(prefix='bench_bqart_')
+        failed = False
+        try:
+            for n in sizes:
+                record = run_size(n, app.pargs.seed, app.pargs.check_limit, app.pargs.check_sample, work_dir)
+                failed = failed or bool(record['mismatch']) or record['max_relative_difference'] > 1e-12
+                with open(app.pargs.results, 'a') as results:
+                    results.write(json.dumps(record) + '\n')
+        finally:
+            shutil.rmtree(work_dir)
+
+        if failed:
+            print('BQART table does not match the scalar reference')
+            sys.exit(1)
+    finally:
+        app.close()
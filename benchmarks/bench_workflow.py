@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic-terrain benchmarks for the hydrology, fault, watershed and BQART
+stages
+
+Builds reproducible DEMs, faults, pour points and monthly climate grids at
+each requested size, runs the workflow on them and appends per-stage wall
+time, CPU time, throughput (cells/s) and peak memory to a JSON lines results
+file tagged with the current commit, so runs can be compared across commits.
+Each size runs in its own process, so memory left behind by one size doesn't
+show up in the next.
+
+    python bench_workflow.py --sizes 1000,5000,20000
+    python bench_workflow.py --sizes 500 --backend numpy
+    python bench_workflow.py --sizes 500 --backend numpy --intermediates raw
+    python bench_workflow.py --compare <base commit>
+"""
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import Queue
+import shutil
+import subprocess
+import sys
+import traceback
+
+from cement.core import foundation, controller
+from cement.core.controller import expose
+
+import synthetic_terrain
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+PROJECTION_CODE = 32611
+DEFAULT_SIZES = [1000, 2000, 5000, 10000, 20000]
+DEFAULT_RESULTS = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results.jsonl')
+
+# Options a run was made with, and their defaults for older results
+RUN_OPTIONS = [('backend', 'arcpy'), ('intermediates', 'tif'), ('persist', None),
+               ('chunked', None), ('acc_workers', None)]
+
+
+class BenchController(controller.CementBaseController):
+    class Meta:
+        label = 'base'
+        description = 'Benchmark the GIS workflow on synthetic terrain'
+        arguments = [
+            ( ['--sizes'], dict(action='store', dest='sizes',
+                      help='comma separated DEM edge lengths in cells') ),
+            ( ['--cell-size'], dict(action='store', dest='cell_size', type=float, default=30.0,
+                      help='DEM cell size in metres') ),
+            ( ['--seed'], dict(action='store', dest='seed', type=int, default=0,
+                      help='random seed for the synthetic terrain') ),
+            ( ['--work'], dict(action='store', dest='work',
+                      help='scratch directory for inputs and batches') ),
+            ( ['--results'], dict(action='store', dest='results', default=DEFAULT_RESULTS,
+                      help='JSON lines file the results are appended to') ),
+            ( ['--compare'], dict(action='store', dest='compare',
+                      help='compare the current commit against this commit') ),
+            ( ['--backend'], dict(action='store', dest='backend', default='arcpy',
+                      choices=['arcpy', 'numpy'], help='GIS backend to run the stages with') ),
+            ( ['--intermediates'], dict(action='store', dest='intermediates', default='tif',
+                      choices=['tif', 'raw'], help='intermediate raster format, raw needs --backend numpy') ),
+            ( ['--persist'], dict(action='store', dest='persist',
+                      help='comma separated hydrology outputs to write, the rest stay in memory') ),
+            ( ['--chunked'], dict(action='store', dest='chunked',
+                      help='comma separated path keys to keep in chunked stores, e.g. flow_acc_path') ),
+            ( ['--acc-workers'], dict(action='store', dest='acc_workers', type=int,
+                      help='worker processes for tiled flow accumulation') ),
+            ]
+
+    @expose(hide=True, aliases=['run'])
+    def default(self):
+        pass
+
+
+class BenchApp(foundation.CementApp):
+
+    class Meta:
+        label = 'GIS_Benchmarks'
+        base_controller = BenchController
+
+
+def current_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT)
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write_inputs(directory, size, cell_size, seed):
+    import arcpy
+
+    sr = arcpy.SpatialReference(PROJECTION_CODE)
+    origin = arcpy.Point(0, 0)
+
+    dem = synthetic_terrain.synthetic_dem(size, seed = seed)
+    faults = synthetic_terrain.fault_lines(size, cell_size, seed = seed)
+    synthetic_terrain.apply_fault_scarps(dem, faults, cell_size)
+
+    dem_path = os.path.join(directory, 'synthetic_dem.tif')
+    arcpy.NumPyArrayToRaster(dem, origin, cell_size, cell_size).save(dem_path)
+    arcpy.DefineProjection_management(dem_path, sr)
+
+    # Faults with the attributes get_fault_data expects
+    fault_path = os.path.join(directory, 'faults.shp')
+    arcpy.CreateFeatureclass_management(directory, 'faults.shp', 'POLYLINE', spatial_reference = sr)
+    for field, field_type in [('name', 'TEXT'), ('slip_min', 'DOUBLE'), ('slip_max', 'DOUBLE'),
+                              ('age_min', 'DOUBLE'), ('age_max', 'DOUBLE'), ('sense', 'TEXT')]:
+        arcpy.AddField_management(fault_path, field, field_type)
+
+    fields = ['SHAPE@', 'Id', 'name', 'slip_min', 'slip_max', 'age_min', 'age_max', 'sense']
+    with arcpy.da.InsertCursor(fault_path, fields) as cursor:
+        for f in faults:
+            line = arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in f['vertices']]), sr)
+            cursor.insertRow([line, f['id'], f['name'], f['slip_min'], f['slip_max'],
+                              f['age_min'], f['age_max'], f['sense']])
+
+    pp_path = os.path.join(directory, 'pour_points.shp')
+    arcpy.CreateFeatureclass_management(directory, 'pour_points.shp', 'POINT', spatial_reference = sr)
+    with arcpy.da.InsertCursor(pp_path, ['SHAPE@XY', 'Id']) as cursor:
+        for i, point in enumerate(synthetic_terrain.pour_points(faults, seed = seed)):
+            cursor.insertRow([point, i + 1])
+
+    # Twelve monthly grids per variable, at roughly WorldClim resolution
+    factor = 30
+    temps, precips = synthetic_terrain.monthly_climate(dem, factor, seed = seed)
+    climate_dirs = {}
+    for name, grids in [('temp', temps), ('precip', precips)]:
+        climate_dir = os.path.join(directory, name)
+        os.makedirs(climate_dir)
+        for month, grid in enumerate(grids):
+            month_path = os.path.join(climate_dir, name + '_' + str(month + 1) + '.tif')
+            arcpy.NumPyArrayToRaster(grid, origin, cell_size * factor, cell_size * factor).save(month_path)
+            arcpy.DefineProjection_management(month_path, sr)
+        climate_dirs[name] = climate_dir
+
+    return dem_path, fault_path, pp_path, climate_dirs
+
+
+def write_open_inputs(directory, size, cell_size, seed):
+    # The same inputs written with rasterio and fiona, for the numpy backend
+    import gis_backend
+    from rasterio.transform import from_origin
+    from shapely import geometry
+
+    backend = gis_backend.NumpyBackend()
+    backend.setup(None, PROJECTION_CODE)
+
+    dem = synthetic_terrain.synthetic_dem(size, seed = seed)
+    faults = synthetic_terrain.fault_lines(size, cell_size, seed = seed)
+    synthetic_terrain.apply_fault_scarps(dem, faults, cell_size)
+
+    # NumPyArrayToRaster puts the origin at the lower left
+    dem_path = os.path.join(directory, 'synthetic_dem.tif')
+    grid = gis_backend.RasterGrid(from_origin(0, size * cell_size, cell_size, cell_size), backend.crs, dem.shape)
+    backend.write_raster(dem_path, dem, grid)
+
+    fault_path = os.path.join(directory, 'faults.shp')
+    schema = {'geometry': 'LineString', 'properties': {'Id': 'int', 'name': 'str', 'slip_min': 'float',
+              'slip_max': 'float', 'age_min': 'float', 'age_max': 'float', 'sense': 'str'}}
+    fields = ['name', 'slip_min', 'slip_max', 'age_min', 'age_max', 'sense']
+    backend.write_features(fault_path, schema, backend.crs, [
+        (geometry.LineString(f['vertices']), dict([(k, f[k]) for k in fields], Id=f['id'])) for f in faults])
+
+    pp_path = os.path.join(directory, 'pour_points.shp')
+    backend.write_features(pp_path, {'geometry': 'Point', 'properties': {'Id': 'int'}}, backend.crs, [
+        (geometry.Point(point), {'Id': i + 1})
+        for i, point in enumerate(synthetic_terrain.pour_points(faults, seed = seed))])
+
+    factor = 30
+    temps, precips = synthetic_terrain.monthly_climate(dem, factor, seed = seed)
+    climate_dirs = {}
+    for name, grids in [('temp', temps), ('precip', precips)]:
+        climate_dir = os.path.join(directory, name)
+        os.makedirs(climate_dir)
+        for month, values in enumerate(grids):
+            month_path = os.path.join(climate_dir, name + '_' + str(month + 1) + '.tif')
+            top = values.shape[0] * cell_size * factor
+            month_grid = gis_backend.RasterGrid(from_origin(0, top, cell_size * factor, cell_size * factor),
+                                                backend.crs, values.shape)
+            backend.write_raster(month_path, values, month_grid)
+        climate_dirs[name] = climate_dir
+
+    return dem_path, fault_path, pp_path, climate_dirs
+
+
+def bench_config(directory, dem_path, fault_path, pp_path, climate_dirs, backend = 'arcpy',
+                 intermediates = 'tif', persist = None, chunked = None, acc_workers = None):
+    output = os.path.join(directory, 'Output')
+    scratch = os.path.join(directory, 'Scratch')
+    for d in [output, scratch]:
+        os.makedirs(d)
+
+    return {
+        'backend': backend,
+        'intermediates': {'format': intermediates, 'chunked': chunked or [], 'export': []},
+        'persist': persist,
+        'root': directory,
+        'project_name': 'synthetic',
+        'projection_code': PROJECTION_CODE,
+        'pour_points_path': pp_path,
+        'lithology_path': '',
+        'lithology_values': '',
+        'fault_path': fault_path,
+        'scratch': scratch,
+        'output': output,
+        'original_dem': dem_path,
+        'uplift_mm_yr': 0.1,
+        'min_area': 0,
+        'fan_toes': False,
+        'fill': True,
+        'flow_dir': {'force_flow': 'NORMAL'},
+        'flow_acc': {'flow_data_type': 'INTEGER', 'flow_weight_raster': '', 'workers': acc_workers},
+        'str_net': {'conditional': 'VALUE > 300', 'false_constant': 0},
+        'set_null': {'conditional': 'VALUE = 0', 'false_raster': 1},
+        'str_ord': {'method': 'STRAHLER'},
+        'faults': {'cluster_tolerance': 1.5, 'search_radius': 20},
+        'pour_points': {'minimum_height': 35, 'snap_distance': 60},
+        'climates': [{'name': 'synthetic', 'temp_directory': climate_dirs['temp'],
+                      'precip_directory': climate_dirs['precip']}],
+        'climate_basic': [],
+        'trace': True
+    }
+
+
+def run_size(size, cell_size, seed, work_dir, backend = 'arcpy', intermediates = 'tif', persist = None,
+             chunked = None, acc_workers = None):
+    import gis_workflow
+
+    directory = os.path.join(work_dir, 'size_' + str(size))
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    print('Building ' + str(size) + ' x ' + str(size) + ' synthetic terrain')
+    if backend == 'numpy':
+        inputs = write_open_inputs(directory, size, cell_size, seed)
+    else:
+        inputs = write_inputs(directory, size, cell_size, seed)
+    config = bench_config(directory, *inputs, backend = backend, intermediates = intermediates,
+                          persist = persist, chunked = chunked, acc_workers = acc_workers)
+    dem_path, fault_path, pp_path, climate_dirs = inputs
+
+    gbatch = gis_workflow.GISbatch(config, False, gis_workflow.RunSpec({'headless': True}))
+    hydro_paths = gbatch.hydro_workflow()
+    # Faults are timed on a copy so BQART below uses the uplift rate path
+    gbatch.fault_workflow(fault_path, dict(hydro_paths))
+
+    watershed_raster = gbatch.watershed_workflow(pp_path, hydro_paths)
+    watershed_directory = os.path.dirname(os.path.realpath(watershed_raster))
+
+    gbatch.bqart_workflow(watershed_raster, hydro_paths, watershed_directory,
+                          climate_dirs['temp'], climate_dirs['precip'], 'synthetic', False)
+
+    return gbatch.tracer.summary()
+
+
+def size_worker(queue, args):
+    try:
+        queue.put(('complete', run_size(*args)))
+    except Exception:
+        queue.put(('failed', traceback.format_exc()))
+
+
+def run_size_in_process(*args):
+    # A fresh process per size, so its process peak RSS is only its own. Not
+    # a pool worker, those can't start the tiled flow accumulation pool
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=size_worker, args=(queue, args))
+    process.start()
+    try:
+        while True:
+            try:
+                status, result = queue.get(timeout=5)
+                break
+            except Queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError('Benchmark of size ' + str(args[0]) + ' exited with code ' +
+                                       str(process.exitcode))
+    finally:
+        process.join()
+
+    if status == 'failed':
+        raise RuntimeError('Benchmark of size ' + str(args[0]) + ' failed:\n' + result)
+
+    return result
+
+
+def stage_records(summary, size, cell_size, commit, options):
+    cells = size * size
+    date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    records = []
+
+    for stage in summary:
+        record = dict((k, options.get(k, default)) for k, default in RUN_OPTIONS)
+        record.update({
+            'commit': commit,
+            'date': date,
+            'host': platform.node(),
+            'size': size,
+            'cells': cells,
+            'cell_size': cell_size,
+            'stage': stage['name'],
+            'calls': stage['calls'],
+            'wall': stage['wall'],
+            'cpu': stage['cpu'],
+            'cells_per_s': cells / stage['wall'] if stage['wall'] > 0 else None,
+            'peak_delta_mb': stage['peak_delta'] / 1048576.0,
+            'peak_rss_mb': stage['process_peak_rss'] / 1048576.0
+        })
+        records.append(record)
+
+    return records
+
+
+def options_label(record):
+    # Options that differ from the defaults, e.g. backend=numpy acc_workers=4
+    label = []
+    for k, default in RUN_OPTIONS:
+        value = record.get(k, default)
+        if value != default:
+            label.append(k + '=' + (','.join(value) if isinstance(value, list) else str(value)))
+
+    return ' '.join(label) or 'defaults'
+
+
+def load_results(path):
+    records = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+
+    return records
+
+
+def compare(records, base, head):
+    # Latest result per (options, size, stage) for each commit, so only runs
+    # made with the same backend and options are compared
+    latest = {}
+    for r in records:
+        if r['commit'] in (base, head):
+            latest[(r['commit'], options_label(r), r['size'], r['stage'])] = r
+
+    print('options'.ljust(30) + 'size'.rjust(7) + '  ' + 'stage'.ljust(30) + base.rjust(12) + head.rjust(12) + '   ratio')
+    for (commit, options, size, stage) in sorted(k for k in latest if k[0] == head):
+        if (base, options, size, stage) not in latest:
+            continue
+        b = latest[(base, options, size, stage)]['wall']
+        h = latest[(head, options, size, stage)]['wall']
+        ratio = h / b if b > 0 else float('nan')
+        flag = '  <-- slower' if ratio > 1.1 else ''
+        print(options.ljust(30) + str(size).rjust(7) + '  ' + stage.ljust(30) + ('%.2f' % b).rjust(12) +
+              ('%.2f' % h).rjust(12) + ('%.2f' % ratio).rjust(8) + flag)
+
+
+if __name__ == '__main__':
+    app = BenchApp()
+    try:
+        app.setup()
+        app.run()
+
+        commit = current_commit()
+
+        if app.pargs.compare:
+            compare(load_results(app.pargs.results), app.pargs.compare, commit)
+        else:
+            sizes = DEFAULT_SIZES
+            if app.pargs.sizes:
+                sizes = [int(s) for s in app.pargs.sizes.split(',')]
+
+            persist = None
+            if app.pargs.persist:
+                persist = app.pargs.persist.split(',')
+            chunked = None
+            if app.pargs.chunked:
+                chunked = app.pargs.chunked.split(',')
+
+            options = {'backend': app.pargs.backend, 'intermediates': app.pargs.intermediates,
+                       'persist': persist, 'chunked': chunked, 'acc_workers': app.pargs.acc_workers}
+
+            work_dir = app.pargs.work or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'work')
+
+            for size in sizes:
+                summary = run_size_in_process(size, app.pargs.cell_size, app.pargs.seed, work_dir, app.pargs.backend,
+                                   app.pargs.intermediates, persist, chunked, app.pargs.acc_workers)
+                records = stage_records(summary, size, app.pargs.cell_size, commit, options)
+                with open(app.pargs.results, 'a') as results:
+                    for r in records:
+                        results.write(json.dumps(r) + '\n')
+                print('Results for ' + str(size) + ' appended to ' + app.pargs.results)
+    finally:
+        app.close()
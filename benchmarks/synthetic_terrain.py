@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Reproducible synthetic terrain for the workflow benchmarks
+
+Diamond-square fractal DEMs with a regional tilt, normal fault scarps along
+synthetic fault lines, pour points along the faults and coarse monthly
+climate grids derived from the DEM.
+"""
+import math
+
+import numpy as np
+
+
+# Largest grid built directly with diamond-square (a 2^13+1 grid)
+MAX_FRACTAL_SIZE = 8193
+
+
+def diamond_square(size, roughness = 0.55, seed = 0):
+    # Fractal surface of size x size cells, cropped from a 2^n+1 grid
+    n = int(math.ceil(math.log(max(size - 1, 1), 2)))
+    full = 2 ** n + 1
+    rng = np.random.RandomState(seed)
+
+    grid = np.zeros((full, full), dtype=np.float32)
+    grid[0::full-1, 0::full-1] = rng.uniform(-1, 1, (2, 2))
+
+    step = full - 1
+    scale = 1.0
+    while step > 1:
+        half = step // 2
+
+        # Diamond step, centres of each square
+        corners = (grid[0:-1:step, 0:-1:step] + grid[0:-1:step, step::step] +
+                   grid[step::step, 0:-1:step] + grid[step::step, step::step]) / 4
+        grid[half::step, half::step] = corners + rng.uniform(-scale, scale, corners.shape)
+
+        # Square step, edge midpoints from their in-grid neighbours
+        for r0, c0 in [(0, half), (half, 0)]:
+            rows = np.arange(r0, full, step)
+            cols = np.arange(c0, full, step)
+            total = np.zeros((len(rows), len(cols)), dtype=np.float32)
+            count = np.zeros((len(rows), len(cols)), dtype=np.float32)
+            for dr, dc in [(-half, 0), (half, 0), (0, -half), (0, half)]:
+                r = rows + dr
+                c = cols + dc
+                r_ok = (r >= 0) & (r < full)
+                c_ok = (c >= 0) & (c < full)
+                block = grid[np.clip(r, 0, full-1)][:, np.clip(c, 0, full-1)]
+                mask = r_ok[:, None] & c_ok[None, :]
+                total += np.where(mask, block, 0)
+                count += mask
+            grid[np.ix_(rows, cols)] = total / count + rng.uniform(-scale, scale, total.shape)
+
+        step = half
+        scale = scale * roughness
+
+    return grid[:size, :size]
+
+
+def synthetic_dem(size, relief = 1500.0, tilt = 0.6, seed = 0, rows_per_chunk = 1024):
+    # Fractal relief on a regional slope so the drainage has somewhere to go.
+    # Past MAX_FRACTAL_SIZE the fractal is built coarser and upsampled, with
+    # fine noise to break up the blocks
+    factor = int(math.ceil(size / float(MAX_FRACTAL_SIZE)))
+    dem = diamond_square(int(math.ceil(size / float(factor))), seed = seed)
+
+    if factor > 1:
+        dem = np.repeat(np.repeat(dem, factor, axis=0), factor, axis=1)[:size, :size]
+        rng = np.random.RandomState(seed + 4)
+        for r0 in range(0, size, rows_per_chunk):
+            r1 = min(r0 + rows_per_chunk, size)
+            dem[r0:r1] += rng.uniform(-0.01, 0.01, (r1 - r0, size)).astype(np.float32)
+
+    dem = (dem - dem.min()) / max(float(dem.max() - dem.min()), 1e-6)
+    ramp = np.linspace(1, 0, size, dtype=np.float32)
+    dem = relief * ((1 - tilt) * dem + tilt * ramp[:, None])
+
+    return dem.astype(np.float32)
+
+
+def fault_lines(size, cell_size, n_faults = 3, seed = 0):
+    # Roughly range-parallel faults, as lists of (x, y) vertices in map units
+    # with the origin at the lower left of the DEM
+    rng = np.random.RandomState(seed + 1)
+    extent = size * cell_size
+    faults = []
+
+    for i in range(n_faults):
+        y = extent * (i + 1) / float(n_faults + 1)
+        xs = np.linspace(0.05, 0.95, 8) * extent
+        ys = y + rng.uniform(-0.03, 0.03, len(xs)) * extent
+        slip_min = round(float(rng.uniform(0.1, 0.5)), 2)
+        faults.append({
+            'id': i + 1,
+            'name': 'fault_' + str(i + 1),
+            'vertices': list(zip(xs.tolist(), ys.tolist())),
+            'slip_min': slip_min,
+            'slip_max': slip_min + round(float(rng.uniform(0.1, 1.0)), 2),
+            'age_min': 0,
+            'age_max': 5,
+            'sense': 'normal'
+        })
+
+    return faults
+
+
+def apply_fault_scarps(dem, faults, cell_size, throw = 150.0, rows_per_chunk = 512):
+    # Raise the footwall (north side) of each fault, in row chunks to cap memory
+    rows, cols = dem.shape
+    x = (np.arange(cols) + 0.5) * cell_size
+
+    for fault in faults:
+        v = np.array(fault['vertices'])
+        fault_y = np.interp(x, v[:, 0], v[:, 1])
+        inside = (x >= v[0, 0]) & (x <= v[-1, 0])
+        # Throw tapers to zero at the fault tips
+        taper = np.where(inside, np.sin(np.pi * (x - v[0, 0]) / (v[-1, 0] - v[0, 0])), 0)
+
+        for r0 in range(0, rows, rows_per_chunk):
+            r1 = min(r0 + rows_per_chunk, rows)
+            # Row 0 is the top of the DEM
+            y = (rows - np.arange(r0, r1) - 0.5) * cell_size
+            footwall = y[:, None] > fault_y[None, :]
+            dem[r0:r1] += (throw * taper[None, :] * footwall).astype(dem.dtype)
+
+    return dem
+
+
+def pour_points(faults, n_points = 50, offset = 40.0, seed = 0):
+    # Points a little into the hanging wall, spread along the faults
+    rng = np.random.RandomState(seed + 2)
+    points = []
+
+    for i in range(n_points):
+        fault = faults[i % len(faults)]
+        v = np.array(fault['vertices'])
+        x = rng.uniform(v[0, 0], v[-1, 0])
+        y = float(np.interp(x, v[:, 0], v[:, 1])) - offset
+        points.append((float(x), y))
+
+    return points
+
+
+def monthly_climate(dem, factor = 30, seed = 0):
+    # Coarse monthly temperature (C x 10, as WorldClim) and precipitation (mm)
+    rows = dem.shape[0] // factor
+    cols = dem.shape[1] // factor
+    coarse = dem[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor).mean(axis=(1, 3))
+    rng = np.random.RandomState(seed + 3)
+
+    temps = []
+    precips = []
+    for month in range(12):
+        season = math.cos(2 * math.pi * (month - 6) / 12.0)
+        temp = 10 * (15 + 10 * season - 6.5 * coarse / 1000.0)
+        precip = 20 + 40 * (1 - season) + 0.03 * coarse
+        temps.append((temp + rng.normal(0, 2, temp.shape)).astype(np.float32))
+        precips.append(np.maximum(precip + rng.normal(0, 3, precip.shape), 0).astype(np.float32))
+
+    return temps, precips
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+BQART sediment flux for a set of catchments
+
+The per-catchment calculation behind GISbatch.do_bqart, kept free of arcpy
+so it can be run and checked anywhere. bqart_rows is the scalar reference,
+bqart_table the NumPy version the workflow uses. Both return the same rows.
+scenario_columns runs several climate scenarios side by side.
+
+Units in: precipitation mm/yr, temperature C x 10 (as WorldClim), relief m,
+area m^2, fault slip and uplift mm/yr
+"""
+import csv
+import math
+import sys
+
+import numpy as np
+
+
+OMEGA = 0.0006
+DENSITY = 2700 # kg/m^3
+POROSITY = 0.3
+SECONDS_PER_YEAR = 60*60*24*365
+
+# Megatons to m^3, the workflow has always used integer division here
+MT_TO_M3 = (1000000000 // DENSITY) * (1 + POROSITY)
+
+
+def bqart_rows(ids, precips, temps, areas, max_reliefs, min_reliefs, l_values,
+               fault_data_output, fault_meta_data, uplift_rate):
+    qs_rows = []
+
+    for k in ids:
+
+        precip = precips[k] # mm/yr - yearly average
+        area_m_squared = areas[k] # m^2
+        relief = max_reliefs[k] - min_reliefs[k] # m
+
+        temp = temps[k]/10.0 # C - yearly average (Worldclim temps need to be divided by 10)
+        density = DENSITY
+        omega = OMEGA
+
+        if l_values:
+            I = 1 #
+            L = l_values[k] # Lithology factor
+            Te = 0
+            Eb = 1
+            B = I * L * (1 - Te) * Eb
+        else:
+            B = 1
+
+        porosity = POROSITY
+
+        # Convert precipitation to m/yr
+        precip_m = precip / float(1000)
+
+        # Relief to km
+        relief_km = relief / float(1000)
+
+        # Convert area to km^2
+        area_km_squared = area_m_squared / float(1000000)
+
+        # Discharge m^3/yr
+        precip_m3_yr = precip_m * float(area_m_squared)
+
+        # Disharge m^3/s
+        Qw_s = precip_m3_yr / float(SECONDS_PER_YEAR)
+
+        # Discharge km^3/yr
+        Qw_km_yr = math.pow(((Qw_s*SECONDS_PER_YEAR)/1000000000),0.31)
+
+        # Area
+        A = math.pow(area_km_squared, 0.5)
+
+        if temp < 2:
+            # Qs in megatons per year
+            Qs_MT_yr = 2 * omega * B * Qw_km_yr * A * relief_km
+        else:
+            Qs_MT_yr = omega * B * Qw_km_yr * A * relief_km * temp
+
+        # Qs m^3/yr
+        Qs_m3_yr = Qs_MT_yr*MT_TO_M3
+
+        Qs_m_yr = Qs_m3_yr / float(area_m_squared)
+
+        Qs_mm_yr = Qs_m_yr * float(1000)
+
+        qs = [k, precip, omega, B,precip_m3_yr, Qw_s, Qw_km_yr, area_km_squared, A, relief_km, temp, Qs_MT_yr, porosity, density, Qs_m3_yr, Qs_m_yr, Qs_mm_yr]
+
+        if fault_data_output:
+            if fault_data_output[str(k)]:
+
+                fault_id = fault_data_output[str(k)][0]
+                # We're using max
+                max_fault_slip_mm_yr = fault_meta_data[int(fault_id)]['slip_max']
+                min_fault_slip_mm_yr = fault_meta_data[int(fault_id)]['slip_min']
+                qs.append(max_fault_slip_mm_yr)
+                qs.append(min_fault_slip_mm_yr)
+
+                Q_tectonic_max = (area_m_squared * (max_fault_slip_mm_yr/float(1000)))
+                Q_tectonic_min = (area_m_squared * (min_fault_slip_mm_yr/float(1000)))
+
+                # Simple Qs
+                qs.append(Q_tectonic_min)
+                qs.append(Q_tectonic_max)
+
+                # Fault number
+                qs.append(fault_id)
+                # Fault name
+                qs.append(fault_meta_data[int(fault_id)]['name'])
+                # Distance
+                qs.append(fault_data_output[str(k)][1])
+        else:
+            Uplift_mm_yr = uplift_rate
+            Uplift_metres_yr = Uplift_mm_yr / float(1000)
+            Q_tectonic = area_m_squared * Uplift_metres_yr
+            qs.append(Uplift_mm_yr)
+            qs.append(Uplift_mm_yr)
+            qs.append(Q_tectonic)
+            qs.append(Q_tectonic)
+
+        qs_rows.append(qs)
+
+    return qs_rows
+
+
+def gather(ids, values):
+    return np.fromiter((values[k] for k in ids), dtype=float, count=len(ids))
+
+
+def bqart_columns(precip, temp, area, relief, B):
+    # Whole-array BQART, temp in C and relief in m
+    precip_m3_yr = (precip / 1000.0) * area
+    Qw_s = precip_m3_yr / float(SECONDS_PER_YEAR)
+    Qw_km_yr = np.power((Qw_s * SECONDS_PER_YEAR) / 1000000000, 0.31)
+    area_km_squared = area / 1000000.0
+    A = np.power(area_km_squared, 0.5)
+    relief_km = relief / 1000.0
+
+    # Same operation order as the scalar version, so the results match exactly
+    Qs_MT_yr = np.where(temp < 2, 2 * OMEGA * B * Qw_km_yr * A * relief_km,
+                        OMEGA * B * Qw_km_yr * A * relief_km * temp)
+    Qs_m3_yr = Qs_MT_yr * MT_TO_M3
+    Qs_m_yr = Qs_m3_yr / area
+
+    return {
+        'precip_m3_yr': precip_m3_yr,
+        'Qw_s': Qw_s,
+        'Qw_km_yr': Qw_km_yr,
+        'area_km_squared': area_km_squared,
+        'A': A,
+        'relief_km': relief_km,
+        'Qs_MT_yr': Qs_MT_yr,
+        'Qs_m3_yr': Qs_m3_yr,
+        'Qs_m_yr': Qs_m_yr,
+        'Qs_mm_yr': Qs_m_yr * 1000.0
+    }
+
+
+def scenario_columns(precip, temp, area, relief, B, baseline):
+    # BQART for every scenario in one pass. precip and temp are (scenario,
+    # catchment) arrays with temp in C, area, relief and B are per catchment.
+    # Each result also gets its change and ratio against the baseline row.
+    # Catchments without climate values are NaN throughout
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = bqart_columns(precip, temp, area, relief, B)
+        columns = dict((k, c[k]) for k in ['Qw_s', 'Qs_MT_yr', 'Qs_m3_yr', 'Qs_mm_yr'])
+
+        for k in list(columns):
+            base = columns[k][baseline]
+            columns[k + ' change'] = columns[k] - base
+            columns[k + ' ratio'] = columns[k] / base
+
+    return columns
+
+
+def bqart_table(ids, precips, temps, areas, max_reliefs, min_reliefs, l_values,
+                fault_data_output, fault_meta_data, uplift_rate):
+    ids = list(ids)
+    n = len(ids)
+    if not n:
+        return []
+
+    precip = gather(ids, precips)
+    area = gather(ids, areas)
+    relief = gather(ids, max_reliefs) - gather(ids, min_reliefs)
+    temp = gather(ids, temps) / 10.0
+
+    if l_values:
+        B = gather(ids, l_values)
+    else:
+        B = np.ones(n)
+
+    c = bqart_columns(precip, temp, area, relief, B)
+
+    columns = [ids, precip.tolist(), [OMEGA] * n, B.tolist() if l_values else [1] * n,
+               c['precip_m3_yr'].tolist(), c['Qw_s'].tolist(), c['Qw_km_yr'].tolist(),
+               c['area_km_squared'].tolist(), c['A'].tolist(), c['relief_km'].tolist(),
+               temp.tolist(), c['Qs_MT_yr'].tolist(), [POROSITY] * n, [DENSITY] * n,
+               c['Qs_m3_yr'].tolist(), c['Qs_m_yr'].tolist(), c['Qs_mm_yr'].tolist()]
+
+    if fault_data_output:
+        fault_rows = [fault_data_output[str(k)] for k in ids]
+        fault_ids = [r[0] for r in fault_rows]
+
+        # Slip rates looked up once per fault rather than once per catchment
+        unique_ids, index = np.unique(np.array([int(f) for f in fault_ids]), return_inverse=True)
+        meta = [fault_meta_data[int(f)] for f in unique_ids]
+        slip_max = [m['slip_max'] for m in meta]
+        slip_min = [m['slip_min'] for m in meta]
+        names = [m['name'] for m in meta]
+
+        max_slips = np.array(slip_max, dtype=float)[index]
+        min_slips = np.array(slip_min, dtype=float)[index]
+
+        columns.extend([
+            [slip_max[i] for i in index],
+            [slip_min[i] for i in index],
+            (area * (min_slips / 1000.0)).tolist(),
+            (area * (max_slips / 1000.0)).tolist(),
+            fault_ids,
+            [names[i] for i in index],
+            [r[1] for r in fault_rows]])
+    else:
+        Q_tectonic = (area * (uplift_rate / 1000.0)).tolist()
+        columns.extend([[uplift_rate] * n, [uplift_rate] * n, Q_tectonic, Q_tectonic])
+
+    return [list(r) for r in zip(*columns)]
+
+
+def csv_output(path):
+    # csv wants binary files on Python 2 and newline='' text files on 3
+    if sys.version_info[0] < 3:
+        return open(path, 'wb')
+
+    return open(path, 'w', newline='')
+
+
+def save_table(qs_data, data_path, row_headers, ignore, min_area, fan_toe_lengths):
+    if min_area:
+        qs_data = [r for r in qs_data if r[7] * float(1000000) > min_area]
+
+    if ignore:
+        ignore = set(ignore)
+
+    catchment_data = {}
+    catchment_ids = []
+
+    with csv_output(data_path) as qs_file:
+        a = csv.writer(qs_file, delimiter=',')
+        a.writerow(row_headers)
+        for r in qs_data:
+            if ignore and r[0] in ignore:
+                continue
+
+            catchment_ids.append(r[0])
+
+            if fan_toe_lengths:
+                r.append(fan_toe_lengths[str(int(r[0]))])
+
+            catchment_data[r[0]] = r
+            a.writerow(r)
+
+    return catchment_ids, catchment_data
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Linear and log-log fits for every pair of catchment datasets
+
+Fits come from per-group sums of x, y, x^2, y^2 and xy, so every dataset
+pair for every fault group is fitted in a few passes over the table.
+Confidence intervals use a Poisson bootstrap (each catchment gets a
+Poisson(1) weight per resample) so the resamples are weighted sums too.
+"""
+import math
+
+import numpy as np
+
+
+KINDS = ['linear', 'loglog']
+
+# Sums kept per (x, y) pair, in this order
+TERMS = ['n', 'sx', 'sy', 'sxx', 'syy', 'sxy']
+
+# Rough cap on the floats held per chunk of rows
+CHUNK_VALUES = 8000000
+
+# Poisson(1) draws from 16 bit random integers, several times quicker than
+# RandomState.poisson
+POISSON_LOOKUP = np.searchsorted(
+    np.round(np.cumsum([math.exp(-1) / math.factorial(i) for i in range(20)]) * 65536),
+    np.arange(65536), side='right').astype(np.uint8)
+
+
+def kind_values(values, kind):
+    # Data matrix for one kind of fit and which values can be used
+    if kind == 'loglog':
+        usable = np.isfinite(values) & (values > 0)
+        values = np.log(np.where(usable, values, 1))
+    else:
+        usable = np.isfinite(values)
+
+    # Centring keeps the sums of squares well conditioned
+    counts = np.maximum(usable.sum(axis=0), 1)
+    centres = np.where(usable, values, 0).sum(axis=0) / counts
+
+    return np.where(usable, values - centres, 0), usable.astype(float), centres
+
+
+def pair_terms(d, w):
+    # Per-row sums for every (x, y) pair, rows x 6 x k x k
+    d2 = d * d
+    return np.stack([
+        w[:, :, None] * w[:, None, :],
+        d[:, :, None] * w[:, None, :],
+        w[:, :, None] * d[:, None, :],
+        d2[:, :, None] * w[:, None, :],
+        w[:, :, None] * d2[:, None, :],
+        d[:, :, None] * d[:, None, :]
+    ], axis=1).reshape(len(d), -1)
+
+
+def fit_from_sums(sums, centres):
+    # sums has TERMS on the second to last axis but two, then x and y
+    n, sx, sy, sxx, syy, sxy = [sums[..., i, :, :] for i in range(len(TERMS))]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xx = n * sxx - sx * sx
+        yy = n * syy - sy * sy
+        xy = n * sxy - sx * sy
+        slope = xy / xx
+        intercept = (sy - slope * sx) / n
+        r_squared = (xy * xy) / (xx * yy)
+
+    # Back from centred values
+    intercept = intercept + centres[None, :] - slope * centres[:, None]
+
+    return slope, intercept, r_squared
+
+
+def fit_matrix(table, names = None, kinds = None, groups = True, resamples = 1000,
+               confidence = 0.95, seed = 0):
+    # Fits of every y against every x, for all catchments and each fault.
+    # Arrays are indexed [group, x, y], group 0 being all catchments
+    if names is None:
+        names = [n for n in sorted(table.columns) if n != 'fault id']
+    kinds = kinds or KINDS
+
+    values = np.column_stack([table.column(n) for n in names])
+    k = len(names)
+
+    if groups and len(table.fault_keys):
+        inverse = table.fault_inverse
+        group_labels = ['all'] + [int(f) for f in table.fault_keys]
+    else:
+        inverse = np.zeros(len(table), dtype=int) - 1
+        group_labels = ['all']
+
+    # Rows sorted by fault so each group is a contiguous block, rows with no
+    # fault (-1) come first and only count towards 'all'
+    order = np.argsort(inverse, kind='mergesort')
+    bounds = np.searchsorted(inverse[order], np.arange(-1, len(group_labels)))
+    chunk_rows = max(1, CHUNK_VALUES // (len(TERMS) * k * k + resamples))
+    rng = np.random.RandomState(seed)
+    alpha = (1 - confidence) / 2.0 * 100
+
+    result = {'names': list(names), 'groups': group_labels, 'confidence': confidence}
+
+    for kind in kinds:
+        d, w, centres = kind_values(values[order], kind)
+
+        # Block 0 holds the rows without a fault
+        sums = np.zeros((len(group_labels), len(TERMS) * k * k))
+        boot = np.zeros((len(group_labels), resamples, len(TERMS) * k * k))
+
+        for g in range(len(group_labels)):
+            for r0 in range(bounds[g], bounds[g + 1], chunk_rows):
+                r1 = min(r0 + chunk_rows, bounds[g + 1])
+                terms = pair_terms(d[r0:r1], w[r0:r1])
+                sums[g] += terms.sum(axis=0)
+                if resamples:
+                    weights = POISSON_LOOKUP[rng.randint(0, 65536, (resamples, r1 - r0))].astype(float)
+                    boot[g] += weights.dot(terms)
+
+        # 'all' takes in every block, the fault groups only their own
+        sums[0] = sums.sum(axis=0)
+        boot[0] = boot.sum(axis=0)
+
+        shape = (len(group_labels), len(TERMS), k, k)
+        slope, intercept, r_squared = fit_from_sums(sums.reshape(shape), centres)
+
+        fits = {
+            'n': sums.reshape(shape)[:, 0].astype(int),
+            'slope': slope,
+            'intercept': intercept,
+            'r_squared': r_squared
+        }
+
+        if resamples:
+            b_slope, b_intercept, _ = fit_from_sums(
+                boot.reshape((len(group_labels), resamples, len(TERMS), k, k)), centres)
+            with np.errstate(invalid='ignore'):
+                fits['slope_ci'] = np.nanpercentile(b_slope, [alpha, 100 - alpha], axis=1)
+                fits['intercept_ci'] = np.nanpercentile(b_intercept, [alpha, 100 - alpha], axis=1)
+
+        result[kind] = fits
+
+    return result
+
+
+def fit_records(matrix):
+    # One row per group, kind and distinct pair
+    names = matrix['names']
+    records = []
+
+    for kind in KINDS:
+        if kind not in matrix:
+            continue
+        fits = matrix[kind]
+        for g, group in enumerate(matrix['groups']):
+            for i, x in enumerate(names):
+                for j, y in enumerate(names):
+                    if i == j:
+                        continue
+                    r = {'kind': kind, 'group': group, 'x': x, 'y': y,
+                         'n': int(fits['n'][g, i, j]),
+                         'slope': float(fits['slope'][g, i, j]),
+                         'intercept': float(fits['intercept'][g, i, j]),
+                         'r_squared': float(fits['r_squared'][g, i, j])}
+                    if 'slope_ci' in fits:
+                        r['slope_low'] = float(fits['slope_ci'][0, g, i, j])
+                        r['slope_high'] = float(fits['slope_ci'][1, g, i, j])
+                        r['intercept_low'] = float(fits['intercept_ci'][0, g, i, j])
+                        r['intercept_high'] = float(fits['intercept_ci'][1, g, i, j])
+                    records.append(r)
+
+    return records
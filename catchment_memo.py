@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Catchment results kept between runs
+
+Each catchment is identified by a hash of its footprint, the cells its
+label covers in the watershed raster and the grid they are on, so the same
+catchment is recognised whatever ID a pour point set gives it. Zonal
+statistics rows are kept by footprint, value source (the climate scenario
+or DEM fingerprint) and table name, and BQART rows by footprint, scenario
+and a hash of the parameters that catchment's row depends on, in one
+SQLite file per project.
+
+Runs with an overlapping pour point set then only compute the catchments
+that are new or changed.
+"""
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+
+def footprint_hashes(labels, georef):
+    # SHA1 of each label's flat cell indices plus the grid description,
+    # labels is a float array with NaN outside every catchment
+    flat = labels.ravel()
+    cells = np.flatnonzero(np.isfinite(flat))
+    zone = flat[cells].astype(np.int64)
+    order = np.argsort(zone, kind='mergesort')
+    zone, cells = zone[order], cells[order].astype('<i8')
+
+    keys, starts = np.unique(zone, return_index=True)
+    ends = np.append(starts[1:], len(zone))
+    hashes = {}
+    for k, s, e in zip(keys.tolist(), starts.tolist(), ends.tolist()):
+        h = hashlib.sha1(georef.encode('utf-8'))
+        h.update(cells[s:e].tobytes())
+        hashes[k] = h.hexdigest()
+
+    return hashes
+
+
+def params_hash(params):
+    described = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(described.encode('utf-8')).hexdigest()
+
+
+class CatchmentMemo:
+    'Zonal and BQART rows by catchment footprint in an SQLite file'
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS zonal (footprint TEXT, source TEXT, name TEXT, row TEXT, '
+                        'PRIMARY KEY (footprint, source, name))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS qs (footprint TEXT, source TEXT, params TEXT, row TEXT, '
+                        'PRIMARY KEY (footprint, source, params))')
+        self.db.commit()
+
+    def select(self, query, footprints, values):
+        # Rows of a query over batches of footprints, SQLite limits the
+        # number of bound parameters
+        footprints = list(footprints)
+        for i in range(0, len(footprints), 500):
+            batch = footprints[i:i + 500]
+            for row in self.db.execute(query + ' AND footprint IN (' + ','.join(['?'] * len(batch)) + ')',
+                                       values + batch):
+                yield row
+
+    def zonal_rows(self, footprints, source, name):
+        # Stored rows by footprint
+        query = 'SELECT footprint, row FROM zonal WHERE source = ? AND name = ?'
+        return dict((f, json.loads(r)) for f, r in self.select(query, footprints, [source, name]))
+
+    def store_zonal(self, rows, source, name):
+        # rows maps footprint to the row without its catchment ID, or None
+        # for a catchment with no row
+        self.db.executemany('INSERT OR REPLACE INTO zonal VALUES (?, ?, ?, ?)',
+                            [(f, source, name, json.dumps(r)) for f, r in rows.items()])
+        self.db.commit()
+
+    def qs_rows(self, keys, source):
+        # Stored rows by (footprint, params)
+        query = 'SELECT footprint, params, row FROM qs WHERE source = ?'
+        keys = set(keys)
+        found = {}
+        for f, p, r in self.select(query, set([k[0] for k in keys]), [source]):
+            if (f, p) in keys:
+                found[(f, p)] = json.loads(r)
+
+        return found
+
+    def store_qs(self, rows, source):
+        # rows maps (footprint, params) to the row without its catchment ID,
+        # or None for a catchment with no row
+        self.db.executemany('INSERT OR REPLACE INTO qs VALUES (?, ?, ?, ?)',
+                            [(f, source, p, json.dumps(r)) for (f, p), r in rows.items()])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
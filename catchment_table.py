@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Catchment data tables as NumPy arrays
+
+Columns are found by header name rather than position, so the older sample
+tables (qs_data_sample.csv), the workflow's <scenario>_data.csv files and
+merged multi-scenario tables all load the same way. Per-scenario columns in
+a merged table are named with the scenario in brackets, e.g.
+'erosion (mm/yr) [lgm_ccsm4]'.
+"""
+import csv
+import re
+
+import numpy as np
+
+
+# Header names each dataset has been written under, lower case
+COLUMN_ALIASES = {
+    'id': ['id'],
+    'precipitation': ['precipitation (mm/yr)', 'precipitation'],
+    'area': ['a (km^2)', 'area (km^2)'],
+    'relief': ['r (km)', 'relief (km)'],
+    'temperature': ['t(c)', 't (c)'],
+    'volume': ['volume (m^3/yr)', 'qs (m^3/yr)'],
+    'sediment flux': ['qs (t/y)'],
+    'erosion mm': ['erosion (mm/yr)'],
+    'erosion m': ['erosion (m/yr)'],
+    'fault id': ['fault_id', 'fault id'],
+    'fault distance': ['distance']
+}
+
+# Datasets that can be worked out from another column when missing
+DERIVED_COLUMNS = {
+    'sediment flux': ('qs (mt/y)', 1000000.0)
+}
+
+SCENARIO_COLUMN = re.compile(r'^(.*\S)\s*\[(.+)\]$')
+
+
+def scenario_column(name, scenario):
+    # Header of a per-scenario column in a merged table
+    return name + ' [' + scenario + ']'
+
+
+def normalise(header):
+    return ' '.join(header.strip().lower().split())
+
+
+def parse_header(header):
+    # Base names and scenarios of each column, scenario is None when shared
+    parsed = []
+    for h in header:
+        match = SCENARIO_COLUMN.match(h.strip())
+        if match:
+            parsed.append((normalise(match.group(1)), match.group(2).strip()))
+        else:
+            parsed.append((normalise(h), None))
+
+    return parsed
+
+
+def to_float(values):
+    # Bulk conversion, with unparseable or empty values as NaN
+    try:
+        return np.array(values, dtype=float)
+    except ValueError:
+        out = np.empty(len(values))
+        for i, v in enumerate(values):
+            try:
+                out[i] = float(v)
+            except ValueError:
+                out[i] = np.nan
+        return out
+
+
+class CatchmentTable:
+    'Catchment columns as arrays, with an index of catchments per fault'
+
+    def __init__(self, ids, columns, scenario = None, scenarios = None):
+        self.ids = ids
+        self.columns = columns
+        self.scenario = scenario
+        self.scenarios = scenarios or []
+
+        self.faults = {}
+        self.fault_keys = np.array([], dtype=int)
+        self.fault_inverse = np.zeros(len(ids), dtype=int) - 1
+
+        fault_ids = columns.get('fault id')
+        if fault_ids is not None:
+            known = ~np.isnan(fault_ids)
+            self.fault_keys, inverse = np.unique(fault_ids[known].astype(int), return_inverse=True)
+            self.fault_inverse[known] = inverse
+
+            # Row indices of each fault's catchments, in file order
+            order = np.argsort(self.fault_inverse, kind='mergesort')
+            bounds = np.searchsorted(self.fault_inverse[order], np.arange(len(self.fault_keys) + 1))
+            for i, key in enumerate(self.fault_keys):
+                self.faults[int(key)] = order[bounds[i]:bounds[i + 1]]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def has(self, name):
+        return name in self.columns
+
+    def column(self, name):
+        if name not in self.columns:
+            raise KeyError(name + ' is not in this table, it has ' + ', '.join(sorted(self.columns)))
+
+        return self.columns[name]
+
+    def fault_rows(self, fault, name = None):
+        # Row indices, or values of a column, for the catchments on one fault
+        rows = self.faults[fault]
+        if name is None:
+            return rows
+
+        return self.column(name)[rows]
+
+
+def read_header(path):
+    with open(path) as csvfile:
+        return next(csv.reader(csvfile, delimiter=','))
+
+
+def table_scenarios(header):
+    scenarios = []
+    for _, scenario in parse_header(header):
+        if scenario is not None and scenario not in scenarios:
+            scenarios.append(scenario)
+
+    return scenarios
+
+
+def load_catchment_table(path, scenario = None):
+    header = read_header(path)
+    parsed = parse_header(header)
+    scenarios = table_scenarios(header)
+
+    if scenarios:
+        if scenario is None and len(scenarios) == 1:
+            scenario = scenarios[0]
+        elif scenario not in scenarios:
+            raise ValueError('Choose one of the scenarios in '+path+': '+', '.join(scenarios))
+
+    # Scenario columns take the place of shared columns with the same name
+    positions = {}
+    for i, (name, column_scenario) in enumerate(parsed):
+        if column_scenario is None and name not in positions:
+            positions[name] = i
+    for i, (name, column_scenario) in enumerate(parsed):
+        if column_scenario is not None and column_scenario == scenario:
+            positions[name] = i
+
+    wanted = {}
+    for dataset, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in positions:
+                wanted[dataset] = positions[alias]
+                break
+    for dataset, (source, factor) in DERIVED_COLUMNS.items():
+        if dataset not in wanted and source in positions:
+            wanted[source] = positions[source]
+
+    if 'id' not in wanted:
+        raise ValueError('No id column in '+path)
+
+    # Only the needed columns are kept while reading
+    names = list(wanted)
+    indices = [wanted[n] for n in names]
+    values = [[] for n in names]
+    width = max(indices) + 1
+    short = 0
+    with open(path) as csvfile:
+        reader = csv.reader(csvfile, delimiter=',')
+        next(reader)
+        for row in reader:
+            if len(row) < width:
+                # Blank lines aren't rows, truncated ones are counted
+                if any(c.strip() for c in row):
+                    short = short + 1
+                continue
+            for v, i in zip(values, indices):
+                v.append(row[i])
+    if short:
+        print('Skipping '+str(short)+' rows with fewer than '+str(width)+' columns in '+path)
+
+    columns = dict((n, to_float(v)) for n, v in zip(names, values))
+
+    ids = columns.pop('id')
+    valid = ~np.isnan(ids)
+    if not valid.all():
+        print('Skipping '+str(int((~valid).sum()))+' rows without a catchment id in '+path)
+    ids = ids[valid].astype(int)
+    for n in columns:
+        columns[n] = columns[n][valid]
+
+    for dataset, (source, factor) in DERIVED_COLUMNS.items():
+        if dataset not in columns and source in columns:
+            columns[dataset] = columns.pop(source) * factor
+
+    return CatchmentTable(ids, columns, scenario, scenarios)
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+D8 hydrology on NumPy arrays
+
+The Fill, FlowDirection, FlowAccumulation, StreamOrder, SnapPourPoint and
+Watershed steps of the hydro and watershed workflows, without arcpy.
+Directions use the ESRI codes (1 east, then clockwise to 128 north east) so
+rasters from either backend can be mixed.
+
+Cells are worked on as flat indices into the grid. Downstream ordering comes
+from flow_levels, which groups cells so that every cell is in a later level
+than all of the cells draining into it.
+"""
+import heapq
+import math
+
+import numpy as np
+
+
+# ESRI D8 codes and the (row, col) step each one points to
+D8_CODES = np.array([1, 2, 4, 8, 16, 32, 64, 128])
+D8_ROWS = np.array([0, 1, 1, 1, 0, -1, -1, -1])
+D8_COLS = np.array([1, 1, 0, -1, -1, -1, 0, 1])
+D8_DISTANCE = np.array([1, math.sqrt(2)] * 4)
+
+# Direction index for each code, -1 for anything else
+CODE_INDEX = np.zeros(256, dtype=int) - 1
+CODE_INDEX[D8_CODES] = np.arange(8)
+
+
+def fill_depressions(dem):
+    # Priority-flood (Barnes et al. 2014): cells are raised to their spill
+    # height working inwards from the edges and nodata. Cells raised into a
+    # pit go on a plain queue, which is quicker than the heap
+    rows, cols = dem.shape
+    width = cols + 2
+    valid = np.isfinite(dem)
+
+    padded = np.zeros((rows + 2, width))
+    padded[1:-1, 1:-1] = np.where(valid, dem, 0)
+    closed = np.ones((rows + 2, width), dtype=bool)
+    closed[1:-1, 1:-1] = ~valid
+
+    # Seeds are the open cells next to anything closed
+    edge = np.zeros((rows + 2, width), dtype=bool)
+    for dr, dc in zip(D8_ROWS, D8_COLS):
+        edge[1:-1, 1:-1] |= closed[1 + dr:rows + 1 + dr, 1 + dc:cols + 1 + dc]
+    seeds = np.flatnonzero(edge & ~closed)
+
+    elevation = padded.ravel().tolist()
+    is_closed = closed.ravel().tolist()
+    offsets = (D8_ROWS * width + D8_COLS).tolist()
+
+    heap = [(elevation[i], i) for i in seeds.tolist()]
+    heapq.heapify(heap)
+    for i in seeds.tolist():
+        is_closed[i] = True
+
+    pit = []
+    while heap or pit:
+        if pit:
+            i = pit.pop()
+        else:
+            i = heapq.heappop(heap)[1]
+        z = elevation[i]
+        for o in offsets:
+            n = i + o
+            if is_closed[n]:
+                continue
+            is_closed[n] = True
+            if elevation[n] <= z:
+                elevation[n] = z
+                pit.append(n)
+            else:
+                heapq.heappush(heap, (elevation[n], n))
+
+    filled = np.array(elevation).reshape(rows + 2, width)[1:-1, 1:-1]
+
+    return np.where(valid, filled, np.nan)
+
+
+def flow_directions(dem, force_flow = False):
+    # Steepest descent. Edge cells drain off the grid when nothing inside is
+    # lower (NORMAL) or always (FORCE), flats drain towards their outlets
+    rows, cols = dem.shape
+    valid = np.isfinite(dem)
+    padded = np.zeros((rows + 2, cols + 2)) + np.nan
+    padded[1:-1, 1:-1] = dem
+
+    max_drop = np.zeros(dem.shape) - np.inf
+    best = np.zeros(dem.shape, dtype=np.int8)
+    # First direction leading off the grid or into nodata
+    outside = np.zeros(dem.shape, dtype=np.int8) - 1
+    with np.errstate(invalid='ignore'):
+        for k in range(8):
+            neighbour = padded[1 + D8_ROWS[k]:rows + 1 + D8_ROWS[k], 1 + D8_COLS[k]:cols + 1 + D8_COLS[k]]
+            drop = (dem - neighbour) / D8_DISTANCE[k]
+            steeper = drop > max_drop
+            max_drop[steeper] = drop[steeper]
+            best[steeper] = k
+            outside[np.isnan(neighbour) & (outside < 0)] = k
+
+    codes = np.where(max_drop > 0, D8_CODES[best], 0)
+
+    edge = (outside >= 0) & valid
+    if force_flow:
+        outward = edge
+    else:
+        outward = edge & (max_drop <= 0)
+    codes[outward] = D8_CODES[outside[outward]]
+    codes[~valid] = 0
+
+    # Flats, breadth first from cells that already drain
+    z = dem.ravel()
+    codes = codes.ravel()
+    flat = (valid & (max_drop == 0)).ravel() & (codes == 0)
+    frontier = np.flatnonzero(codes > 0)
+    while frontier.size and flat.any():
+        f_rows, f_cols = np.divmod(frontier, cols)
+        reached = []
+        for k in range(8):
+            nr = f_rows + D8_ROWS[k]
+            nc = f_cols + D8_COLS[k]
+            ok = (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols)
+            n = nr[ok] * cols + nc[ok]
+            take = flat[n] & (z[n] == z[frontier[ok]])
+            n = np.unique(n[take])
+            if not n.size:
+                continue
+            # Step from the flat cell back to the frontier cell
+            codes[n] = D8_CODES[(k + 4) % 8]
+            flat[n] = False
+            reached.append(n)
+        frontier = np.concatenate(reached) if reached else np.array([], dtype=np.int64)
+
+    return codes.reshape(rows, cols)
+
+
+def receivers(codes, valid = None):
+    # Flat index of the cell each cell drains to, -1 for outlets and flow
+    # into nodata
+    rows, cols = codes.shape
+    c = codes.ravel()
+    if valid is None:
+        valid = np.isfinite(c)
+    else:
+        valid = valid.ravel()
+    k = CODE_INDEX[np.clip(np.where(np.isfinite(c), c, 0), 0, 255).astype(int)]
+    r, col = np.divmod(np.arange(rows * cols), cols)
+    nr = r + np.where(k >= 0, D8_ROWS[k], 0)
+    nc = col + np.where(k >= 0, D8_COLS[k], 0)
+    inside = valid & (k >= 0) & (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols)
+    target = np.where(inside, nr * cols + nc, -1)
+    target[inside] = np.where(valid[target[inside]], target[inside], -1)
+
+    return target
+
+
+def restrict(receiver, cells):
+    # Receivers within a subset of cells, -1 where the flow leaves it
+    target = np.where(cells & (receiver >= 0), receiver, -1)
+    ok = target >= 0
+    target[ok] = np.where(cells[target[ok]], target[ok], -1)
+
+    return target
+
+
+def flow_levels(receiver, cells = None):
+    # Cells grouped so every cell comes after everything upstream of it.
+    # Returns the cells in order and the bounds of each level. Cells on a
+    # loop never come free and are left out
+    n = len(receiver)
+    if cells is None:
+        cells = np.ones(n, dtype=bool)
+
+    target = restrict(receiver, cells)
+    indegree = np.bincount(target[target >= 0], minlength=n)
+
+    frontier = np.flatnonzero(cells & (indegree == 0))
+    levels = []
+    while frontier.size:
+        levels.append(frontier)
+        r = target[frontier]
+        r = r[r >= 0]
+        if not r.size:
+            break
+        r, counts = np.unique(r, return_counts=True)
+        indegree[r] -= counts
+        frontier = r[indegree[r] == 0]
+
+    if not levels:
+        return np.array([], dtype=np.int64), np.zeros(1, dtype=np.int64)
+
+    order = np.concatenate(levels)
+    bounds = np.concatenate([[0], np.cumsum([len(l) for l in levels])])
+
+    return order, bounds
+
+
+def accumulate(receiver, order, bounds, weights = None):
+    # Upstream totals, not counting the cell itself (as FlowAccumulation)
+    totals = np.zeros(len(receiver))
+    if weights is None:
+        weights = np.ones(len(receiver))
+    weights = np.where(np.isfinite(weights), weights, 0)
+
+    for i in range(len(bounds) - 1):
+        cells = order[bounds[i]:bounds[i + 1]]
+        r = receiver[cells]
+        ok = r >= 0
+        np.add.at(totals, r[ok], totals[cells[ok]] + weights[cells[ok]])
+
+    return totals
+
+
+def upstream_extreme(receiver, order, bounds, values, maximum = True):
+    # Highest (or lowest) value over each cell and everything upstream of
+    # it, ignoring NaN
+    extreme = np.array(values, dtype=float)
+    at = np.fmax.at if maximum else np.fmin.at
+
+    for i in range(len(bounds) - 1):
+        cells = order[bounds[i]:bounds[i + 1]]
+        r = receiver[cells]
+        ok = r >= 0
+        at(extreme, r[ok], extreme[cells[ok]])
+
+    return extreme
+
+
+def next_outlets(codes, cells):
+    # Position in cells of the first other one of cells downstream of each,
+    # -1 where the flow leaves the grid or reaches nodata first. Only the
+    # codes along the paths are read, so a memmap stays mostly on disk
+    rows, cols = codes.shape
+    flat = codes.reshape(-1)
+    by_cell = np.argsort(cells)
+    sorted_cells = cells[by_cell]
+
+    result = np.zeros(len(cells), dtype=np.int64) - 1
+    active = np.arange(len(cells))
+    position = np.array(cells, dtype=np.int64)
+
+    # No path is longer than the grid, the step count stops a loop in the codes
+    steps = 0
+    while active.size and steps < rows * cols:
+        steps = steps + 1
+        c = np.asarray(flat[position], dtype=float)
+        k = CODE_INDEX[np.clip(np.where(np.isfinite(c), c, 0), 0, 255).astype(int)]
+        r, col = np.divmod(position, cols)
+        nr = r + np.where(k >= 0, D8_ROWS[k], 0)
+        nc = col + np.where(k >= 0, D8_COLS[k], 0)
+        inside = (k >= 0) & (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols)
+        active, position = active[inside], (nr * cols + nc)[inside]
+
+        i = np.minimum(np.searchsorted(sorted_cells, position), len(cells) - 1)
+        found = sorted_cells[i] == position
+        result[active[found]] = by_cell[i[found]]
+        active, position = active[~found], position[~found]
+
+    return result
+
+
+def stream_order(receiver, streams, method = 'STRAHLER'):
+    # Strahler or Shreve order of the stream cells, 0 elsewhere
+    downstream = restrict(receiver, streams)
+    order, bounds = flow_levels(downstream, streams)
+
+    result = np.zeros(len(receiver), dtype=np.int64)
+    best = np.zeros(len(receiver), dtype=np.int64)
+    count = np.zeros(len(receiver), dtype=np.int64)
+    shreve = method.upper() == 'SHREVE'
+
+    for i in range(len(bounds) - 1):
+        cells = order[bounds[i]:bounds[i + 1]]
+        if shreve:
+            o = np.maximum(best[cells], 1)
+        else:
+            o = np.where(best[cells] == 0, 1, best[cells] + (count[cells] >= 2))
+        result[cells] = o
+
+        r = downstream[cells]
+        ok = r >= 0
+        r = r[ok]
+        o = o[ok]
+        if shreve:
+            np.add.at(best, r, o)
+            continue
+
+        # Track the highest incoming order and how many streams bring it
+        old = best[r]
+        np.maximum.at(best, r, o)
+        raised = best[r] != old
+        count[r[raised]] = 0
+        np.add.at(count, r[o == best[r]], 1)
+
+    return result
+
+
+def stream_links(receiver, streams, orders):
+    # Cell paths of each stream link, from a source or junction down to the
+    # next junction, with the order of the link
+    downstream = restrict(receiver, streams)
+    donors = np.bincount(downstream[downstream >= 0], minlength=len(receiver))
+
+    heads = np.flatnonzero(streams & (donors != 1))
+    downstream = downstream.tolist()
+    donors = donors.tolist()
+    links = []
+
+    for head in heads.tolist():
+        path = [head]
+        c = head
+        while True:
+            r = downstream[c]
+            if r < 0:
+                break
+            path.append(r)
+            if donors[r] != 1:
+                break
+            c = r
+        if len(path) > 1:
+            links.append((path, int(orders[head])))
+
+    return links
+
+
+def label_watersheds(receiver, labels, order = None, bounds = None):
+    # Every cell takes the label of the first labelled cell downstream of it
+    labels = labels.copy()
+    if order is None:
+        order, bounds = flow_levels(receiver)
+
+    for i in range(len(bounds) - 2, -1, -1):
+        cells = order[bounds[i]:bounds[i + 1]]
+        r = receiver[cells]
+        take = (labels[cells] < 0) & (r >= 0)
+        labels[cells[take]] = labels[r[take]]
+
+    return labels
+
+
+def snap_points(accumulation, rows, cols, radius):
+    # Move each point to the highest accumulation cell within radius cells
+    n_rows, n_cols = accumulation.shape
+    r_span = int(math.floor(radius))
+    dr, dc = np.mgrid[-r_span:r_span + 1, -r_span:r_span + 1]
+    in_reach = (dr * dr + dc * dc) <= radius * radius
+    dr = dr[in_reach]
+    dc = dc[in_reach]
+
+    values = np.where(np.isfinite(accumulation), accumulation, -np.inf)
+    snapped_rows = np.array(rows, dtype=np.int64)
+    snapped_cols = np.array(cols, dtype=np.int64)
+
+    for i in range(len(snapped_rows)):
+        r = snapped_rows[i] + dr
+        c = snapped_cols[i] + dc
+        ok = (r >= 0) & (r < n_rows) & (c >= 0) & (c < n_cols)
+        if not ok.any():
+            continue
+        best = np.argmax(values[r[ok], c[ok]])
+        snapped_rows[i] = r[ok][best]
+        snapped_cols[i] = c[ok][best]
+
+    return snapped_rows, snapped_cols
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Flow accumulation split into tiles across a process pool
+
+Each tile is accumulated on its own with the flow leaving it cut off. Tiles
+report their exit cells (cells draining into another tile), what each exit
+sends out from inside its tile, and which exit each cell on the tile edge
+drains to. Those make a small graph between tiles, accumulated in the main
+process to give the flow arriving at every entry cell. A second pass over
+the tiles adds that inflow to the cells downstream of each entry.
+
+Totals are the same as flow_grid.accumulate over the whole grid.
+
+The receiver, valid and weights arrays reach the workers as pool initargs.
+Where the pool forks (Linux, macOS with Python 2) the workers share the
+parent's copy for free. Windows starts fresh workers instead, and each one
+is sent a pickled copy of the whole grid, so on large grids there the
+workers cost a full copy of those arrays each.
+"""
+import multiprocessing
+
+import numpy as np
+
+import flow_grid
+
+
+TILE_SIZE = 1024
+
+
+def init_tile_worker(receiver, valid, weights, cols):
+    global worker_grid
+    worker_grid = (receiver, valid, weights, cols)
+
+
+def grid_tiles(shape, tile_size):
+    rows, cols = shape
+    tiles = []
+    for r0 in range(0, rows, tile_size):
+        for c0 in range(0, cols, tile_size):
+            tiles.append((r0, min(r0 + tile_size, rows), c0, min(c0 + tile_size, cols)))
+
+    return tiles
+
+
+def tile_cells(tile, cols):
+    # Flat indices into the whole grid of the cells in a tile
+    r0, r1, c0, c1 = tile
+    return (np.arange(r0, r1)[:, None] * cols + np.arange(c0, c1)).ravel()
+
+
+def edge_cells(rows, cols):
+    index = np.arange(rows * cols).reshape(rows, cols)
+    return np.unique(np.concatenate([index[0], index[-1], index[:, 0], index[:, -1]]))
+
+
+def local_receivers(tile, cells):
+    # Receivers as indices into the tile, -1 where the flow leaves it, and
+    # the receivers in the whole grid
+    r0, r1, c0, c1 = tile
+    receiver = worker_grid[0][cells]
+    rows, cols = np.divmod(receiver, worker_grid[3])
+    inside = (receiver >= 0) & (rows >= r0) & (rows < r1) & (cols >= c0) & (cols < c1)
+
+    return np.where(inside, (rows - r0) * (c1 - c0) + (cols - c0), -1), receiver
+
+
+def accumulate_tile(tile):
+    receiver, valid, weights, cols = worker_grid
+    r0, r1, c0, c1 = tile
+    cells = tile_cells(tile, cols)
+    local, target = local_receivers(tile, cells)
+
+    w = None if weights is None else weights[cells]
+    order, bounds = flow_grid.flow_levels(local, valid[cells])
+    totals = flow_grid.accumulate(local, order, bounds, w)
+
+    # Every cell is labelled with the exit its flow leaves the tile by
+    exits = np.flatnonzero(valid[cells] & (local < 0) & (target >= 0))
+    labels = np.zeros(len(cells), dtype=np.int64) - 1
+    labels[exits] = cells[exits]
+    labels = flow_grid.label_watersheds(local, labels, order, bounds)
+
+    own = 1.0 if w is None else np.where(np.isfinite(w[exits]), w[exits], 0)
+    edge = edge_cells(r1 - r0, c1 - c0)
+
+    return totals, cells[exits], target[exits], totals[exits] + own, cells[edge], labels[edge]
+
+
+def spread_inflow(task):
+    # Add the flow arriving at each entry to the cells below it in the tile
+    tile, entries, inflow = task
+    r0, r1, c0, c1 = tile
+    cols = worker_grid[3]
+    cells = tile_cells(tile, cols)
+    local, target = local_receivers(tile, cells)
+
+    position = (entries // cols - r0) * (c1 - c0) + entries % cols - c0
+    added = np.zeros(len(cells))
+    while position.size:
+        np.add.at(added, position, inflow)
+        position = local[position]
+        keep = position >= 0
+        # Paths that meet carry on as one
+        position, inverse = np.unique(position[keep], return_inverse=True)
+        inflow = np.bincount(inverse, weights=inflow[keep], minlength=len(position))
+
+    touched = np.flatnonzero(added)
+    return cells[touched], added[touched]
+
+
+def accumulate_tiled(receiver, valid, shape, weights = None, workers = None, tile_size = TILE_SIZE):
+    # Upstream totals not counting the cell itself, as flow_grid.accumulate
+    rows, cols = shape
+    tiles = grid_tiles(shape, tile_size)
+    workers = workers or multiprocessing.cpu_count()
+
+    # The initargs are only shared without copying where the pool forks
+    pool = multiprocessing.Pool(min(workers, len(tiles)), initializer=init_tile_worker,
+                                initargs=(receiver, valid, weights, cols))
+    try:
+        first = pool.map(accumulate_tile, tiles)
+
+        totals = np.zeros(rows * cols)
+        for tile, result in zip(tiles, first):
+            totals[tile_cells(tile, cols)] = result[0]
+
+        exits = np.concatenate([r[1] for r in first])
+        targets = np.concatenate([r[2] for r in first])
+        out = np.concatenate([r[3] for r in first])
+        edge = np.concatenate([r[4] for r in first])
+        edge_exit = np.concatenate([r[5] for r in first])
+
+        # Graph between exits: an exit drains into an edge cell of another tile,
+        # which drains to that tile's exit
+        by_exit = np.argsort(exits)
+        exits, targets, out = exits[by_exit], targets[by_exit], out[by_exit]
+        by_edge = np.argsort(edge)
+        edge, edge_exit = edge[by_edge], edge_exit[by_edge]
+
+        next_exit = edge_exit[np.searchsorted(edge, targets)]
+        graph = np.where(next_exit >= 0, np.searchsorted(exits, next_exit), -1)
+        order, bounds = flow_grid.flow_levels(graph)
+        outflow = flow_grid.accumulate(graph, order, bounds, out) + out
+
+        entries, inverse = np.unique(targets, return_inverse=True)
+        inflow = np.bincount(inverse, weights=outflow, minlength=len(entries))
+
+        # Entries grouped by the tile they are in
+        tiles_across = (cols + tile_size - 1) // tile_size
+        entry_tile = (entries // cols) // tile_size * tiles_across + (entries % cols) // tile_size
+        tasks = []
+        for t in np.unique(entry_tile).tolist():
+            take = entry_tile == t
+            tasks.append((tiles[t], entries[take], inflow[take]))
+
+        second = pool.map(spread_inflow, tasks)
+    finally:
+        # Workers are stopped even when a tile fails
+        pool.terminate()
+        pool.join()
+
+    for cells, added in second:
+        totals[cells] += added
+
+    return totals
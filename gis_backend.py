@@ -0,0 +1,1081 @@
+# -*- coding: utf-8 -*-
+"""
+Raster and vector backends for the GIS workflow
+
+GISbatch stages call a backend rather than arcpy, so a run can use ArcGIS
+(backend: arcpy, the default) or open-source tools (backend: numpy) as set
+in the project config. Both take and return paths, so every stage reads its
+inputs from and writes its outputs to disk the same way.
+
+The numpy backend does the hydrology with flow_grid, raster I/O with
+rasterio, vector I/O with fiona and geometry with shapely. Rasters are
+GeoTIFFs, or for intermediates raw memory-mapped arrays (.raw) or chunked
+compressed stores (.chunks), see raster_store. Feature classes are
+shapefiles and tables (zonal statistics, route events) are CSV files.
+Inputs are expected to already be in the project's projection_code.
+
+Outputs passed to hold() are kept in memory and handed to the next stage
+without being written, in_memory workspace datasets for arcpy and arrays or
+feature lists for numpy.
+"""
+import collections
+import csv
+import math
+import os
+import re
+
+import numpy as np
+
+import catchment_memo
+import flow_grid
+import flow_tiles
+import raster_store
+from lazy_modules import LazyModule
+
+# arcpy is only imported once an arcpy backend runs a stage
+arcpy = LazyModule('arcpy')
+sa = LazyModule('arcpy.sa')
+
+try:
+    import fiona
+    import rasterio
+    from rasterio import features as raster_features
+    from shapely import geometry, ops
+except ImportError:
+    rasterio = None
+
+
+BACKENDS = ['arcpy', 'numpy']
+
+INT_NODATA = -1
+FLOAT_NODATA = -9999.0
+
+# Where clauses as the config writes them, e.g. VALUE > 300 or "GRIDCODE" IN(1,2)
+WHERE_COMPARE = re.compile(r'^\s*"?(\w+)"?\s*(>=|<=|<>|!=|=|>|<)\s*(-?[\d.]+)\s*$')
+WHERE_IN = re.compile(r'^\s*"?(\w+)"?\s+IN\s*\(([^)]*)\)\s*$', re.IGNORECASE)
+
+ZONAL_FIELDS = ['VALUE', 'COUNT', 'AREA', 'MIN', 'MAX', 'RANGE', 'MEAN', 'STD', 'SUM']
+
+
+class BackendError(Exception):
+    pass
+
+
+def parse_where(clause):
+    # Field name and a test to apply to an array of its values
+    match = WHERE_COMPARE.match(str(clause))
+    if match:
+        field, op, value = match.group(1), match.group(2), float(match.group(3))
+        tests = {
+            '>': lambda v: v > value,
+            '>=': lambda v: v >= value,
+            '<': lambda v: v < value,
+            '<=': lambda v: v <= value,
+            '=': lambda v: v == value,
+            '<>': lambda v: v != value,
+            '!=': lambda v: v != value
+        }
+        return field.upper(), tests[op]
+
+    match = WHERE_IN.match(str(clause))
+    if match:
+        values = [float(v) for v in match.group(2).split(',') if v.strip()]
+        return match.group(1).upper(), lambda v: np.in1d(v, values).reshape(np.shape(v))
+
+    raise BackendError('Cannot read where clause '+str(clause))
+
+
+def load_backend(config):
+    name = config.get('backend', 'arcpy') or 'arcpy'
+
+    if name == 'arcpy':
+        return ArcpyBackend()
+    if name == 'numpy':
+        return NumpyBackend()
+
+    raise BackendError('Unknown backend '+str(name)+', use one of '+', '.join(BACKENDS))
+
+
+def release_extensions():
+    # Nothing to check in if no stage ever loaded arcpy
+    if arcpy.loaded():
+        arcpy.CheckInExtension("Spatial")
+
+
+class ArcpyBackend:
+    'Stages run with ArcGIS geoprocessing tools'
+
+    name = 'arcpy'
+
+    # Value rasters are resampled to the zone cell size before zonal stats
+    native_zonal = False
+
+    # Environment
+
+    def setup(self, scratch_path, projection_code):
+        arcpy.env.scratchWorkspace = scratch_path
+
+        sr = arcpy.SpatialReference(projection_code)
+        arcpy.env.outputCoordinateSystem = sr
+
+        # Load in Spatial Analyst Toolbox
+        arcpy.CheckOutExtension("Spatial")
+
+    def set_workspace(self, path):
+        arcpy.env.workspace = path
+
+    def overwrite_outputs(self):
+        arcpy.env.overwriteOutput = True
+
+    def exists(self, path):
+        return arcpy.Exists(path)
+
+    def hold(self, path):
+        # Written to the in_memory workspace rather than to disk
+        return 'in_memory\\' + os.path.splitext(os.path.basename(path))[0]
+
+    # Hydrology
+
+    def fill(self, dem, out_path):
+        sa.Fill(dem, "").save(out_path)
+        return out_path
+
+    def flow_direction(self, dem, force_flow, out_path):
+        sa.FlowDirection(dem, force_flow).save(out_path)
+        return out_path
+
+    def flow_accumulation(self, flow_dir, weight_raster, data_type, out_path, workers = None):
+        # ArcGIS schedules FlowAccumulation itself, workers is not used
+        sa.FlowAccumulation(flow_dir, weight_raster, data_type).save(out_path)
+        return out_path
+
+    def con(self, raster, where, false_constant, out_path):
+        sa.Con(raster, raster, false_constant, where).save(out_path)
+        return out_path
+
+    def set_null(self, raster, false_value, where, out_path):
+        sa.SetNull(raster, false_value, where).save(out_path)
+        return out_path
+
+    def stream_order(self, streams, flow_dir, method, out_path):
+        sa.StreamOrder(streams, flow_dir, method).save(out_path)
+        return out_path
+
+    def stream_to_feature(self, stream_order, flow_dir, out_path):
+        sa.StreamToFeature(stream_order, flow_dir, out_path)
+        return out_path
+
+    def extract_by_attributes(self, raster, where, out_path):
+        sa.ExtractByAttributes(raster, where).save(out_path)
+        return out_path
+
+    def snap_pour_point(self, points, flow_acc, distance, field, out_path):
+        sa.SnapPourPoint(points, flow_acc, distance, field).save(out_path)
+        return out_path
+
+    def watershed(self, flow_dir, pour_raster, out_path):
+        sa.Watershed(flow_dir, pour_raster, "VALUE").save(out_path)
+        return out_path
+
+    def point_to_raster(self, points, field, out_path, cell_size):
+        arcpy.PointToRaster_conversion(points, field, out_path, 'MOST_FREQUENT', '', str(cell_size))
+        return out_path
+
+    # Rasters
+
+    def combine_rasters(self, paths, out_path, mean):
+        raster_sum = sum([sa.Raster(p) for p in paths])
+        if mean:
+            raster_sum = raster_sum / len(paths)
+        raster_sum.save(out_path)
+        return out_path
+
+    def clip(self, raster, out_path, extent):
+        # extent is a template raster or (xmin, ymin, xmax, ymax)
+        if isinstance(extent, (list, tuple)):
+            arcpy.Clip_management(raster, ' '.join(map(str, extent)), out_path)
+        else:
+            arcpy.Clip_management(raster, '#', out_path, extent)
+        return out_path
+
+    def cell_size(self, raster):
+        x = arcpy.GetRasterProperties_management(raster, "CELLSIZEX")
+        y = arcpy.GetRasterProperties_management(raster, "CELLSIZEY")
+        return float(x.getOutput(0)), float(y.getOutput(0))
+
+    def resample(self, raster, out_path, cell_size, method):
+        arcpy.Resample_management(raster, out_path, cell_size, method)
+        return out_path
+
+    def aggregate(self, raster, out_path, factor):
+        sa.Aggregate(raster, factor, "MEAN", "TRUNCATE", "DATA").save(out_path)
+        return out_path
+
+    def zonal_statistics(self, zones, values, table_path):
+        sa.ZonalStatisticsAsTable(zones, "VALUE", values, table_path, "DATA")
+        return table_path
+
+    def zone_footprints(self, zones):
+        # Footprint hash of each zone, see catchment_memo
+        desc = arcpy.Describe(zones)
+        labels = arcpy.RasterToNumPyArray(zones, nodata_to_value=-1).astype(float)
+        labels[labels < 0] = np.nan
+        georef = str((desc.extent.XMin, desc.extent.YMax, desc.meanCellWidth, desc.meanCellHeight, labels.shape))
+        return catchment_memo.footprint_hashes(labels, georef)
+
+    def export_raster(self, raster, out_path):
+        arcpy.CopyRaster_management(raster, out_path)
+        return out_path
+
+    # Features and tables
+
+    def search_rows(self, path, fields):
+        # SHAPE@EXTENT gives (xmin, ymin, xmax, ymax)
+        cursor_fields = ['SHAPE@' if f == 'SHAPE@EXTENT' else f for f in fields]
+        with arcpy.da.SearchCursor(path, cursor_fields) as cursor:
+            for row in cursor:
+                values = []
+                for f, v in zip(fields, row):
+                    if f == 'SHAPE@EXTENT':
+                        v = (v.extent.XMin, v.extent.YMin, v.extent.XMax, v.extent.YMax)
+                    values.append(v)
+                yield tuple(values)
+
+    def field_names(self, path):
+        return [field.name for field in arcpy.ListFields(path)]
+
+    def add_field(self, path, name, field_type):
+        arcpy.AddField_management(path, name, field_type)
+
+    def calculate_area(self, path, name, field_type):
+        arcpy.AddField_management(path, name, field_type)
+        arcpy.CalculateField_management(path, name, '!SHAPE.AREA@SQUAREMETERS!', "PYTHON_9.3")
+
+    def update_rows(self, path, key_field, fields, values):
+        # values maps key field values to new values for fields
+        with arcpy.da.UpdateCursor(path, [key_field] + list(fields)) as cursor:
+            for row in cursor:
+                if row[0] in values:
+                    cursor.updateRow([row[0]] + list(values[row[0]]))
+
+    def delete_rows(self, path, field, values):
+        with arcpy.da.UpdateCursor(path, [field]) as cursor:
+            for row in cursor:
+                if row[0] in values:
+                    cursor.deleteRow()
+
+    def copy_features(self, source, out_path):
+        arcpy.CopyFeatures_management(source, out_path)
+        return out_path
+
+    def select(self, source, out_path, where):
+        arcpy.Select_analysis(source, out_path, where)
+        return out_path
+
+    def intersect(self, features, out_path, cluster_tolerance = "", output_type = "INPUT"):
+        arcpy.Intersect_analysis(features, out_path, "ALL", cluster_tolerance, output_type)
+        return out_path
+
+    def multipart_to_singlepart(self, source, out_path):
+        arcpy.MultipartToSinglepart_management(source, out_path)
+        return out_path
+
+    def extract_values_to_points(self, points, raster, out_path):
+        sa.ExtractValuesToPoints(points, raster, out_path, "INTERPOLATE", "ALL")
+        return out_path
+
+    def raster_to_polygon(self, raster, out_path):
+        arcpy.RasterToPolygon_conversion(raster, out_path, "NO_SIMPLIFY", 'VALUE')
+        return out_path
+
+    def create_routes(self, lines, route_field, out_path):
+        arcpy.CreateRoutes_lr(lines, route_field, out_path, "LENGTH")
+        return out_path
+
+    def locate_features_along_routes(self, points, routes, route_field, search_radius, out_table):
+        arcpy.LocateFeaturesAlongRoutes_lr(points, routes, route_field, search_radius, out_table, "RID POINT MEAS")
+        return out_table
+
+    def route_events(self, table):
+        # [event id, route id, measure] for each located feature
+        ic_cursor = arcpy.SearchCursor(table)
+        fieldnames = self.field_names(table)
+        events = []
+        for row in ic_cursor:
+            events.append([row.getValue('OID'), row.getValue(fieldnames[4]), row.getValue('MEAS')])
+        del ic_cursor
+
+        return events
+
+
+class RasterGrid:
+    'Georeferencing of a raster: transform, CRS and shape'
+
+    def __init__(self, transform, crs, shape):
+        self.transform = transform
+        self.crs = crs
+        self.shape = shape
+
+    def cell_size(self):
+        return abs(self.transform.a), abs(self.transform.e)
+
+    def bounds(self):
+        t = self.transform
+        rows, cols = self.shape
+        xs = [t.c, t.c + cols * t.a]
+        ys = [t.f, t.f + rows * t.e]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def cells(self, x, y):
+        # Row and column of the cells holding each point, may be off the grid
+        t = self.transform
+        cols = np.floor((np.asarray(x, dtype=float) - t.c) / t.a).astype(np.int64)
+        rows = np.floor((np.asarray(y, dtype=float) - t.f) / t.e).astype(np.int64)
+        return rows, cols
+
+    def centres(self, rows, cols):
+        t = self.transform
+        return t.c + (np.asarray(cols) + 0.5) * t.a, t.f + (np.asarray(rows) + 0.5) * t.e
+
+    def inside(self, rows, cols):
+        return (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+
+    def window(self, extent):
+        # Row and column ranges covering (xmin, ymin, xmax, ymax)
+        xmin, ymin, xmax, ymax = extent
+        t = self.transform
+        c0 = int(math.floor((xmin - t.c) / abs(t.a) + 1e-9))
+        c1 = int(math.ceil((xmax - t.c) / abs(t.a) - 1e-9))
+        r0 = int(math.floor((t.f - ymax) / abs(t.e) + 1e-9))
+        r1 = int(math.ceil((t.f - ymin) / abs(t.e) - 1e-9))
+
+        r0, r1 = max(r0, 0), min(r1, self.shape[0])
+        c0, c1 = max(c0, 0), min(c1, self.shape[1])
+        if r0 >= r1 or c0 >= c1:
+            raise BackendError('Extent '+str(extent)+' does not overlap the raster')
+
+        return r0, r1, c0, c1
+
+    def subgrid(self, r0, r1, c0, c1):
+        t = self.transform
+        transform = t * t.translation(c0, r0)
+        return RasterGrid(transform, self.crs, (r1 - r0, c1 - c0))
+
+
+class NumpyBackend:
+    'Stages run with NumPy, rasterio, fiona and shapely'
+
+    name = 'numpy'
+
+    # Zonal stats read value rasters at their own resolution
+    native_zonal = True
+
+    def __init__(self):
+        if rasterio is None:
+            raise BackendError('The numpy backend needs rasterio, fiona and shapely')
+
+        self.crs = None
+        self.workspace = None
+        # Outputs kept in memory by path, None until a stage writes them
+        self.held = {}
+
+    # Environment
+
+    def setup(self, scratch_path, projection_code):
+        self.crs = 'EPSG:' + str(projection_code)
+
+    def set_workspace(self, path):
+        self.workspace = path
+
+    def overwrite_outputs(self):
+        # Outputs are always overwritten
+        pass
+
+    def exists(self, path):
+        return self.held.get(path) is not None or os.path.exists(path)
+
+    def hold(self, path):
+        # Keep this output in memory instead of writing it
+        self.held[path] = None
+        return path
+
+    # Raster I/O
+
+    def raster_info(self, path):
+        # Grid, stored dtype and nodata without reading any values
+        if self.held.get(path) is not None:
+            values, grid, nodata = self.held[path]
+            return grid, values.dtype, nodata
+
+        if raster_store.is_stored(path):
+            meta = raster_store.read_meta(path)
+            grid = RasterGrid(rasterio.transform.Affine(*meta['transform']), meta['crs'] or self.crs,
+                              tuple(meta['shape']))
+            return grid, np.dtype(str(meta['dtype'])), meta['nodata']
+
+        with rasterio.open(path) as src:
+            grid = RasterGrid(src.transform, src.crs or self.crs, src.shape)
+            return grid, np.dtype(src.dtypes[0]), src.nodata
+
+    def open_raster(self, path):
+        # Values as stored, with their grid and nodata. Raw intermediates come
+        # back as a read-only memmap rather than a copy
+        if self.held.get(path) is not None:
+            return self.held[path]
+
+        if raster_store.is_raw(path):
+            values, meta = raster_store.open_raw(path)
+            return values, self.raster_info(path)[0], meta['nodata']
+
+        if raster_store.is_chunked(path):
+            store = raster_store.ChunkedRaster(path)
+            return store.read(), self.raster_info(path)[0], store.nodata
+
+        with rasterio.open(path) as src:
+            grid = RasterGrid(src.transform, src.crs or self.crs, src.shape)
+            return src.read(1), grid, src.nodata
+
+    def read_raster(self, path):
+        # Values as floats with NaN for nodata
+        values, grid, nodata = self.open_raster(path)
+
+        return float_values(values, nodata), grid
+
+    def read_window(self, path, extent):
+        # As read_raster for the cells covering (xmin, ymin, xmax, ymax).
+        # GeoTIFFs and chunked stores only read that window
+        grid, dtype, nodata = self.raster_info(path)
+        r0, r1, c0, c1 = grid.window(extent)
+
+        if self.held.get(path) is None and raster_store.is_chunked(path):
+            values = raster_store.ChunkedRaster(path).read(r0, r1, c0, c1)
+        elif self.held.get(path) is None and not raster_store.is_raw(path):
+            with rasterio.open(path) as src:
+                values = src.read(1, window=((r0, r1), (c0, c1)))
+        else:
+            values = self.open_raster(path)[0][r0:r1, c0:c1]
+
+        return float_values(values, nodata), grid.subgrid(r0, r1, c0, c1)
+
+    def write_raster(self, path, values, grid, dtype = 'float32'):
+        integer = np.dtype(dtype).kind in 'iu'
+        nodata = INT_NODATA if integer else FLOAT_NODATA
+        values = np.where(np.isfinite(values), values, nodata).astype(dtype)
+
+        if path in self.held:
+            self.held[path] = (values, grid, nodata)
+            return path
+
+        if raster_store.is_raw(path):
+            return raster_store.write_raw(path, values, grid.transform, grid.crs, nodata)
+        if raster_store.is_chunked(path):
+            return raster_store.write_chunked(path, values, grid.transform, grid.crs, nodata)
+
+        profile = {
+            'driver': 'GTiff',
+            'height': grid.shape[0],
+            'width': grid.shape[1],
+            'count': 1,
+            'dtype': dtype,
+            'crs': grid.crs,
+            'transform': grid.transform,
+            'nodata': nodata
+        }
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(values, 1)
+
+        return path
+
+    def export_raster(self, raster, out_path):
+        # GeoTIFF copy of a raw or chunked intermediate
+        values, grid, nodata = self.open_raster(raster)
+        profile = {
+            'driver': 'GTiff',
+            'height': grid.shape[0],
+            'width': grid.shape[1],
+            'count': 1,
+            'dtype': values.dtype.name,
+            'crs': grid.crs,
+            'transform': grid.transform,
+            'nodata': nodata
+        }
+        with rasterio.open(out_path, 'w', **profile) as dst:
+            dst.write(np.asarray(values), 1)
+
+        return out_path
+
+    def flow_receivers(self, flow_dir):
+        # Receiver of each cell and which cells have a direction, read
+        # straight from the stored codes
+        codes, grid, nodata = self.open_raster(flow_dir)
+        valid = codes != nodata if nodata is not None else np.ones(codes.shape, dtype=bool)
+
+        return flow_grid.receivers(codes, valid), valid.ravel(), grid
+
+    def sample_raster(self, path, grid):
+        # Values of a raster at the cell centres of another grid, nearest cell
+        values, source = self.read_raster(path)
+        if source.shape == grid.shape and source.transform == grid.transform:
+            return values
+
+        rows, cols = np.indices(grid.shape)
+        x, y = grid.centres(rows, cols)
+        r, c = source.cells(x, y)
+        inside = source.inside(r, c)
+        sampled = np.zeros(grid.shape) + np.nan
+        sampled[inside] = values[r[inside], c[inside]]
+
+        return sampled
+
+    # Hydrology
+
+    def fill(self, dem, out_path):
+        values, grid = self.read_raster(dem)
+        return self.write_raster(out_path, flow_grid.fill_depressions(values), grid)
+
+    def flow_direction(self, dem, force_flow, out_path):
+        values, grid = self.read_raster(dem)
+        codes = flow_grid.flow_directions(values, str(force_flow).upper() == 'FORCE')
+        codes = np.where(np.isfinite(values), codes, np.nan)
+        return self.write_raster(out_path, codes, grid, 'int32')
+
+    def flow_accumulation(self, flow_dir, weight_raster, data_type, out_path, workers = None):
+        # More than one worker splits the grid into tiles, see flow_tiles
+        receiver, valid, grid = self.flow_receivers(flow_dir)
+
+        weights = None
+        if weight_raster:
+            weights = self.sample_raster(weight_raster, grid).ravel()
+
+        if workers and workers > 1:
+            totals = flow_tiles.accumulate_tiled(receiver, valid, grid.shape, weights, workers)
+        else:
+            order, bounds = flow_grid.flow_levels(receiver, valid)
+            totals = flow_grid.accumulate(receiver, order, bounds, weights)
+        totals = totals.reshape(grid.shape)
+        totals = np.where(valid.reshape(grid.shape), totals, np.nan)
+        dtype = 'int32' if str(data_type).upper() == 'INTEGER' else 'float32'
+        return self.write_raster(out_path, totals, grid, dtype)
+
+    def con(self, raster, where, false_constant, out_path):
+        values, grid = self.read_raster(raster)
+        field, test = parse_where(where)
+        with np.errstate(invalid='ignore'):
+            result = np.where(test(values), values, float(false_constant))
+        result[np.isnan(values)] = np.nan
+        return self.write_raster(out_path, result, grid, self.raster_dtype(raster))
+
+    def set_null(self, raster, false_value, where, out_path):
+        values, grid = self.read_raster(raster)
+        field, test = parse_where(where)
+        with np.errstate(invalid='ignore'):
+            result = np.where(test(values) | np.isnan(values), np.nan, float(false_value))
+        return self.write_raster(out_path, result, grid, 'int32')
+
+    def stream_order(self, streams, flow_dir, method, out_path):
+        receiver, valid, grid = self.flow_receivers(flow_dir)
+        stream_cells = np.isfinite(self.sample_raster(streams, grid)).ravel()
+        orders = flow_grid.stream_order(receiver, stream_cells, str(method))
+        orders = np.where(stream_cells, orders, np.nan).reshape(grid.shape)
+        return self.write_raster(out_path, orders, grid, 'int32')
+
+    def stream_to_feature(self, stream_order, flow_dir, out_path):
+        receiver, valid, grid = self.flow_receivers(flow_dir)
+        orders = self.sample_raster(stream_order, grid).ravel()
+        stream_cells = np.isfinite(orders)
+        links = flow_grid.stream_links(receiver, stream_cells, np.where(stream_cells, orders, 0))
+
+        schema = {'geometry': 'LineString', 'properties': {'ARCID': 'int', 'GRID_CODE': 'int'}}
+        features = []
+        for i, (path, order) in enumerate(links):
+            rows, cols = np.divmod(np.array(path), grid.shape[1])
+            x, y = grid.centres(rows, cols)
+            features.append((geometry.LineString(list(zip(x.tolist(), y.tolist()))),
+                             {'ARCID': i + 1, 'GRID_CODE': order}))
+
+        self.write_features(out_path, schema, grid.crs, features)
+        return out_path
+
+    def extract_by_attributes(self, raster, where, out_path):
+        values, grid = self.read_raster(raster)
+        field, test = parse_where(where)
+        with np.errstate(invalid='ignore'):
+            result = np.where(test(values), values, np.nan)
+        return self.write_raster(out_path, result, grid, self.raster_dtype(raster))
+
+    def snap_pour_point(self, points, flow_acc, distance, field, out_path):
+        accumulation, grid = self.read_raster(flow_acc)
+        ids, xs, ys = self.point_values(points, field)
+        rows, cols = grid.cells(xs, ys)
+        keep = grid.inside(rows, cols)
+
+        radius = float(distance) / grid.cell_size()[0]
+        rows, cols = flow_grid.snap_points(accumulation, rows[keep], cols[keep], radius)
+
+        labels = np.zeros(grid.shape) + np.nan
+        labels[rows, cols] = np.array(ids, dtype=float)[keep]
+        return self.write_raster(out_path, labels, grid, 'int32')
+
+    def watershed(self, flow_dir, pour_raster, out_path):
+        receiver, valid, grid = self.flow_receivers(flow_dir)
+        pour = self.sample_raster(pour_raster, grid).ravel()
+        labels = np.where(np.isfinite(pour), pour, -1).astype(np.int64)
+        labels = flow_grid.label_watersheds(receiver, labels)
+        labels = np.where(labels >= 0, labels, np.nan).reshape(grid.shape)
+        return self.write_raster(out_path, labels, grid, 'int32')
+
+    def point_to_raster(self, points, field, out_path, cell_size):
+        ids, xs, ys = self.point_values(points, field)
+        cell_size = float(cell_size)
+        x0 = math.floor(min(xs) / cell_size) * cell_size
+        y1 = math.ceil(max(ys) / cell_size) * cell_size
+        shape = (int((y1 - min(ys)) // cell_size) + 1, int((max(xs) - x0) // cell_size) + 1)
+        grid = RasterGrid(rasterio.transform.from_origin(x0, y1, cell_size, cell_size), self.crs, shape)
+
+        rows, cols = grid.cells(xs, ys)
+        labels = np.zeros(shape) + np.nan
+        labels[rows, cols] = ids
+        return self.write_raster(out_path, labels, grid, 'int32')
+
+    # Rasters
+
+    def raster_dtype(self, path):
+        dtype = self.raster_info(path)[1]
+        return 'int32' if dtype.kind in 'iu' else 'float32'
+
+    def combine_rasters(self, paths, out_path, mean):
+        total = None
+        grid = None
+        for p in paths:
+            values, g = self.read_raster(p)
+            if total is None:
+                total, grid = values, g
+            elif values.shape != total.shape:
+                raise BackendError(p+' is not on the same grid as '+paths[0])
+            else:
+                total = total + values
+
+        if mean:
+            total = total / len(paths)
+        return self.write_raster(out_path, total, grid)
+
+    def clip(self, raster, out_path, extent):
+        if not isinstance(extent, (list, tuple)):
+            extent = self.raster_info(extent)[0].bounds()
+
+        values, grid = self.read_window(raster, extent)
+        return self.write_raster(out_path, values, grid, self.raster_dtype(raster))
+
+    def cell_size(self, raster):
+        return self.raster_info(raster)[0].cell_size()
+
+    def burn_features(self, path, grid):
+        # Cells of a grid touched by any feature, as a boolean array
+        shapes = [geom for fid, geom, props in self.read_features(path)[2] if geom is not None]
+        if not shapes:
+            return np.zeros(grid.shape, dtype=bool)
+
+        burnt = raster_features.rasterize([(g, 1) for g in shapes], out_shape=grid.shape,
+                                          transform=grid.transform, fill=0, all_touched=True, dtype='uint8')
+        return burnt.astype(bool)
+
+    def resample(self, raster, out_path, cell_size, method):
+        if str(method).upper() != 'NEAREST':
+            raise BackendError('The numpy backend only resamples with NEAREST')
+
+        values, grid = self.read_raster(raster)
+        xmin, ymin, xmax, ymax = grid.bounds()
+        cell_size = float(cell_size)
+        shape = (max(int(round((ymax - ymin) / cell_size)), 1), max(int(round((xmax - xmin) / cell_size)), 1))
+        target = RasterGrid(rasterio.transform.from_origin(xmin, ymax, cell_size, cell_size), grid.crs, shape)
+
+        rows, cols = np.indices(shape)
+        x, y = target.centres(rows, cols)
+        r, c = grid.cells(x, y)
+        r = np.clip(r, 0, grid.shape[0] - 1)
+        c = np.clip(c, 0, grid.shape[1] - 1)
+        return self.write_raster(out_path, values[r, c], target, self.raster_dtype(raster))
+
+    def aggregate(self, raster, out_path, factor):
+        # Mean of each factor x factor block ignoring nodata, partial blocks
+        # at the edges are dropped (Aggregate MEAN, TRUNCATE, DATA)
+        values, grid = self.read_raster(raster)
+        factor = int(factor)
+        rows, cols = values.shape[0] // factor, values.shape[1] // factor
+        if not rows or not cols:
+            raise BackendError(raster+' is smaller than one '+str(factor)+' cell block')
+
+        blocks = values[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor)
+        count = np.isfinite(blocks).sum(axis=(1, 3))
+        total = np.where(np.isfinite(blocks), blocks, 0).sum(axis=(1, 3))
+        mean = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+        transform = grid.transform * grid.transform.scale(factor, factor)
+        return self.write_raster(out_path, mean, RasterGrid(transform, grid.crs, mean.shape))
+
+    def zone_coverage(self, zones, source):
+        # Zone, flat cell of the source grid and the number of zone cells
+        # with their centres in it, for each pair, sorted by zone
+        labels, grid = self.read_raster(zones)
+        rows, cols = np.nonzero(np.isfinite(labels))
+        zone = labels[rows, cols].astype(np.int64)
+        if source.shape != grid.shape or source.transform != grid.transform:
+            rows, cols = source.cells(*grid.centres(rows, cols))
+            inside = source.inside(rows, cols)
+            zone, rows, cols = zone[inside], rows[inside], cols[inside]
+
+        size = source.shape[0] * source.shape[1]
+        pairs, coverage = np.unique(zone * size + rows * source.shape[1] + cols, return_counts=True)
+        zone, cell = np.divmod(pairs, size)
+
+        return zone, cell, coverage
+
+    def zone_footprints(self, zones):
+        # Footprint hash of each zone, see catchment_memo
+        labels, grid = self.read_raster(zones)
+        georef = str((tuple(grid.transform)[:6], tuple(grid.shape)))
+        return catchment_memo.footprint_hashes(labels, georef)
+
+    def zonal_statistics(self, zones, values, table_path):
+        # Values are read at their own resolution, each value cell weighted by
+        # how many zone cells of a zone have their centres in it
+        data, source = self.read_raster(values)
+        zone, cell, coverage = self.zone_coverage(zones, source)
+        data = data.ravel()[cell]
+        use = np.isfinite(data)
+        zone, data, coverage = zone[use], data[use], coverage[use]
+
+        keys, inverse = np.unique(zone, return_inverse=True)
+        count = np.bincount(inverse, weights=coverage, minlength=len(keys)).astype(np.int64)
+        total = np.bincount(inverse, weights=coverage * data, minlength=len(keys))
+        mean = total / np.maximum(count, 1)
+        spread = np.bincount(inverse, weights=coverage * (data - mean[inverse]) ** 2, minlength=len(keys))
+
+        # Pairs are sorted by zone already
+        starts = np.concatenate([[0], np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]]).astype(np.int64)
+        lowest = np.minimum.reduceat(data, starts) if len(keys) else np.array([])
+        highest = np.maximum.reduceat(data, starts) if len(keys) else np.array([])
+
+        cell_x, cell_y = self.raster_info(zones)[0].cell_size()
+        table_path = os.path.splitext(table_path)[0] + '.csv'
+        columns = [keys, count, count * cell_x * cell_y, lowest, highest, highest - lowest,
+                   mean, np.sqrt(spread / np.maximum(count, 1)), total]
+        self.write_table(table_path, ZONAL_FIELDS, zip(*[c.tolist() for c in columns]))
+
+        return table_path
+
+    # Features and tables
+
+    def read_features(self, path):
+        # Schema, CRS and (fid, shapely geometry, properties) for each feature
+        if self.held.get(path) is not None:
+            schema, crs, features = self.held[path]
+            return ({'geometry': schema['geometry'], 'properties': schema['properties'].copy()}, crs,
+                    [(fid, geom, dict(props)) for fid, geom, props in features])
+
+        with fiona.open(path) as src:
+            schema = {'geometry': src.schema['geometry'], 'properties': src.schema['properties'].copy()}
+            crs = src.crs
+            features = [(int(f['id']), geometry.shape(f['geometry']) if f['geometry'] else None,
+                         dict(f['properties'])) for f in src]
+
+        return schema, crs, features
+
+    def write_features(self, path, schema, crs, features):
+        if path in self.held:
+            self.held[path] = (schema, crs or self.crs,
+                               [(i, geom, props) for i, (geom, props) in enumerate(features)])
+            return path
+
+        if os.path.exists(path):
+            fiona.remove(path, driver='ESRI Shapefile')
+
+        with fiona.open(path, 'w', driver='ESRI Shapefile', schema=schema, crs=crs or self.crs) as dst:
+            for geom, properties in features:
+                dst.write({'geometry': geometry.mapping(geom), 'properties': properties})
+
+        return path
+
+    def write_table(self, path, fields, rows):
+        with open(path, 'w') as table:
+            a = csv.writer(table, delimiter=',', lineterminator='\n')
+            a.writerow(fields)
+            for r in rows:
+                a.writerow(r)
+
+        return path
+
+    def read_table(self, path):
+        with open(path) as table:
+            reader = csv.reader(table, delimiter=',')
+            fields = next(reader)
+            rows = [[table_value(v) for v in r] for r in reader]
+
+        return fields, rows
+
+    def point_values(self, points, field):
+        # Values of a field (or the FID) and coordinates of each point
+        schema, crs, features = self.read_features(points)
+        ids = [fid if field.upper() == 'FID' else props[field] for fid, geom, props in features]
+        xs = [geom.x for fid, geom, props in features]
+        ys = [geom.y for fid, geom, props in features]
+
+        return ids, xs, ys
+
+    def search_rows(self, path, fields):
+        if path.endswith('.csv'):
+            names, rows = self.read_table(path)
+            index = [[n.upper() for n in names].index(f.upper()) for f in fields]
+            for r in rows:
+                yield tuple(r[i] for i in index)
+            return
+
+        schema, crs, features = self.read_features(path)
+        for fid, geom, props in features:
+            upper = dict((k.upper(), v) for k, v in props.items())
+            values = []
+            for f in fields:
+                if f == 'SHAPE@EXTENT':
+                    values.append(tuple(geom.bounds))
+                elif f.upper() in ('FID', 'OID', 'OID@'):
+                    values.append(fid)
+                else:
+                    values.append(upper[f.upper()])
+            yield tuple(values)
+
+    def field_names(self, path):
+        # Laid out as ListFields gives them for a shapefile
+        if path.endswith('.csv'):
+            return self.read_table(path)[0]
+        if self.held.get(path) is not None:
+            return ['FID', 'Shape'] + list(self.held[path][0]['properties'].keys())
+
+        with fiona.open(path) as src:
+            return ['FID', 'Shape'] + list(src.schema['properties'].keys())
+
+    def add_field(self, path, name, field_type):
+        types = {'LONG': 'int', 'SHORT': 'int', 'FLOAT': 'float', 'DOUBLE': 'float', 'TEXT': 'str'}
+        schema, crs, features = self.read_features(path)
+        schema['properties'][name] = types[field_type.upper()]
+        self.write_features(path, schema, crs, [(g, dict(p, **{name: None})) for fid, g, p in features])
+
+    def calculate_area(self, path, name, field_type):
+        self.add_field(path, name, field_type)
+        schema, crs, features = self.read_features(path)
+        cast = str if schema['properties'][name].startswith('str') else type_cast(field_type)
+        self.write_features(path, schema, crs, [(g, dict(p, **{name: cast(g.area)})) for fid, g, p in features])
+
+    def update_rows(self, path, key_field, fields, values):
+        schema, crs, features = self.read_features(path)
+        updated = []
+        for fid, g, props in features:
+            key = fid if key_field.upper() == 'FID' else props[key_field]
+            if key in values:
+                props = dict(props)
+                props.update(zip(fields, values[key]))
+            updated.append((g, props))
+
+        self.write_features(path, schema, crs, updated)
+
+    def delete_rows(self, path, field, values):
+        values = set(values)
+        schema, crs, features = self.read_features(path)
+        keep = [(g, p) for fid, g, p in features
+                if (fid if field.upper() == 'FID' else p[field]) not in values]
+
+        self.write_features(path, schema, crs, keep)
+
+    def copy_features(self, source, out_path):
+        schema, crs, features = self.read_features(source)
+        return self.write_features(out_path, schema, crs, [(g, p) for fid, g, p in features])
+
+    def select(self, source, out_path, where):
+        field, test = parse_where(where)
+        schema, crs, features = self.read_features(source)
+        values = np.array([dict((k.upper(), v) for k, v in p.items())[field] for fid, g, p in features], dtype=float)
+        chosen = test(values) if len(values) else []
+
+        return self.write_features(out_path, schema, crs,
+                                   [(g, p) for (fid, g, p), ok in zip(features, chosen) if ok])
+
+    def intersect(self, features, out_path, cluster_tolerance = "", output_type = "INPUT"):
+        # Two layers, with FID_<name> and the fields of both as Intersect ALL
+        (a_path, b_path) = features
+        a_schema, crs, a_features = self.read_features(a_path)
+        b_schema, b_crs, b_features = self.read_features(b_path)
+        points = str(output_type).lower() == 'point'
+
+        properties = []
+        names = []
+        for path, schema in [(a_path, a_schema), (b_path, b_schema)]:
+            fid_name = ('FID_' + os.path.splitext(os.path.basename(path))[0])[:10]
+            fields = [(fid_name, 'int')] + list(schema['properties'].items())
+            renamed = []
+            for name, field_type in fields:
+                out_name = name
+                if out_name in names:
+                    out_name = name[:8] + '_1'
+                names.append(out_name)
+                renamed.append(out_name)
+            properties.append((fields, renamed))
+
+        kind = 'Point' if points else a_schema['geometry'].replace('Multi', '')
+        out_fields = collections.OrderedDict()
+        for fields, renamed in properties:
+            for (name, field_type), out_name in zip(fields, renamed):
+                out_fields[out_name] = field_type
+        schema = {'geometry': 'MultiPoint' if points else kind, 'properties': out_fields}
+
+        b_bounds = np.array([g.bounds for fid, g, p in b_features]).reshape(-1, 4)
+        out = []
+        for a_fid, a_geom, a_props in a_features:
+            xmin, ymin, xmax, ymax = a_geom.bounds
+            near = np.flatnonzero((b_bounds[:, 0] <= xmax) & (b_bounds[:, 2] >= xmin) &
+                                  (b_bounds[:, 1] <= ymax) & (b_bounds[:, 3] >= ymin))
+            for j in near.tolist():
+                b_fid, b_geom, b_props = b_features[j]
+                shared = a_geom.intersection(b_geom)
+                parts = geometry_parts(shared, kind)
+                if not parts:
+                    continue
+                if points:
+                    shared = geometry.MultiPoint(parts)
+                elif len(parts) == 1:
+                    shared = parts[0]
+                elif kind == 'Polygon':
+                    shared = geometry.MultiPolygon(parts)
+                else:
+                    shared = geometry.MultiLineString(parts)
+                values = {}
+                for (fields, renamed), fid, props in [(properties[0], a_fid, a_props), (properties[1], b_fid, b_props)]:
+                    values[renamed[0]] = fid
+                    for (name, field_type), out_name in zip(fields[1:], renamed[1:]):
+                        values[out_name] = props[name]
+                out.append((shared, values))
+
+        return self.write_features(out_path, schema, crs, out)
+
+    def multipart_to_singlepart(self, source, out_path):
+        schema, crs, features = self.read_features(source)
+        schema['geometry'] = schema['geometry'].replace('Multi', '')
+        schema['properties']['ORIG_FID'] = 'int'
+        singles = []
+        for fid, g, p in features:
+            for part in geometry_parts(g):
+                singles.append((part, dict(p, ORIG_FID=fid)))
+
+        return self.write_features(out_path, schema, crs, singles)
+
+    def extract_values_to_points(self, points, raster, out_path):
+        # Bilinear values at each point, -9999 off the raster or on nodata
+        values, grid = self.read_raster(raster)
+        schema, crs, features = self.read_features(points)
+        t = grid.transform
+        x = np.array([g.x for fid, g, p in features])
+        y = np.array([g.y for fid, g, p in features])
+
+        # Position in cell centre coordinates
+        fc = (x - t.c) / t.a - 0.5
+        fr = (y - t.f) / t.e - 0.5
+        c0 = np.floor(fc).astype(np.int64)
+        r0 = np.floor(fr).astype(np.int64)
+        wc = fc - c0
+        wr = fr - r0
+        sampled = np.zeros(len(x))
+        for dr, dc, w in [(0, 0, (1 - wr) * (1 - wc)), (0, 1, (1 - wr) * wc),
+                          (1, 0, wr * (1 - wc)), (1, 1, wr * wc)]:
+            r = np.clip(r0 + dr, 0, grid.shape[0] - 1)
+            c = np.clip(c0 + dc, 0, grid.shape[1] - 1)
+            sampled += w * values[r, c]
+        r, c = grid.cells(x, y)
+        sampled = np.where(grid.inside(r, c) & np.isfinite(sampled), sampled, FLOAT_NODATA)
+
+        schema['properties']['RASTERVALU'] = 'float'
+        return self.write_features(out_path, schema, crs,
+                                   [(g, dict(p, RASTERVALU=float(v))) for (fid, g, p), v in zip(features, sampled)])
+
+    def raster_to_polygon(self, raster, out_path):
+        values, grid = self.read_raster(raster)
+        valid = np.isfinite(values)
+        labels = np.where(valid, values, 0).astype(np.int32)
+
+        schema = {'geometry': 'Polygon', 'properties': {'ID': 'int', 'GRIDCODE': 'int'}}
+        features = []
+        for i, (shape, value) in enumerate(raster_features.shapes(labels, mask=valid, transform=grid.transform)):
+            features.append((geometry.shape(shape), {'ID': i + 1, 'GRIDCODE': int(value)}))
+
+        return self.write_features(out_path, schema, grid.crs, features)
+
+    def create_routes(self, lines, route_field, out_path):
+        # Lines merged per route, measured by length from their start
+        schema, crs, features = self.read_features(lines)
+        routes = {}
+        for fid, g, p in features:
+            routes.setdefault(p[route_field], []).append(g)
+
+        out_schema = {'geometry': 'LineString', 'properties': {route_field: schema['properties'][route_field]}}
+        merged = [(ops.linemerge(parts), {route_field: key}) for key, parts in sorted(routes.items())]
+        if [g for g, p in merged if g.geom_type != 'LineString']:
+            out_schema['geometry'] = 'MultiLineString'
+            merged = [(g if g.geom_type != 'LineString' else geometry.MultiLineString([g]), p) for g, p in merged]
+
+        return self.write_features(out_path, out_schema, crs, merged)
+
+    def locate_features_along_routes(self, points, routes, route_field, search_radius, out_table):
+        p_schema, crs, p_features = self.read_features(points)
+        r_schema, r_crs, r_features = self.read_features(routes)
+        search_radius = float(search_radius)
+
+        events = []
+        for fid, point, props in p_features:
+            for r_fid, route, r_props in r_features:
+                distance = route.distance(point)
+                if distance <= search_radius:
+                    events.append([len(events), fid, r_props[route_field], route.project(point), distance])
+
+        table_path = os.path.splitext(out_table)[0] + '.csv'
+        return self.write_table(table_path, ['OID', 'INPUTOID', 'RID', 'MEAS', 'Distance'], events)
+
+    def route_events(self, table):
+        return [[r[0], r[2], r[3]] for r in self.read_table(table)[1]]
+
+
+def float_values(values, nodata):
+    # Copy as floats with NaN for nodata
+    values = values.astype(float)
+    if nodata is not None:
+        values[values == nodata] = np.nan
+
+    return values
+
+
+def geometry_parts(geom, kind = None):
+    # Single geometries in a possibly multi or mixed geometry
+    if geom is None or geom.is_empty:
+        return []
+    if hasattr(geom, 'geoms'):
+        parts = []
+        for g in geom.geoms:
+            parts.extend(geometry_parts(g, kind))
+        return parts
+    if kind is not None and geom.geom_type != kind:
+        return []
+
+    return [geom]
+
+
+def type_cast(field_type):
+    if field_type.upper() in ('LONG', 'SHORT'):
+        return lambda v: int(round(v))
+
+    return float
+
+
+def table_value(text):
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+
+    return text
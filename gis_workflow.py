@@ -9,19 +9,68 @@ import yaml
 import os
 from os.path import basename
 
-import arcpy
+import copy
 import datetime
+import errno
 import shutil
 import math
 import csv
+import functools
 import glob
-from arcpy import env
-from arcpy.sa import *
+import re
+import sys
+import numpy as np
 
 from cement.core import foundation, controller
 from cement.core.controller import expose
 from cement.utils import shell
 
+import bqart
+import catchment_memo
+import catchment_table
+import flow_grid
+import gis_backend
+import raster_store
+import run_catalogue
+import stream_sweep
+from job_scheduler import StageLimits, run_schedule
+from stage_graph import StageGraph, file_fingerprint
+from workflow_trace import StageTracer, traced
+
+
+# hydro_paths keys of the hydrology outputs, in the order they are made
+HYDRO_OUTPUTS = ['working_dem', 'flow_path', 'flow_acc_path', 'stream_net_path',
+                 'null_path', 's_ord_path', 'vector_streams']
+
+# Downsampling factors of the DEM pyramid used by preview runs
+PREVIEW_FACTORS = [4, 8, 16]
+
+# Catchment area quantiles reported by preview runs
+PREVIEW_QUANTILES = [0, 10, 25, 50, 75, 90, 100]
+
+# Catchment climate and elevation from zonal statistics over the watershed
+# raster, or looked up at each outlet from upstream aggregates
+CATCHMENT_STATS = ['zonal', 'upstream']
+
+# Upstream aggregate rasters kept for each value raster
+UPSTREAM_FIELDS = ['sum', 'sq', 'n', 'max', 'min']
+
+# Rows of the monthly climate stack read at a time
+MONTHLY_CHUNK_ROWS = 256
+
+# Flow accumulation thresholds (cells) tried by sweep runs
+SWEEP_THRESHOLDS = [50, 100, 200, 300, 500, 1000, 2000, 5000]
+
+# Run catalogue in the project root, see run_catalogue
+CATALOGUE_NAME = 'run_catalogue.sqlite'
+
+# Results in scenario comparison tables: bqart.scenario_columns key, name,
+# units and whether changes against the baseline are given
+COMPARE_COLUMNS = [('Qw_s', 'Qw', 'm^3/s', True),
+                   ('Qs_MT_yr', 'Qs', 'MT/y', False),
+                   ('Qs_m3_yr', 'Qs', 'm^3/yr', True),
+                   ('Qs_mm_yr', 'erosion', 'mm/yr', True)]
+
 class GISAppController(controller.CementBaseController):
     class Meta:
         label = 'base'
@@ -33,6 +82,34 @@ class GISAppController(controller.CementBaseController):
                       help='path to batch directory') ),
             ( ['-pp', '--pourpoints'], dict(action='store', dest='custom_pp',
                       help='custom pour points') ),
+            ( ['-s', '--spec'], dict(action='store', dest='spec',
+                      help='path to run spec file for unattended runs') ),
+            ( ['--headless'], dict(action='store_true', dest='headless',
+                      help='fail instead of prompting for missing answers') ),
+            ( ['--hydro-batch'], dict(action='store', dest='hydro_batch',
+                      help='hydro batch directory, batch name or latest') ),
+            ( ['--watershed-batch'], dict(action='store', dest='watershed_batch',
+                      help='watershed batch directory, batch name or latest') ),
+            ( ['--scenario'], dict(action='store', dest='scenarios',
+                      help='comma separated climate scenarios to run') ),
+            ( ['--cache'], dict(action='store', dest='cache', choices=['keep', 'clear'],
+                      help='climate cache policy') ),
+            ( ['-j', '--jobs'], dict(action='store', dest='jobs',
+                      help='path to schedule file listing project jobs') ),
+            ( ['-w', '--workers'], dict(action='store', dest='workers', type=int,
+                      help='number of worker processes for scheduled jobs') ),
+            ( ['--factors'], dict(action='store', dest='preview_factors',
+                      help='comma separated DEM downsampling factors for preview runs') ),
+            ( ['--thresholds'], dict(action='store', dest='sweep_thresholds',
+                      help='comma separated flow accumulation thresholds for sweep runs') ),
+            ( ['--masks'], dict(action='store', dest='sweep_masks',
+                      help='comma separated sweep thresholds to save stream masks for') ),
+            ( ['--kind'], dict(action='store', dest='run_kind', choices=run_catalogue.RUN_KINDS,
+                      help='only list batches of this kind') ),
+            ( ['--status'], dict(action='store', dest='run_status', choices=run_catalogue.RUN_STATUSES,
+                      help='only list batches with this status') ),
+            ( ['--baseline'], dict(action='store', dest='baseline',
+                      help='climate scenario the others are compared against') ),
             ]
 
     @expose(hide=True, aliases=['run'])
@@ -42,50 +119,288 @@ class GISAppController(controller.CementBaseController):
     @expose(help='Use existing batch and skip to watershed processing')
     def process_watersheds(self):
         print("Skipping to watersheds")
-        self.app.skip_to_watersheds = 1
+        self.app.mode = 'process_watersheds'
 
     @expose(help='Use existing batch and skip to watershed processing')
     def calculate_bqart(self):
         print("Skipping to discharge calculations")
-        self.app.skip_to_watersheds = 1
-        self.app.skip_to_discharge = 1
+        self.app.mode = 'calculate_bqart'
 
     @expose(help='Use pre-made catchment polygon (CODE & ALIAS columns required)')
     def custom_pour_points(self):
         print("Using specific watershed polygon")
-        self.app.custom_pour_points = 1
+        self.app.mode = 'custom_pour_points'
 
     @expose(help='Prepare watersheds for Fastscape processing')
     def fastscape(self):
         print("Fastscape processing")
-        self.app.fastscape_process = 1
-        self.app.skip_to_discharge = 1
-        self.app.skip_to_watersheds = 1
+        self.app.mode = 'fastscape'
+
+    @expose(help='Reuse the latest batches and rerun only stages whose inputs changed')
+    def update(self):
+        print("Updating changed stages")
+        self.app.mode = 'update'
+
+    @expose(help='Run hydrology, faults and watersheds on a downsampled DEM to tune thresholds')
+    def preview(self):
+        print("Previewing on a coarse DEM")
+        self.app.mode = 'preview'
+
+    @expose(help='Stream network statistics for many thresholds from an existing hydro batch')
+    def sweep(self):
+        print("Sweeping stream thresholds")
+        self.app.mode = 'sweep'
+
+    @expose(help='List catalogued batches, filtered by --kind, --status, --scenario and -pp')
+    def runs(self):
+        self.app.mode = 'runs'
+
+    @expose(help='Compare the results of several climate scenarios (--scenario) for one watershed batch')
+    def compare(self):
+        print("Comparing climate scenarios")
+        self.app.mode = 'compare'
+
+    @expose(help='Run every project in a schedule file (-j) through a worker pool')
+    def schedule(self):
+        print("Scheduling jobs")
+        self.app.mode = 'schedule'
 
 class GISApp(foundation.CementApp):
     
-    skip_to_watersheds = 0
-    skip_to_discharge = 0
-    custom_pour_points = 0
-    fastscape_process = 0
+    mode = 'default'
 
     class Meta:
         label = 'GIS_Automator'
         base_controller = GISAppController
 
-   
-app = GISApp()
+
+class RunSpecError(Exception):
+    pass
+
+
+class RunSpec:
+    'Answers to the interactive prompts so a run can go unattended'
+
+    cache_policies = ['keep', 'clear']
+
+    # skip_to_watersheds, skip_to_discharge, fastscape_process
+    modes = {
+        'default': (0, 0, 0),
+        'custom_pour_points': (0, 0, 0),
+        'process_watersheds': (1, 0, 0),
+        'calculate_bqart': (1, 1, 0),
+        'fastscape': (1, 1, 1),
+        'update': (0, 0, 0),
+        'preview': (0, 0, 0),
+        'sweep': (1, 0, 0),
+        'runs': (0, 0, 0),
+        'compare': (1, 1, 0)
+    }
+
+    def __init__(self, spec = None, pargs = None):
+        spec = spec or {}
+
+        self.mode = spec.get('mode', 'default')
+        self.batch = spec.get('batch', None)
+        self.custom_pour_points = spec.get('custom_pour_points', None)
+        self.headless = bool(spec.get('headless', False))
+        self.use_last_run = spec.get('use_last_run', None)
+        self.hydro_batch = spec.get('hydro_batch', False)
+        self.watershed_batch = spec.get('watershed_batch', False)
+        self.scenarios = spec.get('scenarios', [])
+        self.cache = spec.get('cache', None)
+        self.pour_points = spec.get('pour_points', False)
+        self.lithology_values = spec.get('lithology_values', False)
+        self.preview_factors = spec.get('preview_factors', PREVIEW_FACTORS)
+        self.sweep_thresholds = spec.get('sweep_thresholds', SWEEP_THRESHOLDS)
+        self.sweep_masks = spec.get('sweep_masks', [])
+        self.run_kind = spec.get('run_kind', None)
+        self.run_status = spec.get('run_status', None)
+        self.baseline = spec.get('baseline', None)
+
+        # Command line flags win over the spec file
+        if pargs is not None:
+            if pargs.batch:
+                self.batch = pargs.batch
+            if pargs.custom_pp:
+                self.custom_pour_points = pargs.custom_pp
+            if pargs.headless:
+                self.headless = True
+            if pargs.hydro_batch:
+                self.hydro_batch = pargs.hydro_batch
+            if pargs.watershed_batch:
+                self.watershed_batch = pargs.watershed_batch
+            if pargs.scenarios:
+                self.scenarios = pargs.scenarios
+            if pargs.cache:
+                self.cache = pargs.cache
+            if pargs.preview_factors:
+                self.preview_factors = pargs.preview_factors
+            if pargs.sweep_thresholds:
+                self.sweep_thresholds = pargs.sweep_thresholds
+            if pargs.sweep_masks:
+                self.sweep_masks = pargs.sweep_masks
+            if pargs.run_kind:
+                self.run_kind = pargs.run_kind
+            if pargs.run_status:
+                self.run_status = pargs.run_status
+            if pargs.baseline:
+                self.baseline = pargs.baseline
+
+        if not isinstance(self.preview_factors, list):
+            self.preview_factors = [f.strip() for f in str(self.preview_factors).split(',') if f.strip()]
+
+        if not isinstance(self.sweep_thresholds, list):
+            self.sweep_thresholds = [t.strip() for t in str(self.sweep_thresholds).split(',') if t.strip()]
+
+        if not isinstance(self.sweep_masks, list):
+            self.sweep_masks = [t.strip() for t in str(self.sweep_masks).split(',') if t.strip()]
+
+        if not isinstance(self.scenarios, list):
+            self.scenarios = [c.strip() for c in str(self.scenarios).split(',') if c.strip()]
+
+        # The run catalogue is shared by every run in a root, so unattended
+        # runs only carry on from the last used batches when asked to
+        if self.headless and self.use_last_run is None:
+            self.use_last_run = False
+
+    def prompt(self, text, options = None, numbered = False):
+        if self.headless:
+            raise RunSpecError('Headless run needs an answer for "'+text.strip()+'", add it to the run spec')
+
+        p = shell.Prompt(text, options = options, numbered = numbered)
+
+        return p.input
+
+    def stage_flags(self):
+        return self.modes[self.mode]
+
+    def validate(self, config):
+        # Check everything up front so a queued run fails before any processing
+        if self.mode not in self.modes:
+            raise RunSpecError('Unknown mode '+str(self.mode)+', use one of '+', '.join(sorted(self.modes)))
+
+        if self.cache and self.cache not in self.cache_policies:
+            raise RunSpecError('Unknown cache policy '+str(self.cache)+', use one of '+', '.join(self.cache_policies))
+
+        backend = config.get('backend', 'arcpy') or 'arcpy'
+        if backend not in gis_backend.BACKENDS:
+            raise RunSpecError('Unknown backend '+str(backend)+', use one of '+', '.join(gis_backend.BACKENDS))
+
+        raster_format = (config.get('intermediates') or {}).get('format', 'tif') or 'tif'
+        if raster_format not in raster_store.FORMATS:
+            raise RunSpecError('Unknown intermediate format '+str(raster_format)+', use one of '+', '.join(raster_store.FORMATS))
+        if raster_format == 'raw' and backend != 'numpy':
+            raise RunSpecError('Raw intermediates need backend: numpy')
+        if (config.get('intermediates') or {}).get('chunked') and backend != 'numpy':
+            raise RunSpecError('Chunked intermediates need backend: numpy')
+
+        catchment_stats = config.get('catchment_stats', 'zonal') or 'zonal'
+        if catchment_stats not in CATCHMENT_STATS:
+            raise RunSpecError('Unknown catchment_stats '+str(catchment_stats)+', use one of '+', '.join(CATCHMENT_STATS))
+        if catchment_stats == 'upstream' and backend != 'numpy':
+            raise RunSpecError('catchment_stats: upstream needs backend: numpy')
+        if config.get('monthly_stats') and backend != 'numpy':
+            raise RunSpecError('monthly_stats needs backend: numpy')
+
+        for key in config.get('persist') or []:
+            if key not in HYDRO_OUTPUTS:
+                raise RunSpecError('Cannot persist '+str(key)+', use one of '+', '.join(HYDRO_OUTPUTS))
+
+        climate_names = [c['name'] for c in config['climates']]
+        if config.get('climate_basic'):
+            climate_names = climate_names + ['_basic_'+c['name'] for c in config['climate_basic']]
+
+        for c in self.scenarios:
+            if c not in climate_names:
+                raise RunSpecError('Unknown climate scenario '+c+', use one of '+', '.join(climate_names))
+
+        if self.baseline and self.baseline not in (self.scenarios or climate_names):
+            raise RunSpecError('Baseline '+self.baseline+' is not one of the scenarios, use one of '+
+                               ', '.join(self.scenarios or climate_names))
+
+        for name, path in [('pour_points', self.pour_points), ('custom_pour_points', self.custom_pour_points),
+                           ('lithology_values', self.lithology_values)]:
+            if path and not os.path.exists(path):
+                raise RunSpecError('Cannot find '+name+' '+path)
+
+        # Runs that reach the pour point step need pour points or faults to
+        # find them from, otherwise the prompt fails after the hydrology
+        if self.mode == 'custom_pour_points' and self.headless and not self.custom_pour_points:
+            raise RunSpecError('Headless custom_pour_points runs need custom_pour_points in the run spec')
+
+        if self.mode in ['default', 'process_watersheds', 'update', 'preview']:
+            candidates = [self.pour_points, config.get('pour_points_path'), config.get('fault_path')]
+            if self.mode in ['update', 'preview']:
+                candidates.append(self.custom_pour_points)
+            found = [p for p in candidates if p and os.path.exists(p)]
+            if not found and (self.headless or self.mode in ['update', 'preview']):
+                raise RunSpecError('No pour points: set pour_points in the run spec, or an existing '
+                                   'pour_points_path or fault_path in the config')
+
+        for f in self.preview_factors:
+            if not str(f).isdigit() or int(f) < 2:
+                raise RunSpecError('Preview factors must be whole numbers above 1, not '+str(f))
+
+        for t in self.sweep_thresholds + self.sweep_masks:
+            try:
+                float(t)
+            except ValueError:
+                raise RunSpecError('Sweep thresholds must be numbers, not '+str(t))
+
+        if self.run_kind and self.run_kind not in run_catalogue.RUN_KINDS:
+            raise RunSpecError('Unknown run kind '+str(self.run_kind)+', use one of '+', '.join(run_catalogue.RUN_KINDS))
+        if self.run_status and self.run_status not in run_catalogue.RUN_STATUSES:
+            raise RunSpecError('Unknown run status '+str(self.run_status)+', use one of '+', '.join(run_catalogue.RUN_STATUSES))
+
+        for name, path in [('hydro_batch', self.hydro_batch), ('watershed_batch', self.watershed_batch)]:
+            if path and path != 'latest' and os.path.isabs(path) and not os.path.isdir(path):
+                raise RunSpecError('Cannot find '+name+' '+path)
+
+
+def load_run_spec(path):
+    spec = {}
+
+    if path:
+        if not os.path.exists(path):
+            raise RunSpecError('Cannot find run spec '+path)
+        f = open(path)
+        spec = yaml.load(f.read()) or {}
+        f.close()
+
+    return spec
+
+
+def catalogued(method):
+    # Batches a GISbatch workflow started in the run catalogue are marked
+    # failed if it raises or is interrupted
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        opened = len(self.open_runs)
+        try:
+            return method(self, *args, **kwargs)
+        except BaseException:
+            for run_id in self.open_runs[opened:]:
+                self.catalogue_finish(run_id, {}, 'failed')
+            raise
+
+    return wrapper
+
 
 class GISbatch:
     'Common base class for GIS batch processing'
    
-    def __init__(self, config, batch = False):
+    def __init__(self, config, batch = False, spec = None):
+        self.spec = spec if spec else RunSpec()
+        self.config = config
         self.project_root = config['root']
         self.project_name = config['project_name']
         self.projection_code = config['projection_code']
         self.pour_points_path = config['pour_points_path']
         self.lithology_path = config['lithology_path']
         self.lithology_values = config['lithology_values']
+        if self.spec.lithology_values:
+            self.lithology_values = self.spec.lithology_values
         self.fault_path = config['fault_path']
         self.fault_data = ''
         self.scratch_path = config['scratch']
@@ -112,27 +427,67 @@ class GISbatch:
 
         # Fault data
         self.fault_meta_data = {}
-        
-        # Set the environment variables
-        arcpy.env.scratchWorkspace = self.scratch_path
-        self.set_environment(batch)
 
-        sr = arcpy.SpatialReference(self.projection_code)
-        arcpy.env.outputCoordinateSystem = sr
+        # Stage timings, switch off with trace: false
+        self.tracer = None
+        if config.get('trace', True):
+            self.tracer = StageTracer()
+        
+        # arcpy or numpy, see gis_backend
+        self.backend = gis_backend.load_backend(config)
+        self.backend.setup(self.scratch_path, self.projection_code)
+
+        # Hydro and watershed intermediates as GeoTIFFs (tif) or memory-mapped
+        # arrays (raw), the path keys under chunked in compressed chunked
+        # stores, and the rasters listed under export also saved as GeoTIFFs
+        intermediates = config.get('intermediates') or {}
+        self.intermediate_format = intermediates.get('format', 'tif') or 'tif'
+        self.chunked_rasters = intermediates.get('chunked') or []
+        self.export_rasters = intermediates.get('export') or []
+
+        # Hydrology outputs written to disk, by hydro_paths key. The rest are
+        # handed to the next stage in memory. Everything is written when
+        # persist is not set
+        self.persist = config.get('persist')
+
+        # zonal or upstream, see CATCHMENT_STATS. The D8 graph used for
+        # upstream aggregates is built once per batch
+        self.catchment_stats = config.get('catchment_stats', 'zonal') or 'zonal'
+        self.upstream_graph = None
+
+        # Per-month climate tables for each catchment alongside the annual ones
+        self.monthly_stats = bool(config.get('monthly_stats', False))
+
+        # Zonal and BQART rows kept between runs by catchment footprint, see
+        # catchment_memo. Footprints are hashed once per watershed raster
+        self.memo_path = None
+        if config.get('memo'):
+            self.memo_path = os.path.join(self.output_path, 'catchment_memo.sqlite')
+        self.footprints = None
+
+        # Every hydro, watershed and climate batch is recorded in the run
+        # catalogue, open_runs are the ones started and not yet finished
+        self.catalogue_path = config.get('catalogue') or os.path.join(self.project_root, CATALOGUE_NAME)
+        self.open_runs = []
 
-        # Load in Spatial Analyst Toolbox
-        arcpy.CheckOutExtension("Spatial")
+        # Set the environment variables
+        self.set_environment(batch)
     
+    def save_trace(self):
+        if self.tracer is not None and self.tracer.events:
+            self.tracer.report()
+            trace_path = self.tracer.save(self.batch_path)
+            print('Stage trace saved to '+trace_path)
+
     def set_custom_pp(self, path):
         self.pour_points_path = path
 
     def set_environment(self, batch = False):
         if batch:
             self.batch_path = batch
-            arcpy.env.workspace = self.batch_path
         else:
             self.batch_path = self.set_workspace()
-            arcpy.env.workspace = self.batch_path
+        self.backend.set_workspace(self.batch_path)
 
     
     def get_time_string(self):
@@ -143,33 +498,30 @@ class GISbatch:
         d = '_'.join(tstring_list)
         
         return d
-        
+
     def set_workspace(self):
         
-        if app.pargs.batch is None:
+        if self.spec.batch is None:
             
-            dirname = self.get_time_string()
-        
-            # Assuming it doesn't exist already
-            output_batch_path = os.path.join(self.output_path, dirname)
-  
-            os.makedirs(output_batch_path)
+            output_batch_path = make_batch_directory(self.output_path)
             
             # Copy original DEM
             shutil.copy2(self.original_dem, output_batch_path)
             
         else:
-            if os.path.isdir(app.pargs.batch):
-                output_batch_path = app.pargs.batch
+            if os.path.isdir(self.spec.batch):
+                output_batch_path = self.spec.batch
             else:
-                print('Batch directory does not exist')
-                exit
+                raise RunSpecError('Batch directory does not exist '+self.spec.batch)
         
         return output_batch_path 
         
 
+    @traced
+    @catalogued
     def hydro_workflow(self):
         print('Starting Hydrology Workflow...')
+        run_id = self.catalogue_start('hydro', self.batch_path, {'original_dem': self.original_dem}, self.output_path)
       
         print('Fill')
         if self.fill_check:
@@ -208,12 +560,17 @@ class GISbatch:
             'fault_data_meta':'',
             'uplift_rate':self.uplift_mm_yr
        }
+        hydro_paths['exports'] = self.export_deliverables(hydro_paths)
+        hydro_paths['persisted'] = [k for k in HYDRO_OUTPUTS if os.path.exists(hydro_paths[k])]
        
         with open(os.path.join(self.batch_path,'hydro_paths.yml'), 'w') as outfile:
             outfile.write(yaml.dump(hydro_paths, default_flow_style=True) )
+
+        self.catalogue_finish(run_id, dict((k, hydro_paths[k]) for k in hydro_paths['persisted']))
         
         return hydro_paths
         
+    @traced
     def fault_workflow(self, faultlines, hydro_paths):
         
         print('Starting Fault workflow')
@@ -269,12 +626,16 @@ class GISbatch:
         return pour_points
     
     
+    @traced
+    @catalogued
     def watershed_workflow(self, original_pour_points, hydro_paths):
 
         print('Starting Watershed workflow')
       
         print('Creating batch directory')
         self.watershed_batch_path, pp_path = self.setup_watershed_batch(original_pour_points)
+        run_id = self.catalogue_start('watershed', self.watershed_batch_path, {'pour_points': original_pour_points},
+                                      self.batch_path, pour_points = file_fingerprint(original_pour_points))
         
         print('Snap to pour points')
         snap_pp_path = self.snap_pour_points(pp_path, hydro_paths['flow_acc_path'])
@@ -305,15 +666,20 @@ class GISbatch:
 
             watershed_paths.update({'fan_toes': fan_toe_file})
 
+        watershed_paths['exports'] = self.export_deliverables(watershed_paths)
+
         with open(os.path.join(self.watershed_batch_path,'watershed_paths.yml'), 'w') as outfile:
             outfile.write(yaml.dump(watershed_paths, default_flow_style=True) )
 
+        self.catalogue_finish(run_id, watershed_paths)
 
         return ws_path
 
 
+    @traced
+    @catalogued
     def bqart_workflow(self, watershed_raster, hydro_paths, watershed_path, 
-                       temp_directory, precip_directory, climate_scenario, clear_cache):
+                       temp_directory, precip_directory, climate_scenario, clear_cache, graph = None):
 
         precip_run = False
 
@@ -321,23 +687,71 @@ class GISbatch:
         
         # Are we ignoring any catchments?
         ignore = self.ignore_catchments(watershed_path)
-        
-        print('Creating climate batch directory')
-        climate_batch_path = self.climate_batch_directory(watershed_path, climate_scenario)
+
+        # With a stage graph, stages whose inputs haven't changed are reused
+        climate_stage = 'climate:' + climate_scenario
+        zonal_stage = 'zonal:' + climate_scenario
+        table_stage = 'table:' + climate_scenario
+        extract_stage = 'extract:' + climate_scenario
+        climate_batch_path = False
+
+        if graph is not None:
+            graph.add_inputs(climate_stage, files = [temp_directory, precip_directory], values = [temp_directory, precip_directory])
+            graph.add_inputs(table_stage, files = [os.path.join(watershed_path, 'ignore_catchments.txt')])
+            climate_batch_path = graph.outputs(zonal_stage).get('climate_batch', False)
+            if climate_batch_path and not os.path.isdir(climate_batch_path):
+                climate_batch_path = False
+
+        if climate_batch_path:
+            print('Reusing climate batch directory '+climate_batch_path)
+        else:
+            print('Creating climate batch directory')
+            climate_batch_path = self.climate_batch_directory(watershed_path, climate_scenario)
+        run_id = self.catalogue_start('climate', climate_batch_path, {'temp': temp_directory, 'precip': precip_directory,
+                                      'original_dem': self.original_dem}, watershed_path, climate_scenario)
         climate_cache_path = os.path.join(watershed_path, 'climate_cache', climate_scenario)
+        ensure_directory(climate_cache_path)
+
+        if graph is not None and not graph.is_current(climate_stage):
+            # Climate inputs changed, cached rasters are stale
+            self.clear_cache(watershed_path, climate_scenario)
+
+        zonal_current = graph is not None and graph.is_current(zonal_stage)
+        upstream = self.catchment_stats == 'upstream'
 
         if climate_scenario.startswith('_basic_'):
 
             # Just go with it
             temp_val = temp_directory
             precip_val = precip_directory
+        elif zonal_current:
+            print('Climate zone statistics up to date')
+            tz_dat_path = graph.outputs(zonal_stage)['temp']
+            pz_dat_path = graph.outputs(zonal_stage)['precip']
+        elif upstream:
+            stale = clear_cache or (graph is not None and not graph.is_current(climate_stage))
+            climate_rasters = self.upstream_climate(hydro_paths, temp_directory, precip_directory, climate_scenario, stale)
+            if graph is not None:
+                graph.record(climate_stage, climate_rasters)
+
+            print('Climate upstream statistics')
+            upstream_path = os.path.join(self.batch_path, 'upstream', climate_scenario)
+            tz_dat_path = self.outlet_statistics(climate_batch_path, watershed_path, hydro_paths, 'temp',
+                                                 climate_rasters['temp'], upstream_path, stale)
+            pz_dat_path = self.outlet_statistics(climate_batch_path, watershed_path, hydro_paths, 'precip',
+                                                 climate_rasters['precip'], upstream_path, stale)
+            monthly = self.monthly_tables(climate_batch_path, watershed_raster, temp_directory, precip_directory)
         else:
-            precip_cache_check = self.check_climate_cache(watershed_path, climate_scenario, 't')
-            temp_cache_check = self.check_climate_cache(watershed_path, climate_scenario, 'p')
+            precip_cache_check = self.check_climate_cache(watershed_path, climate_scenario, 'p')
+            temp_cache_check = self.check_climate_cache(watershed_path, climate_scenario, 't')
 
             if clear_cache:
-                p = shell.Prompt("Continue to overwrite previous climate rasters", ['y','n'])
-                if p.input is 'y':
+                if self.spec.cache == 'clear':
+                    overwrite = 'y'
+                else:
+                    overwrite = self.spec.prompt("Continue to overwrite previous climate rasters", ['y','n'])
+
+                if overwrite == 'y':
                     self.clear_cache(watershed_path, climate_scenario)
                     precip_cache_check = False
                     temp_cache_check = False
@@ -346,7 +760,7 @@ class GISbatch:
 
             if precip_cache_check:
                 print('Precipitation cache found')
-                precip_clip_resample = temp_cache_check
+                precip_clip_resample = precip_cache_check
             else:
 
                 datatype = 'p'
@@ -381,12 +795,42 @@ class GISbatch:
                 print('Resampling temperature rasters')
                 temp_clip_resample = self.resample_climate_raster(temp_averaged, watershed_raster, climate_cache_path, resample_name)
 
+            if graph is not None:
+                graph.record(climate_stage, {'precip': precip_clip_resample, 'temp': temp_clip_resample})
+
             print('Climate zone statistics')
-            tz_dat_path = self.zone_statistics(climate_batch_path, watershed_raster, temp_clip_resample, 'temp_data')
-            pz_dat_path = self.zone_statistics(climate_batch_path, watershed_raster, precip_clip_resample, 'precip_data')
+            tz_dat_path = self.memo_zone_statistics(climate_batch_path, watershed_raster, temp_clip_resample,
+                                                    'temp_data', file_fingerprint(temp_directory))
+            pz_dat_path = self.memo_zone_statistics(climate_batch_path, watershed_raster, precip_clip_resample,
+                                                    'precip_data', file_fingerprint(precip_directory))
+            monthly = self.monthly_tables(climate_batch_path, watershed_raster, temp_directory, precip_directory)
+
+        if zonal_current:
+            ez_dat_path = graph.outputs(zonal_stage)['elev']
+        else:
+            if upstream:
+                ez_dat_path = self.outlet_statistics(climate_batch_path, watershed_path, hydro_paths, 'elev',
+                                                     self.original_dem, os.path.join(self.batch_path, 'upstream'))
+            else:
+                ez_dat_path = self.memo_zone_statistics(climate_batch_path, watershed_raster, self.original_dem,
+                                                        'elev_data', file_fingerprint(self.original_dem))
 
-        ez_dat_path = self.zone_statistics(climate_batch_path, watershed_raster, self.original_dem, 'elev_data')
+            if graph is not None:
+                if climate_scenario.startswith('_basic_'):
+                    graph.skip(climate_stage)
+                    graph.record(zonal_stage, {'climate_batch': climate_batch_path, 'elev': str(ez_dat_path)})
+                else:
+                    outputs = {'climate_batch': climate_batch_path, 'elev': str(ez_dat_path),
+                               'temp': str(tz_dat_path), 'precip': str(pz_dat_path)}
+                    outputs.update(monthly)
+                    graph.record(zonal_stage, outputs)
         
+        # Zonal tables behind this scenario's table, catalogued so scenarios
+        # can be compared without rerunning them
+        tables = {'elev': str(ez_dat_path)}
+        if not climate_scenario.startswith('_basic_'):
+            tables.update({'temp': str(tz_dat_path), 'precip': str(pz_dat_path)})
+
         l_values = False
 
         f = open(os.path.join(watershed_path, 'watershed_paths.yml'))
@@ -395,178 +839,257 @@ class GISbatch:
         
         if self.lithology_path:
             if os.path.exists(self.lithology_path):
-                print('Lithology')
-                l_values = self.process_lithology(w_paths['ws_polygons'], self.lithology_path, climate_batch_path)
+                if graph is not None and graph.is_current('lithology'):
+                    print('Lithology up to date')
+                    tables['lithology'] = graph.outputs('lithology')['lithology_data']
+                    l_values = self.load_lithology_values(tables['lithology'])
+                else:
+                    print('Lithology')
+                    l_values = self.process_lithology(w_paths['ws_polygons'], self.lithology_path, climate_batch_path)
+                    tables['lithology'] = os.path.join(climate_batch_path, 'lithologies.csv')
+                    if graph is not None:
+                        graph.record('lithology', {'lithology_data': tables['lithology']})
             else:
                 print('Could not find lithology path')
                 print(self.lithology_path)
+        elif graph is not None:
+            graph.skip('lithology')
+
+        data_path = os.path.join(climate_batch_path, climate_scenario+'_data.csv')
+        extract_path = os.path.join(climate_batch_path, 'catchments_'+climate_scenario+'.shp')
+        if graph is not None and graph.is_current(table_stage) and graph.is_current(extract_stage):
+            print('Catchment table up to date')
+            self.catalogue_finish(run_id, dict(tables, data=data_path, catchments=extract_path))
+            return
         
         print('Calculating Qs using BQART')
-        print climate_scenario
+        print(climate_scenario)
+        if climate_scenario.startswith('_basic_'):
+            qs_source = ['basic', temp_val, precip_val, file_fingerprint(self.original_dem)]
+        else:
+            qs_source = [self.catchment_stats, file_fingerprint(temp_directory), file_fingerprint(precip_directory),
+                         file_fingerprint(self.original_dem)]
+        qs_keys, reused = self.memo_qs_rows(watershed_raster, qs_source, hydro_paths, l_values)
+        compute = None if qs_keys is None else set(qs_keys) - set(reused)
+
         if climate_scenario.startswith('_basic_'):
             qs_data = self.do_bqart(False, False, ez_dat_path,
                 hydro_paths['fault_data'], hydro_paths['fault_data_meta'],
-                hydro_paths['uplift_rate'], w_paths['ws_polygons'], l_values, temp_val, precip_val)
+                hydro_paths['uplift_rate'], w_paths['ws_polygons'], l_values, temp_val, precip_val, compute)
         else:
             qs_data = self.do_bqart(pz_dat_path, tz_dat_path, ez_dat_path,
                 hydro_paths['fault_data'], hydro_paths['fault_data_meta'],
-                hydro_paths['uplift_rate'], w_paths['ws_polygons'], l_values, False, False)
+                hydro_paths['uplift_rate'], w_paths['ws_polygons'], l_values, False, False, compute)
+
+        qs_data = self.memo_store_qs(qs_data, qs_source, qs_keys, reused)
 
         catchment_ids, catchment_data = self.save_data_to_csv(qs_data, climate_batch_path, ignore, climate_scenario, w_paths)
         
         self.extract_catchments(w_paths['ws_polygons'], catchment_ids, catchment_data, climate_batch_path, climate_scenario, ignore)
+
+        if graph is not None:
+            graph.record(table_stage, {'data': data_path})
+            graph.record(extract_stage, {'catchments': extract_path})
+
+        self.catalogue_finish(run_id, dict(tables, data=data_path, catchments=extract_path))
         
+    # Run catalogue
+
+    def catalogue_start(self, kind, path, inputs, parent, scenario = None, pour_points = None):
+        catalogue = run_catalogue.RunCatalogue(self.catalogue_path)
+        run_id = catalogue.start(kind, path, self.project_name, run_catalogue.config_fingerprint(self.config, kind),
+                                 inputs, parent, scenario, pour_points)
+        catalogue.close()
+        self.open_runs.append(run_id)
+
+        return run_id
+
+    def catalogue_finish(self, run_id, outputs, status = 'complete'):
+        catalogue = run_catalogue.RunCatalogue(self.catalogue_path)
+        catalogue.finish(run_id, status, outputs)
+        catalogue.close()
+        self.open_runs.remove(run_id)
+
     # ARC GIS PROCESSES
     # Hydro stuff
 
-    def fill(self):
-        fill_z_limit = ""
+    def stage_output(self, key, path):
+        # Where a hydrology stage writes, in memory unless key is persisted
+        if self.persist is None or key in self.persist:
+            return path
+        return self.backend.hold(path)
+
+    def raster_name(self, suffix, key = None):
+        if key in self.chunked_rasters:
+            return self.project_name + suffix + raster_store.CHUNKED_EXTENSION
+        if self.intermediate_format == 'raw':
+            return self.project_name + suffix + raster_store.RAW_EXTENSION
+        return self.project_name + suffix + '.tif'
+
+    def export_deliverables(self, paths):
+        # GeoTIFF copies of the raw or chunked rasters named in export, by
+        # path key
+        exports = {}
+        for key in self.export_rasters:
+            path = paths.get(key)
+            if path and raster_store.is_stored(path):
+                print('Exporting '+key)
+                exports[key] = self.backend.export_raster(path, os.path.splitext(path)[0] + '.tif')
+
+        return exports
+
+    def watershed_raster(self, watershed_directory):
+        # Named as the watershed workflow recorded it, tif or raw
+        paths_file = os.path.join(watershed_directory, 'watershed_paths.yml')
+        if os.path.exists(paths_file):
+            f = open(paths_file)
+            w_paths = yaml.load(f.read())
+            f.close()
+            if w_paths.get('watersheds'):
+                return os.path.join(watershed_directory, os.path.basename(w_paths['watersheds']))
 
-        out_fill = Fill(self.original_dem, fill_z_limit)
-        out_fill_raster = self.project_name + '_fill.tif'
-        out_fill_path = os.path.join(self.batch_path, out_fill_raster)
-        out_fill.save(out_fill_path)
+        return os.path.join(watershed_directory, self.project_name + '_watersheds.tif')
+
+    @traced
+    def fill(self):
+        out_fill_raster = self.raster_name('_fill', 'working_dem')
+        out_fill_path = self.stage_output('working_dem', os.path.join(self.batch_path, out_fill_raster))
+        self.backend.fill(self.original_dem, out_fill_path)
         
         return out_fill_path
         
 
+    @traced
     def flow_direction(self, dem):
         force_flow = self.flow_dir['force_flow']
         
-        out_flow_dir = FlowDirection(dem, force_flow)
-        out_flow_dir_raster = self.project_name + '_f_dir.tif'
-        out_flow_dir_path = os.path.join(self.batch_path, out_flow_dir_raster)
-        out_flow_dir.save(out_flow_dir_path)
+        out_flow_dir_raster = self.raster_name('_f_dir', 'flow_path')
+        out_flow_dir_path = self.stage_output('flow_path', os.path.join(self.batch_path, out_flow_dir_raster))
+        self.backend.flow_direction(dem, force_flow, out_flow_dir_path)
         
         return out_flow_dir_path
         
 
+    @traced
     def flow_accumulation(self, flow_path):
         flow_weight_raster = self.flow_acc['flow_weight_raster']
         flow_data_type = self.flow_acc['flow_data_type']
 
-        out_flow_acc = FlowAccumulation(flow_path, flow_weight_raster, flow_data_type)
-        out_flow_acc_raster = self.project_name + '_f_acc.tif'
-        out_flow_acc_path = os.path.join(self.batch_path, out_flow_acc_raster)
-        out_flow_acc.save(out_flow_acc_path)
+        out_flow_acc_raster = self.raster_name('_f_acc', 'flow_acc_path')
+        out_flow_acc_path = self.stage_output('flow_acc_path', os.path.join(self.batch_path, out_flow_acc_raster))
+        self.backend.flow_accumulation(flow_path, flow_weight_raster, flow_data_type, out_flow_acc_path,
+                                       self.flow_acc.get('workers'))
         
         return out_flow_acc_path
         
 
+    @traced
     def stream_network(self, flow_acc_path):
         con_where_clause = self.str_net['conditional']
         false_constant = self.str_net['false_constant']
-        true_raster = flow_acc_path
 
-        out_con = Con(flow_acc_path, true_raster, false_constant, con_where_clause)
-        out_con_raster = self.project_name + '_net.tif'
-        stream_net_path = os.path.join(self.batch_path, out_con_raster)
-        out_con.save(stream_net_path)
+        out_con_raster = self.raster_name('_net', 'stream_net_path')
+        stream_net_path = self.stage_output('stream_net_path', os.path.join(self.batch_path, out_con_raster))
+        self.backend.con(flow_acc_path, con_where_clause, false_constant, stream_net_path)
         
         return stream_net_path
         
  
+    @traced
     def nullify(self, stream_net_path):
         false_raster = self.set_null['false_raster']
         null_where_clause = self.set_null['conditional']
 
-        out_null = SetNull(stream_net_path, false_raster, null_where_clause)
-        out_null_raster = self.project_name + '_net_null.tif'
-        out_null_path = os.path.join(self.batch_path, out_null_raster)
-        out_null.save(out_null_path)
+        out_null_raster = self.raster_name('_net_null', 'null_path')
+        out_null_path = self.stage_output('null_path', os.path.join(self.batch_path, out_null_raster))
+        self.backend.set_null(stream_net_path, false_raster, null_where_clause, out_null_path)
         
         return out_null_path       
         
 
+    @traced
     def stream_order(self, null_path, flow_path):
         method = self.str_ord['method']
         
-        out_s_ord_raster = self.project_name + '_s_order.tif'
-        out_s_ord_path = os.path.join(self.batch_path, out_s_ord_raster)
-        out_s_ord = StreamOrder(null_path, flow_path, method)
-        out_s_ord.save(out_s_ord_path)
+        out_s_ord_raster = self.raster_name('_s_order', 's_ord_path')
+        out_s_ord_path = self.stage_output('s_ord_path', os.path.join(self.batch_path, out_s_ord_raster))
+        self.backend.stream_order(null_path, flow_path, method, out_s_ord_path)
         
         return out_s_ord_path
         
 
+    @traced
     def vectorise_streams(self, s_ord_path, flow_path):
         out_sf_name = self.project_name + '_streams.shp'
-        out_sf_path = os.path.join(self.batch_path, out_sf_name)
-        StreamToFeature(s_ord_path, flow_path, out_sf_path)
+        out_sf_path = self.stage_output('vector_streams', os.path.join(self.batch_path, out_sf_name))
+        self.backend.stream_to_feature(s_ord_path, flow_path, out_sf_path)
         
         return out_sf_path
         
         
     # Fault stuff
         
+    @traced
     def get_fault_data(self, faultlines):
-        fc = arcpy.SearchCursor(faultlines)
-        for row in fc:
-            # Get mean temperature
-            self.fault_meta_data.update({row.getValue('FID'):{
-                        'name':row.getValue('name'), 
-                        'slip_min':row.getValue('slip_min'),
-                        'slip_max':row.getValue('slip_max'), 
-                        'age_min':row.getValue('age_min'), 
-                        'age_max':row.getValue('age_max'), 
-                        'sense':row.getValue('sense')}})        
+        fields = ['FID', 'name', 'slip_min', 'slip_max', 'age_min', 'age_max', 'sense']
+        for row in self.backend.search_rows(faultlines, fields):
+            self.fault_meta_data.update({row[0]: dict(zip(fields[1:], row[1:]))})
                         
         
+    @traced
     def fault_intersects(self, faultlines, streams, cluster_tolerance):
         inFeatures = [faultlines, streams]
         intersects_name = self.project_name + '_intersects_multipart.shp'
         intersects_multipart = os.path.join(self.fault_path, intersects_name)
-        arcpy.Intersect_analysis(inFeatures, intersects_multipart, "", cluster_tolerance, "point")
+        self.backend.intersect(inFeatures, intersects_multipart, cluster_tolerance, "point")
         
         return intersects_multipart
         
         
+    @traced
     def intersects_to_singlepart(self, intersects_multipart):
         intersects_name = self.project_name + '_intersects_singlepart.shp'
         intersects_singlepart = os.path.join(self.fault_path, intersects_name)
-        arcpy.MultipartToSinglepart_management(intersects_multipart, intersects_singlepart)
+        self.backend.multipart_to_singlepart(intersects_multipart, intersects_singlepart)
         
         return intersects_singlepart
     
+    @traced
     def remove_lowlands(self, minimum_height):
-        extract = ExtractByAttributes(self.original_dem, "VALUE > "+str(minimum_height))
-        dem_no_lowlands = os.path.join(self.fault_path, self.project_name + '_dem_no_lowlands.tif')
-        extract.save(dem_no_lowlands)
+        dem_no_lowlands = os.path.join(self.fault_path, self.raster_name('_dem_no_lowlands'))
+        self.backend.extract_by_attributes(self.original_dem, "VALUE > "+str(minimum_height), dem_no_lowlands)
         
         return dem_no_lowlands
 
+    @traced
     def ignore_lowest_pp(self, intersects_singlepart, dem_no_lowlands):
         intersect_heights = os.path.join(self.fault_path, self.project_name + '_intersects_all.shp')
-        ExtractValuesToPoints(intersects_singlepart, dem_no_lowlands, intersect_heights,
-                      "INTERPOLATE", "ALL") 
+        self.backend.extract_values_to_points(intersects_singlepart, dem_no_lowlands, intersect_heights)
               
         intersect_heights_above = os.path.join(self.fault_path,  self.project_name + '_intersects_above.shp')
-        arcpy.Select_analysis(intersect_heights, intersect_heights_above, '"RASTERVALU" > 0')
+        self.backend.select(intersect_heights, intersect_heights_above, '"RASTERVALU" > 0')
         
         return intersect_heights_above
         
 
+    @traced
     def fault_routes(self, faultlines):
         fault_routes = os.path.join(self.fault_path, self.project_name + "_fault_routes.shp")
-        arcpy.CreateRoutes_lr(faultlines, 'Id', fault_routes, "LENGTH")
+        self.backend.create_routes(faultlines, 'Id', fault_routes)
         
         return fault_routes
         
         
+    @traced
     def intersect_events(self, pour_points, fault_routes, search_radius):
         intersect_events = os.path.join(self.fault_path, self.project_name + "_intersect_events.dbf")
-        arcpy.LocateFeaturesAlongRoutes_lr(pour_points, fault_routes, "Id", search_radius, intersect_events, "RID POINT MEAS")
         
-        return intersect_events
+        return self.backend.locate_features_along_routes(pour_points, fault_routes, "Id", search_radius, intersect_events)
         
         
+    @traced
     def extract_intersect_positions(self, intersect_events):
-        ic_cursor = arcpy.SearchCursor(intersect_events)
-        fieldnames = [field.name for field in arcpy.ListFields(intersect_events)]
-        ic_data = []
-        for row in ic_cursor:
-            # Get mean temperature
-            ic_data.append([row.getValue('OID'), row.getValue(fieldnames[4]), row.getValue('MEAS')])
+        ic_data = self.backend.route_events(intersect_events)
         
         intersect_data = os.path.join(self.fault_path, self.project_name + "_intersect_data.csv")
         row_headers = ['id', 'fault', 'distance']
@@ -575,10 +1098,6 @@ class GISbatch:
             a.writerow(row_headers)
             for r in ic_data:
                 a.writerow([r[0], r[1], r[2]])
-                
-        # Unlock data
-        del row 
-        del ic_cursor
         
         return intersect_data
     
@@ -586,72 +1105,61 @@ class GISbatch:
     
     # Watershed stuff
     
+    @traced
     def setup_watershed_batch(self, original_pour_points):
         # Each watershed calculations need to be discrete from one another
-        timestamp = self.get_time_string()
-        
-        if os.path.isdir(os.path.join(self.batch_path, 'watershed_calcs')) == 0:
-            os.makedirs(os.path.join(self.batch_path, 'watershed_calcs'))
-            
-        watershed_batch_path = os.path.join(self.batch_path, 'watershed_calcs', timestamp)
+        watershed_batch_path = make_batch_directory(os.path.join(self.batch_path, 'watershed_calcs'))
         originals_batch_path = os.path.join(watershed_batch_path, 'originals')        
-        os.makedirs(watershed_batch_path)
         os.makedirs(originals_batch_path)
         
         # Copy original Pour Points
         shutil.copy2(original_pour_points, originals_batch_path)
         
         working_pp_path = os.path.join(watershed_batch_path, basename(original_pour_points))
-        arcpy.CopyFeatures_management(original_pour_points, working_pp_path)
+        self.backend.copy_features(original_pour_points, working_pp_path)
         
         return watershed_batch_path, working_pp_path
             
         
+    @traced
     def pour_points_to_raster(self, pour_points):
-        pp_raster_name = self.project_name +'_pp_raster.tif'
+        pp_raster_name = self.raster_name('_pp_raster')
         pp_raster_path = os.path.join(self.watershed_batch_path, pp_raster_name)
-        arcpy.PointToRaster_conversion(pour_points, "FID", pp_raster_path, 'MOST_FREQUENT', '', '10')        
+        self.backend.point_to_raster(pour_points, "FID", pp_raster_path, 10)
         
         return pp_raster_path
         
         
+    @traced
     def snap_pour_points(self, pour_points, flow_acc):
         snap_distance = self.pour_points['snap_distance']
         
-        out_pp_name = self.project_name + '_snap_ppoints.tif'
+        out_pp_name = self.raster_name('_snap_ppoints', 'pour_points')
         out_pp_path = os.path.join(self.watershed_batch_path, out_pp_name)        
-        pp = SnapPourPoint(pour_points, flow_acc, snap_distance, "FID")
-        pp.save(out_pp_path)
+        self.backend.snap_pour_point(pour_points, flow_acc, snap_distance, "FID", out_pp_path)
         
         return out_pp_path
     
             
+    @traced
     def watersheds(self, flow_path, pp_path):
-        inPourPointField = "VALUE"
-        
-        out_ws_name = self.project_name + '_watersheds.tif'
+        out_ws_name = self.raster_name('_watersheds', 'watersheds')
         out_ws_path = os.path.join(self.watershed_batch_path, out_ws_name)
-        outWatershed = Watershed(flow_path, pp_path, inPourPointField)
-        outWatershed.save(out_ws_path)
+        self.backend.watershed(flow_path, pp_path, out_ws_path)
         
         return out_ws_path
 
+    @traced
     def fan_toe_lengths(self, fan_toes, pour_points):
         pp = {}
         ft = {}
         toe_lengths = {}
 
-        with arcpy.da.SearchCursor(pour_points, ["SHAPE@", "FID"]) as pp_d:
-            for row in pp_d:
-                pp_x = row[0].extent.XMin
-                pp_y = row[0].extent.YMin
-                pp.update({int(row[1]):[pp_x, pp_y]})
+        for row in self.backend.search_rows(pour_points, ["SHAPE@EXTENT", "FID"]):
+            pp.update({int(row[1]): [row[0][0], row[0][1]]})
 
-        with arcpy.da.SearchCursor(fan_toes, ["SHAPE@", "c_id"]) as ft_d:
-            for row in ft_d:
-                ft_x = row[0].extent.XMin
-                ft_y = row[0].extent.YMin
-                ft.update({int(row[1]):[ft_x, ft_y]})
+        for row in self.backend.search_rows(fan_toes, ["SHAPE@EXTENT", "c_id"]):
+            ft.update({int(row[1]): [row[0][0], row[0][1]]})
 
         for i, p in pp.iteritems():
             f = ft[i]
@@ -660,13 +1168,13 @@ class GISbatch:
 
         return toe_lengths
 
+    @traced
     def ws_to_poly(self, ws_path):
         
         out_poly_name = self.project_name + '_poly_ws.shp'
         out_poly_path = os.path.join(self.watershed_batch_path, out_poly_name)
-        arcpy.RasterToPolygon_conversion(ws_path, out_poly_path, "NO_SIMPLIFY", 'VALUE')      
-        arcpy.AddField_management(out_poly_path, 'AREA', "TEXT")
-        arcpy.CalculateField_management(out_poly_path, 'AREA', '!SHAPE.AREA@SQUAREMETERS!', "PYTHON_9.3")
+        self.backend.raster_to_polygon(ws_path, out_poly_path)
+        self.backend.calculate_area(out_poly_path, 'AREA', "TEXT")
         
         # Ignore off cuts
         
@@ -677,11 +1185,10 @@ class GISbatch:
         fids = []
         areas = []
         
-        with arcpy.da.SearchCursor(out_poly_path, fields) as sc:
-            for row in sc:
-                fids.append(row[0])
-                gcodes.append(row[1])
-                areas.append(row[2])
+        for row in self.backend.search_rows(out_poly_path, fields):
+            fids.append(row[0])
+            gcodes.append(row[1])
+            areas.append(row[2])
         
         i = 0
         for g in gcodes:
@@ -702,39 +1209,26 @@ class GISbatch:
             else:
                 to_delete.append(fids[d[1]])
         
-        with arcpy.da.UpdateCursor(out_poly_path, fields) as uc:
-            for row in uc:
-                if row[0] in to_delete:
-                    uc.deleteRow()
-        
-        del row
-        del uc
-        del sc
+        self.backend.delete_rows(out_poly_path, 'FID', to_delete)
         
         return out_poly_path
 
     # BQART stuff
         
     def climate_batch_directory(self, watershed_directory, scenario):
-        timestamp = self.get_time_string()
         print('Creating batch files')
-        climate_batch_path = os.path.join(watershed_directory, 'climate_calcs', str(timestamp)+'_'+scenario)
-        
-        os.makedirs(climate_batch_path)
-        
-        climate_cache_batch_path = os.path.join(watershed_directory, 'climate_cache')
-        climate_cache_scenario_path = os.path.join(climate_cache_batch_path, scenario)
-        if not os.path.isdir(climate_cache_batch_path):
-            os.makedirs(climate_cache_batch_path)
-        
-        if not os.path.isdir(climate_cache_scenario_path):
-            os.makedirs(climate_cache_scenario_path)
+        climate_batch_path = make_batch_directory(os.path.join(watershed_directory, 'climate_calcs'), '_'+scenario)
+
+        ensure_directory(os.path.join(watershed_directory, 'climate_cache', scenario))
         
         return climate_batch_path
 
     def check_climate_cache(self, watershed_directory, climate_scenario, datatype):
         print('Checking for preexisting '+datatype+' rasters')
+        # Backends with native zonal stats use the averaged raster as it is
         raster_name = datatype + '_' + climate_scenario + '_resample.tif'
+        if self.backend.native_zonal:
+            raster_name = datatype + '_' + climate_scenario + '_all.tif'
         raster_cache_path = os.path.join(watershed_directory, 'climate_cache', climate_scenario, raster_name)
         output = False
         if os.path.isfile(raster_cache_path):
@@ -756,25 +1250,20 @@ class GISbatch:
             except Exception, e:
                 print e
 
+    @traced
     def average_rasters(self, search_directory, save_directory, name, monthly):
         os.chdir(search_directory)
         rasters = []
         for file in glob.glob("*.tif"):
-            rasters.append(Raster(os.path.join(search_directory,file)))
+            rasters.append(os.path.join(search_directory,file))
          
-        raster_sum = sum(rasters)
-        
-        if monthly: # Temp
-            n_rasters = len(rasters)
-            combined_raster = raster_sum / n_rasters
-        else: # precip
-            combined_raster = raster_sum
-
+        # Temperatures are averaged, precipitation summed
         combined_raster_path = os.path.join(save_directory, name)
-        combined_raster.save(combined_raster_path)
+        self.backend.combine_rasters(rasters, combined_raster_path, monthly)
         
         return combined_raster_path
 
+    @traced
     def clip_rasters(self, raster_directory, save_directory, datatype, name, extent):
         clip_dir = os.path.join(save_directory, 'raster_clips')
         datatype_dir = os.path.join(save_directory, 'raster_clips', datatype)
@@ -795,32 +1284,309 @@ class GISbatch:
         
         return datatype_dir
         
+    @traced
     def clip_raster(self, input_raster, save_directory, name, extent):
         clip_raster_path = os.path.join(save_directory, name)
-        arcpy.Clip_management(input_raster, '#', clip_raster_path, extent)    
+        self.backend.clip(input_raster, clip_raster_path, extent)
         
         return clip_raster_path
     
+    @traced
     def resample_climate_raster(self, climate_raster, watershed_raster, save_directory, raster_name):
-        
-        cellsize_x = arcpy.GetRasterProperties_management(watershed_raster, "CELLSIZEX")
-        cellsize_y = arcpy.GetRasterProperties_management(watershed_raster, "CELLSIZEY")
-        
-        cellsize = min([cellsize_x, cellsize_y])
+        # The numpy backend weights climate cells by catchment coverage at
+        # their own resolution instead
+        if self.backend.native_zonal:
+            return climate_raster
+
+        cellsize = min(self.backend.cell_size(watershed_raster))
         
         climate_raster_resample = os.path.join(save_directory,raster_name)
-        arcpy.Resample_management(climate_raster, climate_raster_resample, cellsize, "NEAREST")
+        self.backend.resample(climate_raster, climate_raster_resample, cellsize, "NEAREST")
         
         return climate_raster_resample
 
+    @traced(detail=3)
     def zone_statistics(self, table_directory, watersheds, value_raster, data_name):
         table_path = os.path.join(table_directory, data_name)
-        outdata = ZonalStatisticsAsTable(watersheds, "VALUE", value_raster, table_path, "DATA")
         
-        return outdata      
+        return self.backend.zonal_statistics(watersheds, value_raster, table_path)
     
         
-    def do_bqart(self, pz_data, tz_data, ez_data, fault_data_path, fault_meta_data, uplift_rate, polygons, l_values, temp_val, precip_val):
+    # Catchment memo
+
+    def catchment_footprints(self, watershed_raster):
+        if self.footprints is None or self.footprints[0] != watershed_raster:
+            self.footprints = (watershed_raster, self.backend.zone_footprints(watershed_raster))
+
+        return self.footprints[1]
+
+    @traced
+    def memo_zone_statistics(self, table_directory, watersheds, value_raster, data_name, source):
+        # zone_statistics, computing only the catchments not in the memo
+        if self.memo_path is None:
+            return self.zone_statistics(table_directory, watersheds, value_raster, data_name)
+
+        footprints = self.catchment_footprints(watersheds)
+        source = self.backend.name + ':' + str(source)
+        memo = catchment_memo.CatchmentMemo(self.memo_path)
+        known = memo.zonal_rows(set(footprints.values()), source, data_name)
+
+        # Catchments zonal statistics gave no row for, e.g. outside the
+        # value raster, are stored as None and known to have no row
+        rows = dict((c_id, [c_id] + known[f]) for c_id, f in footprints.items() if known.get(f) is not None)
+        missing = sorted([c_id for c_id, f in footprints.items() if f not in known])
+        print(data_name+': '+str(len(footprints) - len(missing))+' catchments from the memo, '+str(len(missing))+' to compute')
+
+        if missing:
+            zones = os.path.join(table_directory, self.raster_name('_' + data_name + '_zones'))
+            self.backend.extract_by_attributes(watersheds, 'VALUE IN('+','.join(map(str, missing))+')', zones)
+            table = self.zone_statistics(table_directory, zones, value_raster, data_name + '_new')
+
+            new = dict((footprints[c_id], None) for c_id in missing)
+            for r in self.backend.search_rows(table, gis_backend.ZONAL_FIELDS):
+                c_id = int(r[0])
+                rows[c_id] = [c_id] + list(r[1:])
+                new[footprints[c_id]] = list(r[1:])
+            memo.store_zonal(new, source, data_name)
+        memo.close()
+
+        table_path = os.path.join(table_directory, data_name + '.csv')
+        with bqart.csv_output(table_path) as table:
+            a = csv.writer(table, delimiter=',', lineterminator='\n')
+            a.writerow(gis_backend.ZONAL_FIELDS)
+            for c_id in sorted(rows):
+                a.writerow(rows[c_id])
+
+        return table_path
+
+    def memo_qs_rows(self, watershed_raster, source, hydro_paths, l_values):
+        # (footprint, params) key of each catchment and the BQART rows the
+        # memo already has, by catchment ID. params covers everything else
+        # the row depends on: constants, uplift, lithology and fault data
+        if self.memo_path is None:
+            return None, {}
+
+        faults = load_fault_data(hydro_paths['fault_data'])
+        fault_meta = hydro_paths['fault_data_meta'] or {}
+        shared = [bqart.OMEGA, bqart.DENSITY, bqart.POROSITY, hydro_paths['uplift_rate']]
+
+        keys = {}
+        for c_id, f in self.catchment_footprints(watershed_raster).items():
+            fault = faults.get(str(c_id))
+            meta = fault_meta.get(int(fault[0])) if fault and fault_meta else None
+            keys[c_id] = (f, catchment_memo.params_hash([shared, l_values.get(c_id) if l_values else None,
+                                                         fault, meta]))
+
+        memo = catchment_memo.CatchmentMemo(self.memo_path)
+        known = memo.qs_rows(keys.values(), catchment_memo.params_hash(source))
+        memo.close()
+
+        # None for catchments known to have no BQART row
+        reused = dict((c_id, [c_id] + known[k] if known[k] is not None else None)
+                      for c_id, k in keys.items() if k in known)
+        print('BQART: '+str(len(reused))+' catchments from the memo, '+str(len(keys) - len(reused))+' to compute')
+
+        return keys, reused
+
+    def memo_store_qs(self, qs_data, source, keys, reused):
+        # New rows into the memo, returned with the reused ones in ID order
+        if keys is None:
+            return qs_data
+
+        # Computed catchments without a row, e.g. no climate values, are
+        # stored as None so unchanged reruns don't compute them again
+        new = dict((keys[c_id], None) for c_id in keys if c_id not in reused)
+        new.update((keys[r[0]], list(r[1:])) for r in qs_data if r[0] in keys)
+        memo = catchment_memo.CatchmentMemo(self.memo_path)
+        memo.store_qs(new, catchment_memo.params_hash(source))
+        memo.close()
+
+        rows = dict((r[0], r) for r in qs_data)
+        rows.update((c_id, r) for c_id, r in reused.items() if r is not None)
+        return [rows[c_id] for c_id in sorted(rows)]
+
+    def monthly_tables(self, table_directory, watershed_raster, temp_directory, precip_directory):
+        # temp_monthly and precip_monthly next to temp_data and precip_data
+        if not self.monthly_stats:
+            return {}
+
+        print('Monthly climate statistics')
+        return {
+            'temp_monthly': self.monthly_statistics(table_directory, watershed_raster, temp_directory, 'temp'),
+            'precip_monthly': self.monthly_statistics(table_directory, watershed_raster, precip_directory, 'precip')
+        }
+
+    @traced
+    def monthly_statistics(self, table_directory, watershed_raster, climate_directory, name, chunk = MONTHLY_CHUNK_ROWS):
+        # Coverage-weighted mean of each month for each catchment, with the
+        # mean and total of the months and the highest and lowest month. The
+        # monthly rasters are read as one (month, y, x) stack a block of rows
+        # at a time, at their own resolution
+        months = sorted(glob.glob(os.path.join(climate_directory, '*.tif')), key=month_number)
+        if not months:
+            raise RunSpecError('No monthly rasters in '+climate_directory)
+
+        grid = self.backend.raster_info(months[0])[0]
+        source = grid.subgrid(*grid.window(self.backend.raster_info(watershed_raster)[0].bounds()))
+        zone, cell, coverage = self.backend.zone_coverage(watershed_raster, source)
+        keys, inverse = np.unique(zone, return_inverse=True)
+        cell_rows, cols = cell // source.shape[1], source.shape[1]
+
+        totals = np.zeros((len(keys), len(months)))
+        weights = np.zeros((len(keys), len(months)))
+        for r0 in range(0, source.shape[0], chunk):
+            r1 = min(r0 + chunk, source.shape[0])
+            take = (cell_rows >= r0) & (cell_rows < r1)
+            if not take.any():
+                continue
+
+            extent = source.subgrid(r0, r1, 0, cols).bounds()
+            stack = np.array([self.backend.read_window(m, extent)[0] for m in months])
+            values = stack.reshape(len(months), -1)[:, cell[take] - r0 * cols].T
+            w = coverage[take][:, None] * np.isfinite(values)
+            np.add.at(totals, inverse[take], np.where(w > 0, values, 0) * w)
+            np.add.at(weights, inverse[take], w)
+
+        means = np.where(weights > 0, totals / np.maximum(weights, 1), np.nan)
+        known = np.isfinite(means)
+        # Month 0 where a catchment has no climate values in any month
+        any_known = known.any(axis=1)
+        peak = np.where(any_known, np.where(known, means, -np.inf).argmax(axis=1) + 1, 0)
+        low = np.where(any_known, np.where(known, means, np.inf).argmin(axis=1) + 1, 0)
+
+        fields = ['VALUE'] + ['M'+str(m + 1) for m in range(len(months))] + ['MEAN', 'TOTAL', 'PEAK_MONTH', 'LOW_MONTH']
+        rows = []
+        for i, k in enumerate(keys.tolist()):
+            month_means = means[i][known[i]]
+            rows.append([k] + means[i].tolist() + [float(month_means.mean()) if month_means.size else float('nan'),
+                                                   float(month_means.sum()), int(peak[i]), int(low[i])])
+
+        return self.backend.write_table(os.path.join(table_directory, name + '_monthly.csv'), fields, rows)
+
+    # Upstream aggregates
+
+    def flow_graph(self, hydro_paths):
+        # Receivers and downstream levels of the hydro batch, built once
+        if self.upstream_graph is None:
+            receiver, valid, grid = self.backend.flow_receivers(hydro_paths['flow_path'])
+            order, bounds = flow_grid.flow_levels(receiver, valid)
+            self.upstream_graph = (receiver, valid, grid, order, bounds)
+
+        return self.upstream_graph
+
+    @traced
+    def upstream_climate(self, hydro_paths, temp_directory, precip_directory, climate_scenario, clear):
+        # Annual climate rasters over the whole hydro extent, kept with the
+        # hydro batch so any pour point set can use their aggregates
+        directory = os.path.join(self.batch_path, 'upstream', climate_scenario)
+        if clear and os.path.isdir(directory):
+            shutil.rmtree(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        rasters = {}
+        for datatype, name, source, monthly in [('t', 'temp', temp_directory, 1), ('p', 'precip', precip_directory, 0)]:
+            combined_name = datatype + '_' + climate_scenario + '_all.tif'
+            rasters[name] = os.path.join(directory, combined_name)
+            if os.path.exists(rasters[name]):
+                continue
+
+            clip_dir = self.clip_rasters(source, directory, datatype, datatype + '_' + climate_scenario + '_clip',
+                                         hydro_paths['flow_path'])
+            self.average_rasters(clip_dir, directory, combined_name, monthly)
+
+        return rasters
+
+    @traced
+    def upstream_aggregates(self, hydro_paths, name, raster, directory, clear = False):
+        # Sum, sum of squares, count, max and min of a raster's values over
+        # each cell and everything upstream of it
+        paths = dict((f, os.path.join(directory, self.raster_name('_up_' + name + '_' + f))) for f in UPSTREAM_FIELDS)
+        if not clear and all([os.path.exists(p) for p in paths.values()]):
+            return paths
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        print('Accumulating upstream '+name)
+        receiver, valid, grid, order, bounds = self.flow_graph(hydro_paths)
+        values = self.backend.sample_raster(raster, grid).ravel()
+        values[~valid] = np.nan
+        finite = np.isfinite(values).astype(float)
+        data = np.where(finite > 0, values, 0)
+
+        upstream = {
+            'sum': flow_grid.accumulate(receiver, order, bounds, data) + data,
+            'sq': flow_grid.accumulate(receiver, order, bounds, data * data) + data * data,
+            'n': flow_grid.accumulate(receiver, order, bounds, finite) + finite,
+            'max': flow_grid.upstream_extreme(receiver, order, bounds, values),
+            'min': flow_grid.upstream_extreme(receiver, order, bounds, values, False)
+        }
+        for f in UPSTREAM_FIELDS:
+            upstream[f][~valid] = np.nan
+            self.backend.write_raster(paths[f], upstream[f].reshape(grid.shape), grid, 'float64')
+
+        return paths
+
+    @traced
+    def outlet_statistics(self, table_directory, watershed_path, hydro_paths, name, raster, directory, clear = False):
+        # A zonal statistics table, as zone_statistics writes, read from the
+        # upstream aggregates at each snapped pour point. Outlets upstream of
+        # another have their sums taken off it. Max and min can't be taken
+        # off, so outlets with others upstream get them from zonal statistics
+        # over their own catchment
+        paths = self.upstream_aggregates(hydro_paths, name, raster, directory, clear)
+
+        f = open(os.path.join(watershed_path, 'watershed_paths.yml'))
+        w_paths = yaml.load(f.read())
+        f.close()
+
+        labels, pour_grid = self.backend.read_raster(w_paths['pour_points'])
+        rows, cols = np.nonzero(np.isfinite(labels))
+        ids = labels[rows, cols].astype(np.int64)
+
+        codes, grid, nodata = self.backend.open_raster(hydro_paths['flow_path'])
+        rows, cols = grid.cells(*pour_grid.centres(rows, cols))
+        keep = grid.inside(rows, cols)
+        rows, cols, ids = rows[keep], cols[keep], ids[keep]
+
+        values = {}
+        for f in UPSTREAM_FIELDS:
+            values[f] = np.asarray(self.backend.open_raster(paths[f])[0][rows, cols], dtype=float)
+        for f in ['sum', 'sq', 'n']:
+            values[f] = np.where(np.isfinite(values[f]), values[f], 0)
+
+        below = flow_grid.next_outlets(codes, rows * grid.shape[1] + cols)
+        nested = below >= 0
+        for f in ['sum', 'sq', 'n']:
+            own = values[f].copy()
+            np.subtract.at(values[f], below[nested], own[nested])
+
+        outer = np.unique(below[nested])
+        if outer.size:
+            print(str(outer.size)+' pour points have others upstream, taking their '+name+' max and min from zonal statistics')
+            watersheds = self.watershed_raster(watershed_path)
+            zones = os.path.join(table_directory, self.raster_name('_' + name + '_outer_zones'))
+            self.backend.extract_by_attributes(watersheds, 'VALUE IN('+','.join(map(str, ids[outer].tolist()))+')', zones)
+            table = self.zone_statistics(table_directory, zones, raster, name + '_outer')
+            local = dict((int(c_id), (z_max, z_min)) for c_id, z_max, z_min in self.backend.search_rows(table, ['VALUE', 'MAX', 'MIN']))
+            for i in outer.tolist():
+                if int(ids[i]) in local:
+                    values['max'][i], values['min'][i] = local[int(ids[i])]
+
+        count = values['n']
+        mean = values['sum'] / np.maximum(count, 1)
+        spread = np.sqrt(np.maximum(values['sq'] / np.maximum(count, 1) - mean * mean, 0))
+        cell_x, cell_y = grid.cell_size()
+
+        use = count > 0
+        columns = [ids, np.round(count).astype(np.int64), count * cell_x * cell_y, values['min'], values['max'],
+                   values['max'] - values['min'], mean, spread, values['sum']]
+        table_path = os.path.join(table_directory, name + '_data.csv')
+        return self.backend.write_table(table_path, gis_backend.ZONAL_FIELDS,
+                                        zip(*[np.asarray(c)[use].tolist() for c in columns]))
+
+    @traced
+    def do_bqart(self, pz_data, tz_data, ez_data, fault_data_path, fault_meta_data, uplift_rate, polygons, l_values, temp_val, precip_val, only = None):
 
         temps = {}
         precips = {}
@@ -828,176 +1594,36 @@ class GISbatch:
         min_reliefs = {}
         areas = {}
 
-        e_cursor = arcpy.SearchCursor(ez_data)
-        w_cursor = arcpy.SearchCursor(polygons)
-
         if pz_data:
-            t_cursor = arcpy.SearchCursor(tz_data)
-            p_cursor = arcpy.SearchCursor(pz_data)
-
-            for row in t_cursor:
-                # Get mean temperature
-                temps.update({row.getValue('VALUE'): row.getValue('MEAN')})
-
-            for row in p_cursor:
-                # Get mean precipitation
-                precips.update({row.getValue('VALUE'): row.getValue('MEAN')})
+            # Mean temperature and precipitation
+            temps.update(self.backend.search_rows(tz_data, ['VALUE', 'MEAN']))
+            precips.update(self.backend.search_rows(pz_data, ['VALUE', 'MEAN']))
 
-            del t_cursor
-            del p_cursor
-
-        for row in e_cursor:
+        for c_id, z_max, z_min in self.backend.search_rows(ez_data, ['VALUE', 'MAX', 'MIN']):
             # Get highest, lowest elevation & area of watersheds
-            max_reliefs.update({row.getValue('VALUE'): row.getValue('MAX')})
-            min_reliefs.update({row.getValue('VALUE'): row.getValue('MIN')})
+            max_reliefs.update({c_id: z_max})
+            min_reliefs.update({c_id: z_min})
         
-        for row in w_cursor:
-            c_id = row.getValue('GRIDCODE')
+        for c_id, area in self.backend.search_rows(polygons, ['GRIDCODE', 'AREA']):
             if c_id in areas:
-                areas[c_id] = areas[c_id] + float(row.getValue('AREA'))
+                areas[c_id] = areas[c_id] + float(area)
             else:
-                areas.update({c_id: float(row.getValue('AREA'))})
+                areas.update({c_id: float(area)})
 
             if temp_val and precip_val:
                 temps.update({c_id: float(temp_val)})
                 precips.update({c_id: float(precip_val)})
 
-        fault_data_output = {}
-        
         print('Adding fault data from')
-        if fault_data_path:
-            if os.path.exists(fault_data_path):
-                fault_data_output = {}
-                with open(fault_data_path, 'rb') as csvfile:
-                    fault_data = csv.reader(csvfile, delimiter=',')
-                    for row in fault_data:
-                        fault_data_output.update({row[0]: [row[1], row[2]]})
-        
-        # Unlock data
+        fault_data_output = load_fault_data(fault_data_path)
 
-        
-        del row
-        del e_cursor
-        del w_cursor
-        
-        # BQART
-        
-        qs_rows = []
-
-        
-        # Units!!
-
-        # Qs (kg/s)
-        # Qs (m^3/s)
-        # A (km^2)
-        # R (km)
-        # T (C)
-        
-        # precips are in mm
-        # temps are in C x 10
-        # relief is in m
-        # area is m^2
-        
-        # Are we ignoring any catchments?
-        
-        
-        for k in precips.keys():
- 
-            precip = precips[k] # mm/yr - yearly average
-            area_m_squared = areas[k] # m^2
-            relief = max_reliefs[k] - min_reliefs[k] # m
-
-            temp = temps[k]/10 # C - yearly average (Worldclim temps need to be divided by 10)
-            density = 2700 # kg/m^3
-            omega = 0.0006
-            
-            if l_values:
-                I = 1 # 
-                L = l_values[k] # Lithology factor
-                Te = 0
-                Eb = 1
-                B = I * L * (1 - Te) * Eb
-            else:
-                B = 1
-            
-            porosity = 0.3
-              
-            # Convert precipitation to m/yr
-            precip_m = precip / float(1000)
-            
-            # Relief to km
-            relief_km = relief / float(1000)
-            
-            # Convert area to km^2
-            area_km_squared = area_m_squared / float(1000000)
-            
-            # Discharge m^3/yr
-            precip_m3_yr = precip_m * float(area_m_squared)
-            
-            # Disharge m^3/s
-            Qw_s = precip_m3_yr / float(60*60*24*365)
-            
-            # Discharge km^3/yr
-            Qw_km_yr = math.pow(((Qw_s*(60*60*24*365))/1000000000),0.31)
-            
-            # Area
-            A = math.pow(area_km_squared, 0.5)
-            
-            if temp < 2:
-                # Qs in megatons per year
-                Qs_MT_yr = 2 * omega * B * Qw_km_yr * A * relief_km            
-            else:
-                Qs_MT_yr = omega * B * Qw_km_yr * A * relief_km * temp
-            
-            # Qs m^3/yr
-            Qs_m3_yr = Qs_MT_yr*((1000000000/density)*(1+porosity))
-
-            Qs_m_yr = Qs_m3_yr / float(area_m_squared)
-            
-            Qs_mm_yr = Qs_m_yr * float(1000)
-            
-            
-            qs = [k, precip, omega, B,precip_m3_yr, Qw_s, Qw_km_yr, area_km_squared, A, relief_km, temp, Qs_MT_yr, porosity, density, Qs_m3_yr, Qs_m_yr, Qs_mm_yr]
-            
-            if fault_data_output:
-                if fault_data_output[str(k)]:
-                    
-                    fault_id = fault_data_output[str(k)][0]
-                    # We're using max
-                    max_fault_slip_mm_yr = fault_meta_data[int(fault_id)]['slip_max']
-                    min_fault_slip_mm_yr = fault_meta_data[int(fault_id)]['slip_min']
-                    qs.append(max_fault_slip_mm_yr)
-                    qs.append(min_fault_slip_mm_yr)
-                    
-                    # fault slip (m)
-                    # corrected for density
-                    
-                    Q_tectonic_max = (area_m_squared * (max_fault_slip_mm_yr/float(1000)))
-                    Q_tectonic_min = (area_m_squared * (min_fault_slip_mm_yr/float(1000)))
-                    
-                    # Simple Qs
-                    qs.append(Q_tectonic_min)
-                    qs.append(Q_tectonic_max)
-                    
-                    # Fault number
-                    qs.append(fault_id)
-                    # Fault name
-                    qs.append(fault_meta_data[int(fault_id)]['name'])
-                    # Distance
-                    qs.append(fault_data_output[str(k)][1])
-            else:
-                Uplift_mm_yr = uplift_rate
-                Uplift_metres_yr = Uplift_mm_yr / float(1000)
-                Q_tectonic = area_m_squared * Uplift_metres_yr
-                qs.append(Uplift_mm_yr)
-                qs.append(Uplift_mm_yr)
-                qs.append(Q_tectonic)
-                qs.append(Q_tectonic)
-                
-            qs_rows.append(qs)
-            
-        return qs_rows
+        # BQART, see bqart.py for the units and the scalar reference. With
+        # only set, just those catchments
+        ids = [c_id for c_id in precips.keys() if only is None or c_id in only]
+        return bqart.bqart_table(ids, precips, temps, areas, max_reliefs, min_reliefs,
+                                 l_values, fault_data_output, fault_meta_data, uplift_rate)
 
+    @traced
     def fastscape_workflow(self, watershed_directory):
         f = open(os.path.join(watershed_directory, 'watershed_paths.yml'))
         w_paths = yaml.load(f.read())
@@ -1022,23 +1648,31 @@ class GISbatch:
 
         pp_coords = {}
 
-        for row in arcpy.da.SearchCursor(w_paths['pour_points_vector'], ["SHAPE@", "FID"]):
-            pp_x = row[0].extent.XMin
-            pp_y = row[0].extent.YMin
-            pp_coords.update({row[1]: [pp_x, pp_y]})
+        for row in self.backend.search_rows(w_paths['pour_points_vector'], ["SHAPE@EXTENT", "FID"]):
+            pp_coords.update({row[1]: [row[0][0], row[0][1]]})
 
         dat_rows = []
 
         dat_row_headers = ['id', 'pp_x', 'pp_y', 'xmin','xmax', 'ymax', 'ymin', 'b', 'r', 't', 'l']
 
-        for row in arcpy.da.SearchCursor(w_paths['ws_polygons'], ["SHAPE@", "GRIDCODE"]):
-            extent = row[0].extent
+        c_ids = []
+        extents = []
+
+        for row in self.backend.search_rows(w_paths['ws_polygons'], ["SHAPE@EXTENT", "GRIDCODE"]):
+            xmin, ymin, xmax, ymax = row[0]
             pp = pp_coords[row[1]]
-            xl, xr, yt, yb, bc, error = self.pp_position(pp[0], pp[1], extent.XMin, extent.XMax, extent.YMin, extent.YMax)
+            c_ids.append(row[1])
+            extents.append([pp[0], pp[1], xmin, xmax, ymin, ymax])
+
+        if extents:
+            e = np.array(extents, dtype=float)
+            xls, xrs, yts, ybs, bcs, errors = self.pp_positions(e[:, 0], e[:, 1], e[:, 2], e[:, 3], e[:, 4], e[:, 5])
 
-            if not error:
-                self.catchment_clip(xl,xr,yt,yb, watershed_directory, row[1])
-                dat_rows.append([row[1], pp[0], pp[1], xl, xr, yt, yb, int(bc[0]), int(bc[1]), int(bc[2]), int(bc[3])])
+            for i, c_id in enumerate(c_ids):
+                if not errors[i]:
+                    xl, xr, yt, yb, bc = float(xls[i]), float(xrs[i]), float(yts[i]), float(ybs[i]), str(bcs[i])
+                    self.catchment_clip(xl,xr,yt,yb, watershed_directory, c_id)
+                    dat_rows.append([c_id, e[i, 0], e[i, 1], xl, xr, yt, yb, int(bc[0]), int(bc[1]), int(bc[2]), int(bc[3])])
 
         catchment_dem_dir = os.path.join(watershed_directory, 'catchment_clips')
         clip_dat = os.path.join(catchment_dem_dir, 'clip_dat.csv')
@@ -1052,77 +1686,62 @@ class GISbatch:
 
     def pp_position(self, pp_x, pp_y, xmin, xmax, ymin, ymax):
 
-        tolerance = 100
-        tolerance_inc = 50
-        xy_pos = False
-
-        while (xy_pos == 'mid mid') | (xy_pos is False):
-
-            tolerance = tolerance+tolerance_inc
-            c_x_left = xmin
-            c_x_right = xmax
-            c_y_top = ymax
-            c_y_bottom = ymin
-
-            x_diff = 0
-            y_diff = 0
-
-            if pp_x > xmax-tolerance:
-                # PP is to the right
-                x_pos = 'right'
-                c_x_right = pp_x
-            elif pp_x < xmin+tolerance:
-                x_pos = 'left'
-                c_x_left = pp_x
-            else: # xmin < pp_x < xmax
-                # PP is within catchment x bounds
-                x_pos = 'mid'
-
-                ldiff = abs(pp_x-xmin)
-                rdiff = abs(pp_x-xmax)
-
-                if ldiff > rdiff:
-                    # Pad right
-                    x_diff = ldiff-rdiff
-                    c_x_right = c_x_right+x_diff
-                else:
-                    # Sub left
-                    x_diff = -(rdiff-ldiff)
-                    c_x_left = c_x_left+x_diff
-
-
-
-            if pp_y > ymax-tolerance:
-                # PP is above catchment
-                y_pos = 'top'
-                c_y_top = pp_y
-            elif pp_y < ymin+tolerance:
-                # PP is below catchment
-                y_pos = 'bottom'
-                c_y_bottom = pp_y
-            else: # ymin < pp_y < ymax
-                # PP is within catchment y bounds
-                y_pos = 'mid'
-
-                tdiff = abs(pp_y-ymax)
-                bdiff = abs(pp_y-ymin)
-
-                if tdiff > bdiff:
-                    # Sub bottom
-                    y_diff = -(tdiff-bdiff)
-                    c_y_bottom = c_y_bottom+y_diff
-                else:
-                    # Pad top
-                    y_diff = bdiff-tdiff
-                    c_y_top = c_y_top+y_diff
+        c_x_left, c_x_right, c_y_top, c_y_bottom, bc, error = self.pp_positions(
+            [pp_x], [pp_y], [xmin], [xmax], [ymin], [ymax])
 
+        return (float(c_x_left[0]), float(c_x_right[0]), float(c_y_top[0]),
+                float(c_y_bottom[0]), str(bc[0]), bool(error[0]))
 
+    def pp_positions(self, pp_x, pp_y, xmin, xmax, ymin, ymax):
+        # Classify every pour point against its catchment extent at once.
+        # The tolerance starts at 150 and grows by 50 until the pour point is
+        # no longer 'mid mid', so the first tolerance that works is the first
+        # step above the distance to the nearest extent edge.
 
-            xy_pos = x_pos+' '+y_pos
+        pp_x = np.asarray(pp_x, dtype=float)
+        pp_y = np.asarray(pp_y, dtype=float)
+        xmin = np.asarray(xmin, dtype=float)
+        xmax = np.asarray(xmax, dtype=float)
+        ymin = np.asarray(ymin, dtype=float)
+        ymax = np.asarray(ymax, dtype=float)
 
-        error = False
+        tolerance_start = 150
+        tolerance_inc = 50
 
-        bc = '0000'
+        edge_distance = np.minimum(np.minimum(xmax-pp_x, pp_x-xmin),
+                                   np.minimum(ymax-pp_y, pp_y-ymin))
+        valid = np.isfinite(edge_distance)
+        edge_distance = np.where(valid, edge_distance, 0)
+
+        steps = np.floor((edge_distance-tolerance_start) / tolerance_inc) + 1
+        tolerance = tolerance_start + tolerance_inc * np.maximum(steps, 0)
+
+        # Same comparisons as the original loop, so rounding at the edges can
+        # at most cost one extra step
+        x_pos, y_pos = self._pp_classes(pp_x, pp_y, xmin, xmax, ymin, ymax, tolerance)
+        retry = valid & (x_pos == 1) & (y_pos == 1)
+        if retry.any():
+            tolerance = np.where(retry, tolerance+tolerance_inc, tolerance)
+            x_pos, y_pos = self._pp_classes(pp_x, pp_y, xmin, xmax, ymin, ymax, tolerance)
+
+        # Mid positions pad the extent so the pour point sits in the middle
+        ldiff = np.abs(pp_x-xmin)
+        rdiff = np.abs(pp_x-xmax)
+        tdiff = np.abs(pp_y-ymax)
+        bdiff = np.abs(pp_y-ymin)
+
+        c_x_left = np.where(x_pos == 0, pp_x, xmin)
+        c_x_right = np.where(x_pos == 2, pp_x, xmax)
+        c_y_top = np.where(y_pos == 0, pp_y, ymax)
+        c_y_bottom = np.where(y_pos == 2, pp_y, ymin)
+
+        x_mid = x_pos == 1
+        c_x_right = np.where(x_mid & (ldiff > rdiff), xmax+(ldiff-rdiff), c_x_right)
+        c_x_left = np.where(x_mid & (ldiff <= rdiff), xmin-(rdiff-ldiff), c_x_left)
+
+        y_mid = y_pos == 1
+        c_y_bottom = np.where(y_mid & (tdiff > bdiff), ymin-(tdiff-bdiff), c_y_bottom)
+        c_y_top = np.where(y_mid & (tdiff <= bdiff), ymax+(bdiff-tdiff), c_y_top)
 
         # Boundaries:
         # Bottom
@@ -1130,27 +1749,26 @@ class GISbatch:
         # Top
         # Left
 
-        if xy_pos == 'left top':
-            bc = '0022'
-        elif xy_pos == 'right top':
-            bc = '0220'
-        elif xy_pos == 'left bottom':
-            bc = '2002'
-        elif xy_pos == 'right bottom':
-            bc = '2200'
-        elif xy_pos == 'left mid':
-            bc = '0003'
-        elif xy_pos == 'right mid':
-            bc = '0300'
-        elif xy_pos == 'mid top':
-            bc = '0030'
-        elif xy_pos == 'mid bottom':
-            bc = '3000'
-        elif xy_pos == 'mid mid':
-            error = True
+        # Rows are left, mid, right. Columns are top, mid, bottom
+        boundary_codes = np.array([
+            ['0022', '0003', '2002'],
+            ['0030', '0000', '3000'],
+            ['0220', '0300', '2200']
+        ])
+
+        bc = boundary_codes[x_pos, y_pos]
+        error = ~valid | (x_mid & y_mid)
 
         return c_x_left, c_x_right, c_y_top, c_y_bottom, bc, error
 
+    def _pp_classes(self, pp_x, pp_y, xmin, xmax, ymin, ymax, tolerance):
+        # 0 = left/top, 1 = mid, 2 = right/bottom
+        x_pos = np.where(pp_x > xmax-tolerance, 2, np.where(pp_x < xmin+tolerance, 0, 1))
+        y_pos = np.where(pp_y > ymax-tolerance, 0, np.where(pp_y < ymin+tolerance, 2, 1))
+
+        return x_pos, y_pos
+
+    @traced
     def catchment_clip(self, xmin,xmax,ymin,ymax, parent_directory, fid):
 
         catchment_dem_dir = os.path.join(parent_directory, 'catchment_clips')
@@ -1167,10 +1785,10 @@ class GISbatch:
                 d = 1
                 ok = True
 
-        rect = ' '.join(map(str, [xmin, ymin, xmax, ymax]))
-        arcpy.Clip_management(self.original_dem, rect, raster_name)
+        self.backend.clip(self.original_dem, raster_name, (xmin, ymin, xmax, ymax))
 
 
+    @traced
     def save_data_to_csv(self, qs_data, path, ignore, scenario, w_paths):
         data_name = scenario+'_data.csv'
         row_headers = ['id', 'precipitation (mm/yr)', 'w', 'B', 'Discharge', 'Qw (m^3/s)', 'Qw (km^3/yr)', 'A (km^2)', 'A^0.5', 
@@ -1185,47 +1803,16 @@ class GISbatch:
             row_headers.append('distance')
         
         data_path = os.path.join(path, data_name)
-        
-        if self.min_area:
-            r_qs_data = qs_data
-            qs_data = []
-            for r in r_qs_data:
-                area_m2 = r[7] * float(1000000)
-                if area_m2 > self.min_area:
-                    qs_data.append(r)
 
         fan_toe_lengths = False
-        if w_paths['fan_toes']:
+        if w_paths.get('fan_toes'):
             reader = csv.reader(open(w_paths['fan_toes'], 'rb'))
             fan_toe_lengths = dict(reader)
             row_headers.append('fan length')
 
-        catchment_data = {}
-        catchment_ids = []
-
-        with open(data_path, 'wb') as qs_file:
-            a = csv.writer(qs_file, delimiter=',')
-            a.writerow(row_headers)
-            if ignore:
-                for r in qs_data:
-                    if not r[0] in ignore:
-                        catchment_ids.append(r[0])
-
-                        if fan_toe_lengths:
-                            r.append(fan_toe_lengths[str(int(r[0]))])
-
-                        catchment_data[r[0]] = r
-                        a.writerow(r)
-            else:
-                for r in qs_data:
-                    catchment_ids.append(r[0])
+        catchment_ids, catchment_data = bqart.save_table(qs_data, data_path, row_headers, ignore,
+                                                         self.min_area, fan_toe_lengths)
 
-                    if fan_toe_lengths:
-                        r.append(fan_toe_lengths[str(int(r[0]))])
-
-                    catchment_data[r[0]] = r
-                    a.writerow(r)
-                    
         print('Data saved to '+data_path)
         return catchment_ids, catchment_data
         
@@ -1243,37 +1830,31 @@ class GISbatch:
         return ignore
         
     
+    @traced
     def process_lithology(self, watershed_polygons, lithology, save_directory):
         
         intersections = os.path.join(save_directory, 'lith_intersections.shp')
         lithology_data = os.path.join(save_directory, 'lithologies.csv')
-        arcpy.Intersect_analysis ([watershed_polygons, lithology], intersections, "ALL", "", "")
-        arcpy.AddField_management(intersections, 'LITH_AREA', "LONG")
-        arcpy.CalculateField_management(intersections, 'LITH_AREA', '!SHAPE.AREA@SQUAREMETERS!', "PYTHON_9.3")     
-        
-        intObj = arcpy.SearchCursor(intersections)
+        self.backend.intersect([watershed_polygons, lithology], intersections)
+        self.backend.calculate_area(intersections, 'LITH_AREA', "LONG")
 
         i = 0
         row_headers = ['id', 'catchment', 'lith', 'total area', 'lith area', 'label', 'age', 'rocktype 1', 'rocktype 2', '%']
-        fieldnames = [field.name for field in arcpy.ListFields(intersections)]
+        fieldnames = self.backend.field_names(intersections)
+        fields = ['GRIDCODE', fieldnames[6], 'AREA', 'LITH_AREA', fieldnames[11],
+                  fieldnames[15], fieldnames[16], fieldnames[17]]
         cols = []
         
-        for row in intObj:
+        for gridcode, lith, area, lith_area, label, age, rock_1, rock_2 in self.backend.search_rows(intersections, fields):
             i = i+1
-            percent_cover = (float(row.getValue('LITH_AREA')) / float(row.getValue('AREA'))) * 100
-            cols.append([i,int(row.getValue('GRIDCODE')), row.getValue(fieldnames[6]), 
-                row.getValue('AREA'), row.getValue('LITH_AREA'),
-                row.getValue(fieldnames[11]), row.getValue(fieldnames[15]), 
-                row.getValue(fieldnames[16]), row.getValue(fieldnames[17]), percent_cover])
+            percent_cover = (float(lith_area) / float(area)) * 100
+            cols.append([i, int(gridcode), lith, area, lith_area, label, age, rock_1, rock_2, percent_cover])
                  
         with open(lithology_data, 'wb') as qs_file:
             a = csv.writer(qs_file, delimiter=',')
             a.writerow(row_headers)
             for r in cols:
                 a.writerow(r) 
-
-
-        del intObj
         
         lith_values = False
         
@@ -1283,14 +1864,15 @@ class GISbatch:
             
             if not self.lithology_values:
                 print('Lithology values not yet specified:')
-                p1 = shell.Prompt("Path to lithology values")
-                if os.path.exists(p1.input):
-                    lith_path = p1.input
+                p1 = self.spec.prompt("Path to lithology values")
+                if os.path.exists(p1):
+                    lith_path = p1
             else:
                 if os.path.exists(self.lithology_values):
                     lith_path = self.lithology_values
                 else:
                     print('File does not exist')
+                    self.lithology_values = ''
             
             if lith_path:
                 lith_values = {}
@@ -1350,7 +1932,25 @@ class GISbatch:
         del r
 
         return l_values
+
+    def load_lithology_values(self, lithology_data):
+        # Per-catchment L values from a lithologies.csv written by process_lithology
+        catchment_lithologies = {}
+
+        with open(lithology_data, 'rb') as csvfile:
+            segment_rows = csv.reader(csvfile, delimiter=',')
+            for row in segment_rows:
+                try:
+                    c_id = int(row[1])
+                    l_segment = float(row[10]) * (float(row[9])/100)
+                except (ValueError, IndexError):
+                    continue
+
+                catchment_lithologies[c_id] = catchment_lithologies.get(c_id, 0) + l_segment
+
+        return catchment_lithologies
         
+    @traced
     def extract_catchments(self, polygons, catchment_ids, catchment_data, climate_batch_path, climate_scenario, ignore):
         
         ws_extracted_name = 'catchments_'+climate_scenario+'.shp'
@@ -1372,297 +1972,897 @@ class GISbatch:
         comma = ','
         id_string = comma.join(ok_catchments)
         
-        arcpy.Select_analysis(polygons, ws_extracted_path, '"GRIDCODE" IN('+id_string+')')
+        self.backend.select(polygons, ws_extracted_path, '"GRIDCODE" IN('+id_string+')')
 
         ws_headers = ['precip', 'B', 'Qw', 'R_km', 'temp', 'Qs', 'erosion', 'slip_min', 'slip_max']
         
         for wh in ws_headers:
-            arcpy.AddField_management(ws_extracted_path, wh, "FLOAT")
-        
-        fields = ("GRIDCODE",'precip', 'B', 'Qw', 'R_km', 'temp', 'Qs', 'erosion', 'slip_min', 'slip_max')
-        
-        with arcpy.da.UpdateCursor(ws_extracted_path, fields) as cursor:
-            for r in cursor:
-                gcode = r[0]
-                if gcode in catchment_data:
-                    c_dat = catchment_data[gcode]
-                    r[1] = c_dat[1] # Precipitation
-                    r[2] = c_dat[3] # B
-                    r[3] = c_dat[5] # Qw
-                    r[4] = c_dat[9] # R_km
-                    r[5] = c_dat[10] # temp
-                    r[6] = c_dat[14] # Qs
-                    r[7] = c_dat[16] # erosion
-                    r[8] = c_dat[17] # slip_min
-                    r[9] = c_dat[18] # slip_max
-                    cursor.updateRow(r)
-          
+            self.backend.add_field(ws_extracted_path, wh, "FLOAT")
         
+        # Precipitation, B, Qw, R_km, temp, Qs, erosion, slip_min, slip_max
+        columns = [1, 3, 5, 9, 10, 14, 16, 17, 18]
+        values = {}
+        for gcode, c_dat in catchment_data.items():
+            values[gcode] = [c_dat[c] for c in columns]
         
+        self.backend.update_rows(ws_extracted_path, "GRIDCODE", ws_headers, values)
+          
         
-def save_last_run(root, key, val):
-    
-    last_run_path = os.path.join(root, 'last_run.yml')
-    
-    if os.path.isfile(last_run_path):
-        f = open(last_run_path)
-        last_run = yaml.load(f.read())
-        f.close()
-    else:
-        last_run = {}
         
-    last_run.update({key: val})
-    
-    with open(last_run_path, 'w') as outfile:
-        outfile.write(yaml.dump(last_run, default_flow_style=True))
-
         
-def load_last_run(root):
-    # Check if last run exists
-    last_run = False
+def ensure_directory(path):
+    # makedirs that doesn't mind another job making the directory first
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
 
-    if os.path.exists(os.path.join(root, 'last_run.yml')):
-        f = open(os.path.join(root, 'last_run.yml'))
-        last_run = yaml.load(f.read())
-        f.close()
-    
-    return last_run
 
-def select_batch_directory(root_dir):
-    os.chdir(root_dir)
+def make_batch_directory(parent, suffix = ''):
+    # <timestamp>_<pid><suffix>. Jobs sharing a root can start batches in
+    # the same second, the process ID keeps them apart and a name that
+    # is taken anyway gets a counter
+    ensure_directory(parent)
+    t = datetime.datetime.now()
+    name = '_'.join(map(str, [t.year, t.month, t.day, t.hour, t.minute, t.second, os.getpid()]))
+    n = 0
+    while True:
+        path = os.path.join(parent, name + ('-' + str(n) if n else '') + suffix)
+        try:
+            os.mkdir(path)
+            return path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            n = n + 1
+
+
+def load_fault_data(fault_data_path):
+    # Fault ID and position along it for each catchment, by catchment ID
+    fault_data_output = {}
+    if fault_data_path and os.path.exists(fault_data_path):
+        with open(fault_data_path, 'rb') as csvfile:
+            for row in csv.reader(csvfile, delimiter=','):
+                fault_data_output.update({row[0]: [row[1], row[2]]})
+
+    return fault_data_output
+
+
+def month_number(path):
+    # Monthly rasters sorted by the last number in their name, so prec_10
+    # comes after prec_9
+    numbers = re.findall(r'\d+', os.path.splitext(os.path.basename(path))[0])
+    return (int(numbers[-1]) if numbers else 0, os.path.basename(path))
+
+
+def open_catalogue(yaml_config):
+    return run_catalogue.RunCatalogue(yaml_config.get('catalogue') or os.path.join(yaml_config['root'], CATALOGUE_NAME))
+
+
+def last_run_settings(catalogue, yaml_config):
+    # The hydro batch of this project made or picked most recently, and the
+    # watershed batch last used within it
+    settings = {}
+    hydro = catalogue.latest(kind='hydro', project=yaml_config['project_name'],
+                             directory=yaml_config['output'], order='used')
+    if hydro:
+        settings['hydro_batch'] = hydro['path']
+        watersheds = catalogue.latest(kind='watershed', parent=hydro['path'], order='used')
+        if watersheds:
+            settings['watershed_batch'] = watersheds['path']
+
+    return settings
+
+
+def describe_run(run):
+    details = [run['status']]
+    if run['finished']:
+        details.append(run['finished'])
+    if run['scenario']:
+        details.append(run['scenario'])
+
+    return os.path.basename(run['path'])+' ('+', '.join(details)+')'
+
+
+def select_batch_directory(root_dir, catalogue, spec):
+    # One numbered prompt with the catalogued batches in root_dir, newest
+    # first, then any batches on disk made before the catalogue
+    options = []
+    paths = []
+    for run in catalogue.runs(directory=root_dir):
+        if os.path.isdir(run['path']):
+            options.append(describe_run(run))
+            paths.append(run['path'])
+
+    known = set(paths)
+    for name in batch_directories(root_dir):
+        path = run_catalogue.normalise(os.path.join(root_dir, name))
+        if path not in known:
+            options.append(name+' (not catalogued)')
+            paths.append(path)
+
+    if not options:
+        raise RunSpecError('No batches found in '+root_dir)
+
+    choice = spec.prompt("Pick batch", options = options, numbered = True)
+
+    return paths[options.index(choice)]
+
+
+def batch_directories(root_dir):
+    # Timestamped batches, newest first, ignoring anything that isn't one.
+    # Newer names carry the process ID after the six timestamp parts
     times = {}
-    days = {}
-    
-    for dir_name in glob.glob("*"):
-        t_frags = dir_name.split('_')
-        t_int = map(int, t_frags)
-        dt = datetime.datetime(t_int[0], t_int[1], t_int[2], t_int[3], t_int[4], t_int[5])
-        times.update({dir_name: dt})
-        ds = '_'.join([t_frags[0], t_frags[1], t_frags[2]])
-        days.update({ds:{}})
-                
-    for k in times.keys():
-        t_frags = k.split('_')
-        ds = '_'.join([t_frags[0], t_frags[1], t_frags[2]])
-        t_string = times[k].strftime("%H:%M:%S")
-        days[ds].update({t_string:k})
-    
-    d_strings = []
-    d_frag_list = []
-    
-    # Ask which days
-    for k in days:
-        d_frags = k.split('_')
-        d_int = map(int, d_frags)
-        dt = datetime.datetime(d_int[0], d_int[1], d_int[2])
-        d_strings.append(dt.strftime("%a %b %d %Y"))
-        d_frag_list.append(k)
-    
-    
-    p1 = shell.Prompt("Pick batch day", options = d_strings, numbered = True)
-    
-    # Ask which times
-    d_index = d_strings.index(p1.input)
-    d_choice = days[d_frag_list[d_index]]
-    
-    p2 = shell.Prompt("Pick batch time", options = d_choice.keys(), numbered = True)   
-    
-    choice = d_choice[p2.input]
-    
-    return choice
 
-         
-try:
-    app.setup()
-    
-    app.run()
-    
-    if app.pargs.config:
+    for dir_name in os.listdir(root_dir):
+        if not os.path.isdir(os.path.join(root_dir, dir_name)):
+            continue
         try:
-            f = open(app.pargs.config)
-            yaml_config = yaml.load(f.read())
-            f.close()
+            t_int = [int(t) for t in dir_name.split('_')[:6]]
+            times[dir_name] = datetime.datetime(t_int[0], t_int[1], t_int[2], t_int[3], t_int[4], t_int[5])
+        except (ValueError, IndexError):
+            continue
 
-            if app.custom_pour_points == 1:
-                while not os.path.exists(app.pargs.custom_pp):
-                    p = shell.Prompt("Custom pour points:")
-                    app.pargs.custom_pp = p.input
-
-            last_settings = load_last_run(yaml_config['root'])
-            hydro_batch = False
-            watershed_batch = False
-            clear_cache = False
-
-
-            if last_settings:
-                p = shell.Prompt("Use last used settings?", ['y','n'])
-                if p.input is 'y':
-                    if 'hydro_batch' in last_settings:
-                        hydro_batch = last_settings['hydro_batch']
-                      
-                    if 'watershed_batch' in last_settings:
-                        watershed_batch = last_settings['watershed_batch']          
-                else:
-                    clear_cache = True
-            
-            
-            if app.skip_to_discharge == 0:
-                if app.skip_to_watersheds == 0:
-                    gbatch = GISbatch(yaml_config)
-                    hydro_paths = gbatch.hydro_workflow()
-                    save_last_run(yaml_config['root'], 'hydro_batch', os.path.dirname(os.path.realpath(hydro_paths['working_dem'])))
-                else:
-                    try:
-                        
-                        if hydro_batch:
-                            # Using last used hydro_batch
-                            gbatch = GISbatch(yaml_config, hydro_batch)
-                            hydro_file_path = os.path.join(hydro_batch, 'hydro_paths.yml')
-                        else:
-                            print 'Pick hydro path batch'
-                            tchoice = select_batch_directory(os.path.join(yaml_config['root'], 'Output'))
-                            batch = os.path.join(yaml_config['root'], 'Output', tchoice)
-                            gbatch = GISbatch(yaml_config, batch)
-                            hydro_file_path = os.path.join(gbatch.batch_path, 'hydro_paths.yml')
-                            
-                        if os.path.exists(hydro_file_path):
-                            f = open(hydro_file_path)
-                            hydro_paths = yaml.load(f.read())
-                            f.close()
-                        else:
-                            print('Cannot find '+ hydro_file_path)
-                            hydro_paths_exists = 0
-                            while hydro_paths_exists == 0:
-                                p = shell.Prompt("Path to hydro_paths config file: ")
-                                if os.path.exists(p.input):
-                                    f = open(p.input)
-                                    hydro_paths = yaml.load(f.read())
-                                    f.close()
-                                    hydro_paths_exists = 1
-                                else:
-                                    print('File does not exist!')
-                                    
-                        save_last_run(yaml_config['root'], 'hydro_batch', os.path.dirname(os.path.realpath(hydro_file_path)))
-                        
-                    except (OSError, IOError) as e:
-                        print(e)
-                        exit
+    return sorted(times, key=lambda k: (times[k], k), reverse=True)
 
-                if app.custom_pour_points == 1:
-                    gbatch.pour_points_path = app.pargs.custom_pp
 
-                if os.path.exists(gbatch.pour_points_path):
-                    pour_point_path = gbatch.pour_points_path
-                else:
-                    pour_point_path = 0
-                    process_faults = 0
-                    
-                    if gbatch.fault_path:
-                        if os.path.exists(gbatch.fault_path):
-                            process_faults = 1
-                        
-                    if process_faults:
-                        pour_point_path = gbatch.fault_workflow(gbatch.fault_path, hydro_paths)
-                        save_last_run(yaml_config['root'], 'fault_data', os.path.dirname(os.path.realpath(pour_point_path)))
-                    else:
-                        while pour_point_path == 0:
-                            p = shell.Prompt("Path to pour point shapefile: ")
-                            if os.path.exists(p.input):
-                                pour_point_path = p.input
-                            else:
-                                print('File does not exist!')
+def latest_batch_directory(root_dir, catalogue):
+    # Newest complete catalogued batch. Directories alone can't say whether
+    # another job is still writing to them, so they are never picked as latest
+    latest = catalogue.latest(directory=root_dir)
+    if latest:
+        return latest['path']
 
-                watershed_raster = gbatch.watershed_workflow(pour_point_path, hydro_paths)
-                watershed_directory = os.path.dirname(os.path.realpath(watershed_raster))
-                
-            else: # Skip to discharge calculations
+    return False
+
+
+def resolve_batch_directory(root_dir, choice, spec, catalogue):
+    # choice can be a path, a batch name, 'latest' or nothing to ask
+    if choice == 'latest':
+        latest = latest_batch_directory(root_dir, catalogue)
+        if not latest:
+            raise RunSpecError('No complete catalogued batches in '+root_dir+', name the batch to use instead')
+        return latest
+
+    if choice:
+        batch = choice if os.path.isabs(choice) else os.path.join(root_dir, choice)
+        if not os.path.isdir(batch):
+            raise RunSpecError('Cannot find batch '+batch)
+        return batch
+
+    if spec.headless:
+        raise RunSpecError('Headless run needs a batch from '+root_dir+', add it to the run spec')
+
+    return select_batch_directory(root_dir, catalogue, spec)
+
+
+def load_hydro_batch(yaml_config, hydro_batch, spec):
+    if not hydro_batch:
+        print('Pick hydro path batch')
+
+    catalogue = open_catalogue(yaml_config)
+    batch = resolve_batch_directory(os.path.join(yaml_config['root'], 'Output'), hydro_batch, spec, catalogue)
+    gbatch = GISbatch(yaml_config, batch, spec)
+    hydro_file_path = os.path.join(gbatch.batch_path, 'hydro_paths.yml')
+
+    if os.path.exists(hydro_file_path):
+        f = open(hydro_file_path)
+        hydro_paths = yaml.load(f.read())
+        f.close()
+    else:
+        print('Cannot find '+ hydro_file_path)
+        hydro_paths_exists = 0
+        while hydro_paths_exists == 0:
+            p = spec.prompt("Path to hydro_paths config file: ")
+            if os.path.exists(p):
+                f = open(p)
+                hydro_paths = yaml.load(f.read())
+                f.close()
+                hydro_paths_exists = 1
+            else:
+                print('File does not exist!')
+
+    catalogue.mark_used(gbatch.batch_path, 'hydro', gbatch.project_name, gbatch.output_path)
+    catalogue.close()
+
+    # Batches made with persist only have some of their outputs on disk,
+    # stop before any processing if the mode needs one that isn't
+    persisted = hydro_paths.get('persisted', HYDRO_OUTPUTS)
+    missing = [key for key in hydro_requirements(yaml_config, spec) if key not in persisted]
+    if missing:
+        raise RunSpecError(spec.mode+' runs need '+', '.join(missing)+' persisted in hydro batch '+gbatch.batch_path)
+
+    for key in HYDRO_OUTPUTS:
+        if key not in persisted:
+            print(key+' was not persisted in this batch')
+
+    return gbatch, hydro_paths
+
+
+def hydro_requirements(yaml_config, spec):
+    # Hydro outputs a mode reads from a reused hydro batch
+    if spec.mode == 'sweep':
+        return ['flow_path', 'flow_acc_path']
+
+    if spec.mode == 'process_watersheds':
+        needs = ['flow_path', 'flow_acc_path']
+        pour_points = spec.pour_points or yaml_config.get('pour_points_path')
+        # Pour points are found from the faults and the stream vectors
+        if not (pour_points and os.path.exists(pour_points)):
+            needs.append('vector_streams')
+        return needs
+
+    if spec.mode == 'calculate_bqart' and yaml_config.get('catchment_stats') == 'upstream':
+        return ['flow_path']
+
+    return []
+
+
+def run_project(yaml_config, spec, limits = None):
+    # One project run. All state comes from the config and run spec so
+    # several runs can share a process pool without sharing globals
+    if limits is None:
+        limits = StageLimits()
+
+    if spec.mode == 'update':
+        return run_incremental(yaml_config, spec, limits)
+    if spec.mode == 'preview':
+        return run_preview(yaml_config, spec)
+    if spec.mode == 'sweep':
+        return run_sweep(yaml_config, spec)
+    if spec.mode == 'runs':
+        return list_runs(yaml_config, spec)
+    if spec.mode == 'compare':
+        return run_compare(yaml_config, spec)
+
+    skip_to_watersheds, skip_to_discharge, fastscape_process = spec.stage_flags()
+
+    if spec.mode == 'custom_pour_points':
+        while not spec.custom_pour_points or not os.path.exists(spec.custom_pour_points):
+            spec.custom_pour_points = spec.prompt("Custom pour points:")
+
+    catalogue = open_catalogue(yaml_config)
+    last_settings = last_run_settings(catalogue, yaml_config)
+    catalogue.close()
+    hydro_batch = spec.hydro_batch
+    watershed_batch = spec.watershed_batch
+    clear_cache = spec.cache == 'clear'
+
+    if last_settings and not (hydro_batch or watershed_batch):
+        use_last_run = spec.use_last_run
+        if use_last_run is None:
+            use_last_run = spec.prompt("Use last used settings?", ['y','n']) == 'y'
+            if not use_last_run and spec.cache is None:
+                clear_cache = True
+
+        if use_last_run:
+            if 'hydro_batch' in last_settings:
+                hydro_batch = last_settings['hydro_batch']
+              
+            if 'watershed_batch' in last_settings:
+                watershed_batch = last_settings['watershed_batch']          
+    
+    
+    # The trace is saved even when a stage fails
+    gbatch = None
+    try:
+        if skip_to_discharge == 0:
+            if skip_to_watersheds == 0:
+                gbatch = GISbatch(yaml_config, False, spec)
+                with limits.hold('hydro'):
+                    hydro_paths = gbatch.hydro_workflow()
+            else:
+                gbatch, hydro_paths = load_hydro_batch(yaml_config, hydro_batch, spec)
+
+            if spec.mode == 'custom_pour_points':
+                gbatch.pour_points_path = spec.custom_pour_points
+            elif spec.pour_points:
+                gbatch.pour_points_path = spec.pour_points
 
-                hydro_paths = 0
-                watershed_raster = 0
+            if os.path.exists(gbatch.pour_points_path):
+                pour_point_path = gbatch.pour_points_path
+            else:
+                pour_point_path = 0
+                process_faults = 0
+            
+                if gbatch.fault_path:
+                    if os.path.exists(gbatch.fault_path):
+                        process_faults = 1
                 
-                if hydro_batch:
-                    # Using last used hydro_batch
-                    gbatch = GISbatch(yaml_config, hydro_batch)
-                    hydro_file_path = os.path.join(hydro_batch, 'hydro_paths.yml')
+                if process_faults:
+                    pour_point_path = gbatch.fault_workflow(gbatch.fault_path, hydro_paths)
                 else:
-                    print 'Pick hydro path batch'
-                    tchoice = select_batch_directory(os.path.join(yaml_config['root'], 'Output'))
-                    batch = os.path.join(yaml_config['root'], 'Output', tchoice)
-                    gbatch = GISbatch(yaml_config, batch)
-                    hydro_file_path = os.path.join(gbatch.batch_path, 'hydro_paths.yml')
-                    
-                if os.path.exists(hydro_file_path):
-                    f = open(hydro_file_path)
-                    hydro_paths = yaml.load(f.read())
-                    f.close()
-                else:
-                    print('Cannot find '+ hydro_file_path)
-                    hydro_paths_exists = 0
-                    while hydro_paths_exists == 0:
-                        p = shell.Prompt("Path to hydro_paths config file: ")
-                        if os.path.exists(p.input):
-                            f = open(p.input)
-                            hydro_paths = yaml.load(f.read())
-                            f.close() 
-                            hydro_paths_exists = 1
+                    while pour_point_path == 0:
+                        p = spec.prompt("Path to pour point shapefile: ")
+                        if os.path.exists(p):
+                            pour_point_path = p
                         else:
                             print('File does not exist!')
-                            
-                h_dir = os.path.dirname(os.path.realpath(hydro_file_path))
-                save_last_run(yaml_config['root'], 'hydro_batch', h_dir)
-                
-                if watershed_batch:
-                     watershed_directory = watershed_batch
-                     watershed_raster = os.path.join(watershed_directory, 
-                                gbatch.project_name + '_watersheds.tif')    
-                else:
-                    print 'Pick watershed path batch'
-                    watershed_calcs = os.path.join(h_dir, 'watershed_calcs')
-                    
-                    tchoice = select_batch_directory(watershed_calcs)
-                    
-                    watershed_raster = os.path.join(watershed_calcs, tchoice, 
-                                gbatch.project_name + '_watersheds.tif')
-                    
-                    watershed_directory = os.path.dirname(os.path.realpath(watershed_raster))
-                    save_last_run(yaml_config['root'], 'watershed_batch', watershed_directory)
 
-            if app.fastscape_process == 1: # Prepare watersheds for fastscape
-                gbatch.fastscape_workflow(watershed_directory)
-            else:
-                # Pick climate scenario
-                climate_by_name = {}
-                climate_names = []
-                for c in gbatch.climates:
-                    climate_by_name.update({c['name']: c})
-                    climate_names.append(c['name'])
+            with limits.hold('hydro'):
+                watershed_raster = gbatch.watershed_workflow(pour_point_path, hydro_paths)
+            watershed_directory = os.path.dirname(os.path.realpath(watershed_raster))
+        
+        else: # Skip to discharge calculations
 
-                if gbatch.climate_basic:
-                    for c in gbatch.climate_basic:
-                        climate_by_name.update({'_basic_'+c['name']: c})
-                        climate_names.append('_basic_'+c['name'])
+            gbatch, hydro_paths = load_hydro_batch(yaml_config, hydro_batch, spec)
+            h_dir = gbatch.batch_path
 
-                p = shell.Prompt("Pick climate scenario", options = climate_names, numbered = True)
+            if not watershed_batch:
+                print('Pick watershed path batch')
 
-                climate_scenario = climate_by_name[p.input]
+            watershed_calcs = os.path.join(h_dir, 'watershed_calcs')
+            catalogue = open_catalogue(yaml_config)
+            watershed_directory = os.path.realpath(resolve_batch_directory(watershed_calcs, watershed_batch, spec, catalogue))
+            watershed_raster = gbatch.watershed_raster(watershed_directory)
+            catalogue.mark_used(watershed_directory, 'watershed', gbatch.project_name, h_dir)
+            catalogue.close()
 
-                if p.input.startswith('_basic_'):
-                    temp = climate_scenario['temp']
-                    precip = climate_scenario['precip']
-                else:
-                    temp = climate_scenario['temp_directory']
-                    precip = climate_scenario['precip_directory']
+        if fastscape_process == 1: # Prepare watersheds for fastscape
+            gbatch.fastscape_workflow(watershed_directory)
+        else:
+            for scenario_name, temp, precip in pick_climate_scenarios(gbatch, spec):
+                with limits.hold('climate'):
+                    gbatch.bqart_workflow(watershed_raster, hydro_paths,
+                                          watershed_directory, temp,
+                                          precip, scenario_name, clear_cache)
+
+    finally:
+        if gbatch is not None:
+            gbatch.save_trace()
+
+
+def pick_climate_scenarios(gbatch, spec):
+    climate_by_name = {}
+    climate_names = []
+    for c in gbatch.climates:
+        climate_by_name.update({c['name']: c})
+        climate_names.append(c['name'])
+
+    if gbatch.climate_basic:
+        for c in gbatch.climate_basic:
+            climate_by_name.update({'_basic_'+c['name']: c})
+            climate_names.append('_basic_'+c['name'])
+
+    scenario_names = spec.scenarios
+    if not scenario_names:
+        scenario_names = [spec.prompt("Pick climate scenario", options = climate_names, numbered = True)]
+
+    scenarios = []
+    for scenario_name in scenario_names:
+        climate_scenario = climate_by_name[scenario_name]
+
+        if scenario_name.startswith('_basic_'):
+            scenarios.append([scenario_name, climate_scenario['temp'], climate_scenario['precip']])
+        else:
+            scenarios.append([scenario_name, climate_scenario['temp_directory'], climate_scenario['precip_directory']])
+
+    return scenarios
+
+
+def run_incremental(yaml_config, spec, limits):
+    # Reuse a batch and rerun only the stages downstream of whatever changed
+    output_dir = yaml_config['output']
+    catalogue = open_catalogue(yaml_config)
+
+    if os.path.isdir(output_dir) and (spec.hydro_batch or latest_batch_directory(output_dir, catalogue)):
+        batch = resolve_batch_directory(output_dir, spec.hydro_batch or 'latest', spec, catalogue)
+        gbatch = GISbatch(yaml_config, batch, spec)
+    else:
+        gbatch = GISbatch(yaml_config, False, spec)
+
+    # The trace is saved even when a stage fails
+    try:
+        # Stale outputs get rewritten in place
+        gbatch.backend.overwrite_outputs()
+        exists = gbatch.backend.exists
 
+        hydro_graph = StageGraph(yaml_config, os.path.join(gbatch.batch_path, 'stages.yml'), exists = exists)
+        hydro_file_path = os.path.join(gbatch.batch_path, 'hydro_paths.yml')
+        hydro_paths = False
+
+        if os.path.exists(hydro_file_path):
+            f = open(hydro_file_path)
+            hydro_paths = yaml.load(f.read())
+            f.close()
+
+        # Later stages read these, so hydrology reruns if they were kept in memory
+        if hydro_paths and hydro_graph.is_current('hydro', dict((k, hydro_paths[k]) for k in
+                                                          ['flow_path', 'flow_acc_path', 'vector_streams'])):
+            print('Hydrology up to date')
+        else:
+            with limits.hold('hydro'):
+                hydro_paths = gbatch.hydro_workflow()
+            hydro_graph.record('hydro', dict((k, hydro_paths[k]) for k in hydro_paths['persisted']))
+
+        catalogue.mark_used(gbatch.batch_path, 'hydro', gbatch.project_name, output_dir)
+
+        if spec.custom_pour_points:
+            gbatch.pour_points_path = spec.custom_pour_points
+        elif spec.pour_points:
+            gbatch.pour_points_path = spec.pour_points
+
+        if gbatch.pour_points_path and os.path.exists(gbatch.pour_points_path):
+            pour_point_path = gbatch.pour_points_path
+            hydro_graph.skip('faults')
+        elif gbatch.fault_path and os.path.exists(gbatch.fault_path):
+            if hydro_graph.is_current('faults'):
+                print('Fault data up to date')
+                pour_point_path = hydro_graph.outputs('faults')['pour_points']
+            else:
+                pour_point_path = gbatch.fault_workflow(gbatch.fault_path, hydro_paths)
+                hydro_graph.record('faults', {'pour_points': pour_point_path, 'fault_data': hydro_paths['fault_data']})
+        else:
+            raise RunSpecError('Update runs need pour points or a fault path')
+
+        # Any earlier watershed batch built from the same inputs can be reused.
+        # Catalogued batches from these pour points are tried first
+        watershed_calcs = os.path.join(gbatch.batch_path, 'watershed_calcs')
+        ws_graph = False
+
+        if os.path.isdir(watershed_calcs):
+            candidates = [r['path'] for r in catalogue.runs(kind='watershed', parent=gbatch.batch_path, status='complete',
+                                                            pour_points=file_fingerprint(pour_point_path))]
+            # Uncatalogued directories predate the catalogue. Catalogued ones that
+            # aren't complete may still be being written by another job
+            catalogued = set(r['path'] for r in catalogue.runs(kind='watershed', parent=gbatch.batch_path))
+            for name in batch_directories(watershed_calcs):
+                if run_catalogue.normalise(os.path.join(watershed_calcs, name)) not in catalogued:
+                    candidates.append(os.path.join(watershed_calcs, name))
+
+            for candidate in candidates:
+                graph = StageGraph(yaml_config, os.path.join(candidate, 'stages.yml'), hydro_graph, exists)
+                graph.add_inputs('watersheds', files = [pour_point_path])
+                if graph.is_current('watersheds'):
+                    ws_graph = graph
+                    watershed_directory = candidate
+                    print('Watersheds up to date in '+watershed_directory)
+                    break
+
+        if not ws_graph:
+            with limits.hold('hydro'):
+                watershed_raster = gbatch.watershed_workflow(pour_point_path, hydro_paths)
+            watershed_directory = os.path.dirname(os.path.realpath(watershed_raster))
+
+            f = open(os.path.join(watershed_directory, 'watershed_paths.yml'))
+            w_paths = yaml.load(f.read())
+            f.close()
+
+            ws_graph = StageGraph(yaml_config, os.path.join(watershed_directory, 'stages.yml'), hydro_graph, exists)
+            ws_graph.add_inputs('watersheds', files = [pour_point_path])
+            ws_graph.record('watersheds', {'watersheds': w_paths['watersheds'], 'ws_polygons': w_paths['ws_polygons']})
+
+        watershed_raster = gbatch.watershed_raster(watershed_directory)
+        catalogue.mark_used(watershed_directory, 'watershed', gbatch.project_name, gbatch.batch_path)
+        catalogue.close()
+
+        for scenario_name, temp, precip in pick_climate_scenarios(gbatch, spec):
+            with limits.hold('climate'):
                 gbatch.bqart_workflow(watershed_raster, hydro_paths,
                                       watershed_directory, temp,
-                                      precip, p.input, clear_cache)
+                                      precip, scenario_name, spec.cache == 'clear', ws_graph)
+
+    finally:
+        gbatch.save_trace()
+
+
+def scale_where(clause, scale):
+    # VALUE > 300 with its number scaled, other clauses as they are
+    match = gis_backend.WHERE_COMPARE.match(str(clause))
+    if not match:
+        return clause
+
+    return match.group(1)+' '+match.group(2)+' '+('%g' % (float(match.group(3)) * scale))
+
+
+def build_pyramid(backend, dem, factors, directory):
+    # Each level is aggregated from the finest level it divides
+    levels = []
+    for factor in sorted(factors):
+        source, step = dem, factor
+        for finer, path in levels:
+            if factor % finer == 0:
+                source, step = path, factor // finer
+
+        path = os.path.join(directory, 'dem_x'+str(factor)+'.tif')
+        print('Building x'+str(factor)+' DEM')
+        backend.aggregate(source, path, step)
+        levels.append((factor, path))
+
+    return levels
+
+
+def preview_config(yaml_config, dem, factor, cell_size, directory):
+    # Config for one pyramid level. Accumulation thresholds are in cells so
+    # shrink with the cell area, distances have to reach at least one cell
+    config = copy.deepcopy(yaml_config)
+    config['original_dem'] = dem
+    config['output'] = directory
+    config['fan_toes'] = False
+    config['trace'] = False
+    # Coarse batches go in the preview's own catalogue, so hydro_batch: latest
+    # never picks one for a full run
+    config['catalogue'] = os.path.join(os.path.dirname(directory), CATALOGUE_NAME)
+
+    area_scale = 1.0 / (factor * factor)
+    config['str_net'] = dict(config['str_net'], conditional = scale_where(config['str_net']['conditional'], area_scale))
+    config['pour_points'] = dict(config['pour_points'],
+                                 snap_distance = max(float(config['pour_points']['snap_distance']), cell_size))
+    config['faults'] = dict(config['faults'], search_radius = max(float(config['faults']['search_radius']), cell_size))
+
+    return config
+
+
+def preview_summary(gbatch, factor, cell_size, watershed_raster, seconds):
+    f = open(os.path.join(os.path.dirname(os.path.realpath(watershed_raster)), 'watershed_paths.yml'))
+    w_paths = yaml.load(f.read())
+    f.close()
+
+    pour_points = len(list(gbatch.backend.search_rows(w_paths['pour_points_vector'], ['FID'])))
+    areas = np.array([float(r[0]) for r in gbatch.backend.search_rows(w_paths['ws_polygons'], ['AREA'])]) / 1e6
+
+    summary = {
+        'factor': factor,
+        'cell_size': cell_size,
+        'stream_threshold': gbatch.str_net['conditional'],
+        'snap_distance': gbatch.pour_points['snap_distance'],
+        'search_radius': gbatch.faults['search_radius'],
+        'pour_points': pour_points,
+        'catchments': len(areas),
+        'area_km2': {},
+        'seconds': round(seconds, 2),
+        'batch': gbatch.batch_path
+    }
+    if len(areas):
+        for q, v in zip(PREVIEW_QUANTILES, np.percentile(areas, PREVIEW_QUANTILES)):
+            summary['area_km2']['p'+str(q)] = float(v)
+
+    return summary
+
+
+def run_preview(yaml_config, spec):
+    # Hydrology, faults and watersheds on coarse copies of the DEM, reporting
+    # pour point counts and catchment areas for tuning thresholds
+    backend = gis_backend.load_backend(yaml_config)
+    backend.setup(yaml_config['scratch'], yaml_config['projection_code'])
+    factors = [int(f) for f in spec.preview_factors]
+
+    directory = make_batch_directory(os.path.join(yaml_config['output'], 'preview'))
+
+    pour_points = spec.custom_pour_points or spec.pour_points or yaml_config['pour_points_path']
+    if not (pour_points and os.path.exists(pour_points)):
+        pour_points = False
+        if not (yaml_config['fault_path'] and os.path.exists(yaml_config['fault_path'])):
+            raise RunSpecError('Preview runs need pour points or a fault path')
+
+    cell_size = min(backend.cell_size(yaml_config['original_dem']))
+    summaries = []
+
+    for factor, dem in build_pyramid(backend, yaml_config['original_dem'], factors, directory):
+        print('Preview at x'+str(factor))
+        level_directory = os.path.join(directory, 'x'+str(factor))
+        os.makedirs(level_directory)
+        config = preview_config(yaml_config, dem, factor, cell_size * factor, level_directory)
+
+        start = datetime.datetime.now()
+        gbatch = GISbatch(config, False, RunSpec({'headless': True}))
+        hydro_paths = gbatch.hydro_workflow()
+        if pour_points:
+            level_pour_points = pour_points
+        else:
+            level_pour_points = gbatch.fault_workflow(gbatch.fault_path, hydro_paths)
+        watershed_raster = gbatch.watershed_workflow(level_pour_points, hydro_paths)
+        seconds = (datetime.datetime.now() - start).total_seconds()
+
+        summaries.append(preview_summary(gbatch, factor, cell_size * factor, watershed_raster, seconds))
+
+    with open(os.path.join(directory, 'preview.yml'), 'w') as outfile:
+        outfile.write(yaml.dump(summaries, default_flow_style=False))
+
+    print('Preview (catchment areas in km2)')
+    print('  '+'factor'.rjust(6)+'cell'.rjust(9)+'threshold'.rjust(18)+'points'.rjust(8)+'catchments'.rjust(11)+
+          ''.join([('p'+str(q)).rjust(10) for q in PREVIEW_QUANTILES]))
+    for s in summaries:
+        print('  '+str(s['factor']).rjust(6)+('%.0f' % s['cell_size']).rjust(9)+str(s['stream_threshold']).rjust(18)+
+              str(s['pour_points']).rjust(8)+str(s['catchments']).rjust(11)+
+              ''.join([('%.3g' % s['area_km2'].get('p'+str(q), float('nan'))).rjust(10) for q in PREVIEW_QUANTILES]))
+    print('Preview saved to '+directory)
+
+    return summaries
+
+
+def sweep_crossings(backend, gbatch, receiver, grid):
+    # Fault cells above minimum_height whose flow leaves the fault, where a
+    # stream through them makes a pour point in the fault workflow
+    faults = backend.burn_features(gbatch.fault_path, grid).ravel()
+    dem = backend.sample_raster(gbatch.original_dem, grid).ravel()
+    high = np.where(np.isfinite(dem), dem, -np.inf) > float(gbatch.pour_points['minimum_height'])
+    leaves = (receiver < 0) | ~faults[np.maximum(receiver, 0)]
+
+    return faults & high & leaves
+
+
+def run_sweep(yaml_config, spec):
+    # Drainage density, stream counts and fault crossings for each threshold
+    # from the flow accumulation of an existing hydro batch
+    gbatch, hydro_paths = load_hydro_batch(yaml_config, spec.hydro_batch, spec)
+    for key in ['flow_path', 'flow_acc_path']:
+        if not os.path.exists(hydro_paths[key]):
+            raise RunSpecError('Sweep runs need '+key+' persisted in the hydro batch')
+
+    # Arrays come from the numpy backend whichever backend made the batch
+    backend = gbatch.backend
+    if backend.name != 'numpy':
+        backend = gis_backend.NumpyBackend()
+        backend.setup(gbatch.scratch_path, gbatch.projection_code)
+
+    thresholds = [float(t) for t in spec.sweep_thresholds]
+    receiver, valid, grid = backend.flow_receivers(hydro_paths['flow_path'])
+    accumulation = backend.sample_raster(hydro_paths['flow_acc_path'], grid).ravel()
+    accumulation[~valid] = np.nan
+
+    crossings = None
+    if gbatch.fault_path and os.path.exists(gbatch.fault_path):
+        crossings = sweep_crossings(backend, gbatch, receiver, grid)
+
+    print('Sweeping '+str(len(thresholds))+' thresholds')
+    results = stream_sweep.sweep(accumulation, receiver, grid.shape, min(grid.cell_size()), thresholds, crossings)
+
+    sweep_path = os.path.join(gbatch.batch_path, gbatch.project_name + '_stream_sweep.csv')
+    fields = ['threshold', 'stream_cells', 'length_km', 'drainage_density', 'channel_heads',
+              'junctions', 'outlets', 'fault_crossings']
+    with open(sweep_path, 'wb') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(fields)
+        for r in results:
+            writer.writerow([r.get(f, '') for f in fields])
+
+    for t in spec.sweep_masks:
+        mask_path = os.path.join(gbatch.batch_path, gbatch.project_name + '_streams_'+('%g' % float(t))+'.tif')
+        print('Saving stream mask for '+('%g' % float(t)))
+        mask = np.where(accumulation > float(t), 1, np.nan).reshape(grid.shape)
+        backend.write_raster(mask_path, mask, grid, 'int16')
+
+    print('Stream threshold sweep (lengths in km, density in km/km2)')
+    print('  '+'threshold'.rjust(10)+'cells'.rjust(10)+'length'.rjust(10)+'density'.rjust(9)+
+          'heads'.rjust(8)+'junctions'.rjust(10)+'outlets'.rjust(8)+'crossings'.rjust(10))
+    for r in results:
+        print('  '+('%g' % r['threshold']).rjust(10)+str(r['stream_cells']).rjust(10)+
+              ('%.1f' % r['length_km']).rjust(10)+('%.3f' % r['drainage_density']).rjust(9)+
+              str(r['channel_heads']).rjust(8)+str(r['junctions']).rjust(10)+str(r['outlets']).rjust(8)+
+              str(r.get('fault_crossings', '-')).rjust(10))
+    print('Sweep saved to '+sweep_path)
+
+    return results
+
+
+def list_runs(yaml_config, spec):
+    # Catalogued batches of this project, newest first, as tab separated
+    # lines so they can be piped into other tools
+    pour_points = spec.custom_pour_points or spec.pour_points
+    query = {
+        'kind': spec.run_kind,
+        'project': yaml_config['project_name'],
+        'status': spec.run_status,
+        'pour_points': file_fingerprint(pour_points) if pour_points else None
+    }
+
+    catalogue = open_catalogue(yaml_config)
+    runs = []
+    for scenario in spec.scenarios or [None]:
+        runs.extend(catalogue.runs(scenario = scenario, **query))
+    catalogue.close()
+
+    fields = ['id', 'kind', 'status', 'started', 'finished', 'seconds', 'scenario', 'path']
+    print('\t'.join(fields))
+    for run in sorted(runs, key=lambda r: (r['finished'] or '', r['id']), reverse=True):
+        print('\t'.join(['' if run[f] is None else str(run[f]) for f in fields]))
+
+    return runs
+
+
+def scenario_batch(catalogue, watershed_directory, scenario):
+    # Latest complete climate batch of a scenario and its zonal tables.
+    # Batches made before the catalogue are found by directory name
+    run = catalogue.latest(kind='climate', parent=watershed_directory, scenario=scenario)
+    if run:
+        return run['path'], run['outputs']
+
+    climate_calcs = os.path.join(watershed_directory, 'climate_calcs')
+    if not os.path.isdir(climate_calcs):
+        return None, {}
+
+    # Named <timestamp>_<scenario>, the timestamp has six parts. Newer
+    # <timestamp>_<pid>_<scenario> batches are always catalogued
+    names = [n for n in os.listdir(climate_calcs) if n.split('_', 6)[6:] == [scenario]]
+    if not names:
+        return None, {}
+
+    path = os.path.join(climate_calcs, max(names, key=lambda n: [int(t) for t in n.split('_')[:6]]))
+    tables = {}
+    for name in ['temp', 'precip', 'elev']:
+        for candidate in [name + '_data.csv', name + '_data.dbf', name + '_data']:
+            if os.path.exists(os.path.join(path, candidate)):
+                tables[name] = os.path.join(path, candidate)
+                break
+    if os.path.exists(os.path.join(path, 'lithologies.csv')):
+        tables['lithology'] = os.path.join(path, 'lithologies.csv')
+
+    return path, tables
+
+
+def aligned(ids, rows):
+    # Values of (id, value) rows at each of the sorted ids, NaN where a
+    # catchment has no row
+    values = np.zeros(len(ids)) + np.nan
+    rows = np.array(list(rows), dtype=float).reshape(-1, 2)
+
+    position = np.searchsorted(ids, rows[:, 0])
+    found = position < len(ids)
+    found[found] = ids[position[found]] == rows[found, 0]
+    values[position[found]] = rows[found, 1]
+
+    return values
+
+
+def run_compare(yaml_config, spec):
+    # Qs, erosion and discharge of several scenarios side by side for one
+    # watershed batch, from the zonal tables of each scenario's latest
+    # climate batch, with changes and ratios against a baseline scenario
+    gbatch, hydro_paths = load_hydro_batch(yaml_config, spec.hydro_batch, spec)
+    backend = gbatch.backend
+
+    if not spec.watershed_batch:
+        print('Pick watershed path batch')
+
+    catalogue = open_catalogue(yaml_config)
+    watershed_calcs = os.path.join(gbatch.batch_path, 'watershed_calcs')
+    watershed_directory = os.path.realpath(resolve_batch_directory(watershed_calcs, spec.watershed_batch, spec, catalogue))
+
+    basic = dict(('_basic_'+c['name'], c) for c in gbatch.climate_basic or [])
+    names = spec.scenarios or [c['name'] for c in gbatch.climates] + sorted(basic)
+    batches = {}
+    for name in names:
+        path, tables = scenario_batch(catalogue, watershed_directory, name)
+        if path:
+            print(name+': '+path)
+            batches[name] = tables
+        elif spec.scenarios:
+            raise RunSpecError('No climate batch for '+name+' in '+watershed_directory)
+    catalogue.close()
+
+    scenarios = [n for n in names if n in batches]
+    if len(scenarios) < 2:
+        raise RunSpecError('Comparing needs climate batches for two or more scenarios in '+watershed_directory)
+
+    baseline = spec.baseline or scenarios[0]
+    if baseline not in batches:
+        raise RunSpecError('No climate batch for the baseline '+baseline+' in '+watershed_directory)
+
+    # Catchment areas from the polygons, a catchment can be several parts
+    f = open(os.path.join(watershed_directory, 'watershed_paths.yml'))
+    w_paths = yaml.load(f.read())
+    f.close()
+
+    rows = np.array(list(backend.search_rows(w_paths['ws_polygons'], ['GRIDCODE', 'AREA'])), dtype=float).reshape(-1, 2)
+    ids, inverse = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+    area = np.bincount(inverse, weights=rows[:, 1], minlength=len(ids))
+
+    # Same catchments as the per-scenario tables
+    keep = area > (gbatch.min_area or 0)
+    ignore = gbatch.ignore_catchments(watershed_directory)
+    if ignore:
+        keep = keep & ~np.in1d(ids, list(ignore))
+    ids, area = ids[keep], area[keep]
+
+    # Relief and lithology don't change with the climate
+    tables = batches[baseline]
+    relief = (aligned(ids, backend.search_rows(tables['elev'], ['VALUE', 'MAX'])) -
+              aligned(ids, backend.search_rows(tables['elev'], ['VALUE', 'MIN'])))
+    B = np.ones(len(ids))
+    if gbatch.lithology_path and tables.get('lithology') and os.path.exists(tables['lithology']):
+        B = aligned(ids, gbatch.load_lithology_values(tables['lithology']).items())
+        # do_bqart fails on these too, rather than leave them out of the totals
+        missing = ids[np.isnan(B)]
+        if missing.size:
+            raise RunSpecError('No lithology values for catchments '+', '.join(map(str, missing.tolist()))+
+                               ' in '+tables['lithology'])
+
+    precip = np.zeros((len(scenarios), len(ids)))
+    temp = np.zeros((len(scenarios), len(ids)))
+    for i, name in enumerate(scenarios):
+        if name in basic:
+            precip[i] = float(basic[name]['precip'])
+            temp[i] = float(basic[name]['temp'])
+        else:
+            precip[i] = aligned(ids, backend.search_rows(batches[name]['precip'], ['VALUE', 'MEAN']))
+            temp[i] = aligned(ids, backend.search_rows(batches[name]['temp'], ['VALUE', 'MEAN']))
+    temp = temp / 10.0
+
+    print('BQART for '+str(len(scenarios))+' scenarios and '+str(len(ids))+' catchments')
+    columns = bqart.scenario_columns(precip, temp, area, relief, B, scenarios.index(baseline))
+
+    header = ['id', 'A (km^2)', 'R (km)', 'B']
+    data = [ids, area / 1000000.0, relief / 1000.0, B]
+    for i, name in enumerate(scenarios):
+        header.extend([catchment_table.scenario_column('precipitation (mm/yr)', name),
+                       catchment_table.scenario_column('T(C)', name)])
+        data.extend([precip[i], temp[i]])
+        for key, title, units, compared in COMPARE_COLUMNS:
+            header.append(catchment_table.scenario_column(title+' ('+units+')', name))
+            data.append(columns[key][i])
+            if compared and name != baseline:
+                header.extend([catchment_table.scenario_column(title+' change ('+units+')', name),
+                               catchment_table.scenario_column(title+' ratio', name)])
+                data.extend([columns[key + ' change'][i], columns[key + ' ratio'][i]])
+
+    compare_path = os.path.join(watershed_directory, gbatch.project_name+'_scenarios_'+baseline+'.csv')
+    with bqart.csv_output(compare_path) as table:
+        a = csv.writer(table, delimiter=',')
+        a.writerow(header)
+        for r in zip(*[c.tolist() for c in data]):
+            a.writerow(r)
+
+    totals = np.nansum(columns['Qs_m3_yr'], axis=1)
+    print('Total Qs (m^3/yr) against '+baseline)
+    for i, name in enumerate(scenarios):
+        ratio = totals[i] / totals[scenarios.index(baseline)] if totals[scenarios.index(baseline)] else float('nan')
+        print('  '+name.ljust(30)+('%.4g' % totals[i]).rjust(12)+('%.3f' % ratio).rjust(9))
+    print('Comparison saved to '+compare_path)
+
+    return compare_path
+
+
+def release_extensions():
+    gis_backend.release_extensions()
+
+
+def main():
+    app = GISApp()
+    try:
+        app.setup()
+
+        app.run()
+
+        if app.mode == 'schedule':
+            if app.pargs.jobs:
+                try:
+                    outcomes = run_schedule(app.pargs.jobs, app.pargs.workers)
+                    if [o for o in outcomes if o['status'] != 'complete']:
+                        sys.exit(1)
+                except (OSError, IOError) as e:
+                    print(e)
+                    sys.exit(1)
+            else:
+                print('Please define path to schedule file -j JOBS')
 
-        except (OSError, IOError) as e:
-            print(e)
-            exit
-    else:
-        print('Please define path to config file -c CONFIG')
-    
-finally:
-    arcpy.CheckInExtension("Spatial")
-    app.close()
+        elif app.pargs.config:
+            try:
+                f = open(app.pargs.config)
+                yaml_config = yaml.load(f.read())
+                f.close()
+
+                spec = RunSpec(load_run_spec(app.pargs.spec), app.pargs)
+                if app.mode != 'default':
+                    spec.mode = app.mode
+                spec.validate(yaml_config)
+
+                run_project(yaml_config, spec)
+
+            except (OSError, IOError) as e:
+                print(e)
+                exit
+            except (RunSpecError, gis_backend.BackendError) as e:
+                print(e)
+                sys.exit(1)
+        else:
+            print('Please define path to config file -c CONFIG')
+
+    finally:
+        release_extensions()
+        app.close()
+
+
+if __name__ == '__main__':
+    main()
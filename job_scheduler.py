@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Run many project configs through a pool of worker processes
+
+Each job runs in a fresh process so arcpy.env, the working directory and
+module state are never shared between projects. Memory hungry hydro stages
+and I/O heavy climate stages are capped with shared semaphores.
+"""
+import contextlib
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import yaml
+
+
+class StageLimits:
+    'Caps how many jobs can be inside each kind of stage at once'
+
+    def __init__(self, semaphores = None):
+        self.semaphores = semaphores or {}
+
+    @contextlib.contextmanager
+    def hold(self, kind):
+        semaphore = self.semaphores.get(kind)
+
+        if semaphore is None:
+            yield
+        else:
+            semaphore.acquire()
+            try:
+                yield
+            finally:
+                semaphore.release()
+
+
+class JobScheduler:
+    'Runs project jobs through a worker pool'
+
+    def __init__(self, jobs, workers = None, hydro_slots = 1, climate_slots = 2, log_directory = None):
+        self.jobs = jobs
+        self.workers = workers or multiprocessing.cpu_count()
+        self.hydro_slots = hydro_slots
+        self.climate_slots = climate_slots
+        self.log_directory = log_directory
+
+        names = [job['name'] for job in self.jobs]
+        for name in names:
+            if names.count(name) > 1:
+                raise ValueError('Job names must be unique, '+name+' is used more than once')
+
+    def run(self):
+        manager = multiprocessing.Manager()
+        limits = StageLimits({
+            'hydro': manager.Semaphore(self.hydro_slots),
+            'climate': manager.Semaphore(self.climate_slots)
+        })
+
+        if self.log_directory and not os.path.isdir(self.log_directory):
+            os.makedirs(self.log_directory)
+
+        # One job per process so nothing leaks from one project to the next
+        pool = multiprocessing.Pool(self.workers, maxtasksperchild=1)
+        pending = []
+        for job in self.jobs:
+            log_path = None
+            if self.log_directory:
+                log_path = os.path.join(self.log_directory, job['name']+'.log')
+            pending.append(pool.apply_async(run_job, (job, limits, log_path)))
+        pool.close()
+
+        outcomes = []
+        for job, result in zip(self.jobs, pending):
+            outcome = result.get()
+            print(outcome['name']+': '+outcome['status']+' in '+str(round(outcome['seconds'], 1))+'s')
+            outcomes.append(outcome)
+
+        pool.join()
+        manager.shutdown()
+
+        return outcomes
+
+
+def run_job(job, limits, log_path = None):
+    gis_workflow = None
+    start = time.time()
+    stdout = sys.stdout
+    log_file = None
+    if log_path:
+        log_file = open(log_path, 'w')
+        sys.stdout = log_file
+
+    status = 'complete'
+    error = ''
+
+    try:
+        # Imported here so the parent process doesn't need the GIS stack,
+        # and so a worker missing it fails the job rather than the pool
+        import gis_workflow
+
+        f = open(job['config'])
+        yaml_config = yaml.load(f.read())
+        f.close()
+
+        spec_data = gis_workflow.load_run_spec(job.get('spec'))
+        for key in ['mode', 'batch', 'hydro_batch', 'watershed_batch', 'scenarios',
+                    'cache', 'pour_points', 'custom_pour_points', 'lithology_values']:
+            if key in job:
+                spec_data[key] = job[key]
+
+        # Scheduled jobs never prompt
+        spec_data['headless'] = True
+
+        spec = gis_workflow.RunSpec(spec_data)
+        spec.validate(yaml_config)
+        gis_workflow.run_project(yaml_config, spec, limits)
+
+    except Exception:
+        status = 'failed'
+        error = traceback.format_exc()
+        print(error)
+
+    finally:
+        if gis_workflow is not None:
+            gis_workflow.release_extensions()
+        sys.stdout = stdout
+        if log_file:
+            log_file.close()
+
+    return {
+        'name': job['name'],
+        'config': job['config'],
+        'status': status,
+        'error': error,
+        'seconds': time.time() - start
+    }
+
+
+def load_schedule(path):
+    f = open(path)
+    schedule = yaml.load(f.read())
+    f.close()
+
+    jobs = []
+    for i, job in enumerate(schedule['jobs']):
+        job = dict(job)
+        if 'name' not in job:
+            job['name'] = os.path.splitext(os.path.basename(job['config']))[0]+'_'+str(i+1)
+        jobs.append(job)
+
+    schedule['jobs'] = jobs
+
+    return schedule
+
+
+def run_schedule(path, workers = None):
+    schedule = load_schedule(path)
+
+    log_directory = schedule.get('log_directory')
+    if not log_directory:
+        log_directory = os.path.join(os.path.dirname(os.path.realpath(path)), 'schedule_logs')
+
+    scheduler = JobScheduler(schedule['jobs'],
+                             workers or schedule.get('workers'),
+                             schedule.get('hydro_slots', 1),
+                             schedule.get('climate_slots', 2),
+                             log_directory)
+
+    return scheduler.run()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Deferred imports for the heavy GIS and plotting packages
+
+arcpy takes several seconds to import and matplotlib's pyplot pulls in a
+GUI toolkit, so both are only imported when something first uses them.
+"""
+import importlib
+
+
+class LazyModule:
+    'Stands in for a module and imports it on first attribute access'
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def load(self):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+
+        return self.__dict__['_module']
+
+    def loaded(self):
+        return self.__dict__['_module'] is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.load(), attr, value)
@@ -7,7 +7,7 @@ Created on Wed Apr 01 13:30:06 2015
 
 import cement
 import csv
-import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
 from os.path import basename
@@ -16,6 +16,13 @@ from cement.core import foundation, controller
 from cement.core.controller import expose
 from cement.utils import shell
 
+from catchment_fits import fit_matrix, fit_records
+from catchment_table import load_catchment_table
+from lazy_modules import LazyModule
+
+# pyplot is only needed for interactive plots
+plt = LazyModule('matplotlib.pyplot')
+
 columns = ['id',
     'precipitation',
     'w',
@@ -42,13 +49,73 @@ columns = ['id',
     'QS_Tectonic_Average',
     'Error']
 
+DATANAMES = [
+    'area',
+    'precipitation',
+    'relief',
+    'volume',
+    'sediment flux',
+    'erosion mm',
+    'erosion m',
+    'fault distance'
+]
+
+DATALABELS = [
+    'Catchment areas',
+    'Average precipitation',
+    'Relief',
+    'Sediment volume',
+    'Sediment flux',
+    'Catchment erosion',
+    'Catchment erosion',
+    'Distance along fault'
+]
+
+DATAUNITS = [
+    'km$^2$',
+    'mm/yr',
+    'km',
+    'm$^3$/kg',
+    'T/yr',
+    'mm',
+    'm',
+    'm'
+]
+
+# Past this many catchments 'auto' density plots switch from points to bins
+DENSITY_POINTS = 20000
+
 class GISAppController(controller.CementBaseController):
     class Meta:
         label = 'base'
         description = 'Python CLI application to automate QS data plots'
         arguments = [
             ( ['-d', '--data'], dict(action='store', dest='data',
-                      help='path to data file') )]
+                      help='path to data file') ),
+            ( ['--scenario'], dict(action='store', dest='scenario',
+                      help='scenario to plot from a multi-scenario table') ),
+            ( ['--batch'], dict(action='store_true', dest='batch',
+                      help='render every x, y and extent combination to files') ),
+            ( ['--x'], dict(action='store', dest='x',
+                      help='comma separated x datasets for batch plots, default all') ),
+            ( ['--y'], dict(action='store', dest='y',
+                      help='comma separated y datasets for batch plots, default all') ),
+            ( ['--extent'], dict(action='store', dest='extent',
+                      help='all, faults or comma separated fault ids, default all,faults') ),
+            ( ['-o', '--output'], dict(action='store', dest='output',
+                      help='directory for batch plots, or the fits file') ),
+            ( ['--format'], dict(action='store', dest='format', default='png',
+                      help='png or svg') ),
+            ( ['-w', '--workers'], dict(action='store', dest='workers', type=int,
+                      help='number of plotting processes') ),
+            ( ['--density'], dict(action='store', dest='density', default='auto',
+                      help='points, hexbin, hist2d or auto (hexbin past '+str(DENSITY_POINTS)+' catchments)') ),
+            ( ['--gridsize'], dict(action='store', dest='gridsize', type=int, default=100,
+                      help='bins across each axis for density plots') ),
+            ( ['--fits'], dict(action='store_true', dest='fits',
+                      help='fit every dataset pair for all catchments and each fault, to a CSV') ),
+            ( ['--resamples'], dict(action='store', dest='resamples', type=int, default=1000,
+                      help='bootstrap resamples for the fit confidence intervals, 0 for none') )]
         
 
 class GISApp(foundation.CementApp):
@@ -60,18 +127,8 @@ class GISApp(foundation.CementApp):
 
 class Plotter():
     
-    def __init__(self, datafile):
-        self.precipitation = {}
-        self.areas = {}
-        self.areas_col = []
-        self.relief = {}
-        self.QS_t_yr = {}
-        self.volume_m3_yr = {}
-        self.erosion_mm_yr = {}
-        self.erosion_m_yr = {}
-        self.erosion_col = []
-        self.faults = {}
-        self.distances = {}
+    def __init__(self, datafile, scenario = None, density = 'auto', gridsize = 100):
+        self.data = load_catchment_table(datafile, scenario)
         self.selected_fault = ''
         self.datalabel_x = '' 
         self.datalabel_y = ''
@@ -81,66 +138,20 @@ class Plotter():
         self.plot_options = {
             'logarithmic': { 'x': False, 'y': False },
             'trend': 1,
-            'line': 'None'
+            'line': 'None',
+            'density': density,
+            'gridsize': gridsize
         }
         
-        self.datanames = [
-            'area',
-            'precipitation',
-            'relief',
-            'volume',
-            'sediment flux',
-            'erosion mm',
-            'erosion m',
-            'fault distance'
-        ]
-        
-        self.datalabels = [
-            'Catchment areas',
-            'Average precipitation',
-            'Relief',
-            'Sediment volume',
-            'Sediment flux',
-            'Catchment erosion',
-            'Catchment erosion',
-            'Distance along fault'
-        ]
-        
-        self.dataunits = [
-            'km$^2$',
-            'mm/yr',
-            'km',
-            'm$^3$/kg',
-            'T/yr',
-            'mm',
-            'm',
-            'm'
-        ]
-        
-        with open(datafile, 'rb') as csvfile:
-            fault_data = csv.reader(csvfile, delimiter=',')
-            for row in fault_data:
-                try:
-                    if int(row[0]):
-                        c_id = int(row[0])
-                        self.precipitation.update({c_id: float(row[1])})
-                        self.areas.update({c_id: float(row[5])})
-                        self.areas_col.append(float(row[5]))
-                        self.QS_t_yr.update({c_id: float(row[9])})
-                        self.volume_m3_yr.update({c_id: float(row[11])})
-                        self.erosion_m_yr.update({c_id: float(row[12])})
-                        self.erosion_mm_yr.update({c_id: float(row[13])})
-                        self.erosion_col.append(float(row[13]))
-                        self.distances.update({c_id: float(row[15])})                      
-            
-                        if int(row[14]) in self.faults:
-                            self.faults[int(row[14])].append(c_id)
-                        else:
-                            self.faults.update({int(row[14]): [c_id]})
-                
-                except ValueError:
-                    error = ValueError
-        
+        self.datanames = DATANAMES
+        self.datalabels = DATALABELS
+        self.dataunits = DATAUNITS
+
+        if self.data.scenario:
+            print('Loaded '+str(len(self.data))+' catchments for '+self.data.scenario)
+        else:
+            print('Loaded '+str(len(self.data))+' catchments')
+
         self.choose_plot()
         
     def choose_plot(self):
@@ -162,7 +173,7 @@ class Plotter():
         p1 = shell.Prompt("Data extent", options = extent_choices, numbered = True)
         
         if p1.input is 'Fault specific':
-            fault_list = map(lambda x: 'fault '+str(x), self.faults.keys())
+            fault_list = map(lambda x: 'fault '+str(x), sorted(self.data.faults.keys()))
             p2 = shell.Prompt("Choose fault", options = fault_list, numbered = True)  
             
             
@@ -182,239 +193,417 @@ class Plotter():
         else:
             print('All catchments!')
             self.title = 'All Catchments'
-            r_x_data, x_label_id, x_unit_id = self.select_dataset(x_choice, 'x')
-            r_y_data, y_label_id, y_unit_id = self.select_dataset(y_choice, 'y')
-            f_x_data = r_x_data.values()
-            f_y_data = r_y_data.values()
+            f_x_data, x_label_id, x_unit_id = self.select_dataset(x_choice, 'x')
+            f_y_data, y_label_id, y_unit_id = self.select_dataset(y_choice, 'y')
             s_x_data, s_y_data = self.sort_by_x(f_x_data, f_y_data)
             self.plot_data([s_x_data,x_label_id, x_unit_id], [s_y_data, y_label_id, y_unit_id])
 
             
     def sort_by_x(self,xdata,ydata):
-        unsorted = []
-        
-        def getKey(item):
-            return item[0]
-            
-        for n in range(0, len(xdata)):
-            unsorted.append([xdata[n], ydata[n]])
-        
-        sorted_by_x = sorted(unsorted, key=getKey)
-        
-        x_data_sorted = []
-        y_data_sorted = []
-        
-        for m in range(0, len(sorted_by_x)):
-            x_data_sorted.append(sorted_by_x[m][0])
-            y_data_sorted.append(sorted_by_x[m][1])
-            
-        return x_data_sorted, y_data_sorted
+        order = np.argsort(xdata, kind='mergesort')
+
+        return np.asarray(xdata)[order], np.asarray(ydata)[order]
         
         
     def select_dataset(self, dataname,x_y):
         print('Choosing dataset for '+ dataname)
-            
-        if dataname is self.datanames[1]:
-            dataset = self.precipitation
-            unit = 1
-            label = 1
-        elif dataname is self.datanames[0]:
-            dataset = self.areas
-            unit = 0
-            label = 0
-        elif dataname is self.datanames[2]:
-            dataset = self.relief
-            unit = 2
-            label = 2
-        elif dataname is self.datanames[3]:
-            dataset = self.volume_m3_yr
-            unit = 3
-            label = 3
-        elif dataname is self.datanames[4]:
-            dataset = self.QS_t_yr
-            
-            if self.plot_options['logarithmic']['x'] is not 'force_off':
-                self.plot_options['logarithmic']['x'] = True
-                
-            if self.plot_options['logarithmic']['y'] is not 'force_off':
-                self.plot_options['logarithmic']['y'] = True
-                
-            unit = 4
-            label = 4
-        elif dataname is self.datanames[6]:
-            dataset = self.erosion_mm_yr
-            label = 5
-            unit = 5
-        elif dataname is self.datanames[5]:
-            dataset = self.erosion_m_yr
-            unit = 6
-            label = 6
-        elif dataname is self.datanames[7]:
-            dataset = self.distances
-            self.plot_options['logarithmic'][x_y] = 'force_off'
-            self.plot_options['trend'] = 0
-            self.plot_options['line'] = '-'
-            unit = 7
-            label = 7
-        else:
-            dataset = ''
+
+        if dataname not in self.datanames:
             print(dataname+' - not recognised!')
             exit
-            
+
+        # Labels and units share the datanames order
+        label = self.datanames.index(dataname)
+        unit = label
+        dataset = self.data.column(dataname)
+
+        dataset_options(self.plot_options, dataname, x_y)
+
         return dataset, unit, label
         
 
     def get_fault_data(self, dataname, x_y):
         
         dataset, label, unit = self.select_dataset(dataname, x_y)
-        
-        catchments = self.faults[self.selected_fault]
-        
-        output_data = []
 
-        for c in catchments:
-            output_data.append(dataset[c])
+        output_data = dataset[self.data.fault_rows(self.selected_fault)]
 
         return output_data, label, unit
     
-    def get_r_squared(self, x_data, y_data, m, b):
-        
-        y_mean = sum(y_data)/len(y_data)        
-        
-        ss_totals = []
-        
-        for y in y_data:
-            ss_totals.append(np.square(y-y_mean))
-        
-        ss_total = sum(ss_totals)
-        
-        f = []
-        
-        for x in x_data:
-            f.append((m*x + b))
-
-        ss_residuals = []
-        
-        
-        y_f = np.array([y_data,f])
-        
-        
-        for k in range(0,len(y_data)):
-            ss_residuals.append(np.square(y_f[0][k]-y_f[1][k]))
-        
-        ss_res = sum(ss_residuals)
-        
-        r_squared = 1 - (ss_res/ss_total)
-        
-        return r_squared
-            
-            
     def plot_data(self, x, y):
-        x_data = x[0]
-        x_label = self.datalabels[x[1]]
-        x_unit = self.dataunits[x[2]]
-        
-        y_data = y[0]
-        y_label = self.datalabels[y[1]]
-        y_unit = self.dataunits[y[2]]
-        
-        plt.plot(x_data, y_data, marker='o', linestyle=self.plot_options['line'])
-        plt.title(self.title)
-        plt.xlabel(x_label+' ('+x_unit+')')
-        plt.ylabel(y_label+' ('+y_unit+')')
+        x_label = self.datalabels[x[1]]+' ('+self.dataunits[x[2]]+')'
+        y_label = self.datalabels[y[1]]+' ('+self.dataunits[y[2]]+')'
+
+        fit = draw_plot(plt.gca(), x[0], y[0], x_label, y_label, self.title, self.plot_options)
+
+        if fit:
+            print('Slope: '+str(fit['slope']))
+            print('Intercepts: '+str(fit['intercept']))
+            print('r squared '+str(fit['r_squared']))
+
+        plt.show()
+
+
+def dataset_options(plot_options, dataname, x_y):
+    # Axis scales and trend settings that go with a dataset
+    if dataname == 'sediment flux':
+        if plot_options['logarithmic']['x'] is not 'force_off':
+            plot_options['logarithmic']['x'] = True
+
+        if plot_options['logarithmic']['y'] is not 'force_off':
+            plot_options['logarithmic']['y'] = True
+
+    elif dataname == 'fault distance':
+        plot_options['logarithmic'][x_y] = 'force_off'
+        plot_options['trend'] = 0
+        plot_options['line'] = '-'
+
+
+def get_r_squared(x_data, y_data, m, b):
+    y_data = np.asarray(y_data, dtype=float)
+    ss_total = np.sum(np.square(y_data - y_data.mean()))
+    ss_res = np.sum(np.square(y_data - (m*np.asarray(x_data, dtype=float) + b)))
+
+    return 1 - (ss_res/ss_total)
+
+
+def bin_edges(values, bins, log):
+    low = np.amin(values)
+    high = np.amax(values)
+    if low == high:
+        low, high = (low / 2.0, high * 2.0) if log else (low - 0.5, high + 0.5)
+
+    if log:
+        return np.logspace(np.log10(low), np.log10(high), bins + 1)
+
+    return np.linspace(low, high, bins + 1)
+
+
+def draw_density(ax, x_data, y_data, log_x, log_y, density, gridsize):
+    # Counts per bin instead of one marker per catchment, binned in log space
+    # on log axes. The cost of drawing depends on the grid, not the points
+    from matplotlib.colors import LogNorm
+
+    x_data = np.asarray(x_data, dtype=float)
+    y_data = np.asarray(y_data, dtype=float)
+    keep = np.isfinite(x_data) & np.isfinite(y_data)
+    if log_x:
+        keep &= x_data > 0
+    if log_y:
+        keep &= y_data > 0
+    x_data = x_data[keep]
+    y_data = y_data[keep]
+
+    if not len(x_data):
+        return None
+
+    if density == 'hexbin':
+        image = ax.hexbin(x_data, y_data, gridsize=gridsize, bins='log', mincnt=1, cmap='viridis',
+                          xscale='log' if log_x else 'linear', yscale='log' if log_y else 'linear')
+    else:
+        x_edges = bin_edges(x_data, gridsize, log_x)
+        y_edges = bin_edges(y_data, gridsize, log_y)
+        counts = np.histogram2d(x_data, y_data, bins=[x_edges, y_edges])[0]
+        image = ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0), norm=LogNorm(), cmap='viridis')
+
+    ax.figure.colorbar(image, ax=ax, label='Catchments')
+
+    return image
+
+
+def draw_plot(ax, x_data, y_data, x_label, y_label, title, plot_options):
+    # Draws one scatter plot with its trend line, returns the fit or None
+    ax.set_title(title)
+    ax.set_xlabel(x_label)
+    ax.set_ylabel(y_label)
+    
+    log_settings = plot_options['logarithmic']
+    
+    loglog = False
+    log_x = False
+    log_y = False
+
+    if log_settings['x'] is True:
+        log_x = True
         
-        log_settings = self.plot_options['logarithmic']
+    if log_settings['y'] is True:
+        log_y = True
         
+    if log_settings['x'] is 'force_off':
         loglog = False
         log_x = False
+
+    if log_settings['y'] is 'force_off':
+        loglog = False
         log_y = False
+    
+    if log_x and log_y:
+        loglog = True
 
-        if log_settings['x'] is True:
-            log_x = True
-            
-        if log_settings['y'] is True:
-            log_y = True
-            
-        if log_settings['x'] is 'force_off':
-            loglog = False
-            log_x = False
+    density = plot_options.get('density', 'points')
+    if density == 'auto':
+        density = 'hexbin' if len(x_data) > DENSITY_POINTS else 'points'
 
-        if log_settings['y'] is 'force_off':
-            loglog = False
-            log_y = False
+    if density == 'points':
+        ax.plot(x_data, y_data, marker='o', linestyle=plot_options['line'])
+    else:
+        draw_density(ax, x_data, y_data, log_x, log_y, density, plot_options.get('gridsize', 100))
+    
+    if log_x:
+        ax.set_xscale('log')
+    
+    if log_y:
+        ax.set_yscale('log')
+    
+    r_squared = None
+    
+    if plot_options['trend']:
         
-        if log_x and log_y:
-            loglog = True
-            
         if loglog:
-            plt.yscale('log')
-            plt.xscale('log')
-        
-        if log_x:
-            plt.xscale('log')
-        
-        if log_y:
-            plt.yscale('log')
-        
-        
-        if self.plot_options['trend']:
+            logx = np.log(x_data)
+            logy = np.log(y_data)
+            max_x = np.amax(logx)
+            max_y = np.amax(logy)
+            min_x = np.amin(logx)
+            x_d = np.exp(np.linspace(min_x, max_x))
+            coeffs = np.polyfit(logx,logy,deg=1, full=True)
+            poly = np.poly1d(coeffs[0])
+            yfit = lambda x: np.exp(poly(np.log(x)))
+            ax.loglog(x_d,yfit(x_d))
+            r_squared = get_r_squared(logx,logy, coeffs[0][0], coeffs[0][1])
+            slope = coeffs[0][0]
+            intercept = coeffs[0][1]
+            anno_x = max_x/3
+            anno_x_t = anno_x*+(max_x*0.2)
+            anno_y = max_y/3
+            anno_y_t = anno_y+(max_y*0.2)
+        elif log_x:
+            print('Log x')
+        elif log_y:
+            print('Log y')
+        else:
+            m, b = np.polyfit(x_data, y_data, 1)
+            r_squared = get_r_squared(x_data,y_data, m, b)
+            x_min = np.amin(x_data)
+            x_max = np.amax(x_data)
+            y_max = np.amax(y_data)
+            slope = m
+            intercept = b
+            anno_x = x_max/3
+            anno_x_t = anno_x+(x_max*0.2)
+            anno_y = y_max/3
+            anno_y_t = anno_y+(y_max*0.2)
+            x_d = np.linspace(np.floor(x_min), np.ceil(x_max))
+            ax.plot(x_d, m*x_d + b, '-')
             
-            if loglog:
-                logx = np.log(x_data)
-                logy = np.log(y_data)
-                max_x = np.amax(logx)
-                max_y = np.amax(logy)
-                min_x = np.amin(logx)
-                x_d = np.logspace(min_x, max_x)
-                coeffs = np.polyfit(logx,logy,deg=1, full=True)
-                print('Slope: '+str(coeffs[0][0]))
-                print('Intercepts: '+str(coeffs[0][1]))
-                poly = np.poly1d(coeffs[0])
-                yfit = lambda x: np.exp(poly(np.log(x)))
-                plt.loglog(x_d,yfit(x_d))
-                r_squared = self.get_r_squared(logx,logy, coeffs[0][0], coeffs[0][1])
-                slope = coeffs[0][0]
-                intercept = coeffs[0][1]
-                anno_x = max_x/3
-                anno_x_t = anno_x*+(max_x*0.2)
-                anno_y = max_y/3
-                anno_y_t = anno_y+(max_y*0.2)
-                print('r squared '+str(r_squared))
-            elif log_x:
-                print('Log x')
-            elif log_y:
-                print('Log y')
+        if r_squared:
+            ax.annotate('R$^2$ = '+str(round(r_squared, 3))+'\nSlope ='+str(slope)+
+            '\nIntercept = '+str(intercept),  
+                 xy=(anno_x, anno_y), xycoords='data',
+                 xytext=(anno_x_t,anno_y_t), textcoords='data')
+
+    if r_squared is None:
+        return None
+
+    return {'slope': float(slope), 'intercept': float(intercept), 'r_squared': float(r_squared),
+            'loglog': loglog}
+
+
+# Table shared by the jobs each batch plotting worker runs
+worker_table = None
+
+
+def init_plot_worker(datafile, scenario):
+    global worker_table
+    worker_table = load_catchment_table(datafile, scenario)
+
+
+def plot_file_name(x, y, extent, image_format):
+    name = (y+'_vs_'+x).replace(' ', '_')
+    if extent != 'all':
+        name = name+'_fault_'+str(extent)
+
+    return name+'.'+image_format
+
+
+def render_plot(job):
+    # Figures are drawn straight onto an Agg canvas, nothing touches pyplot
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    x, y, extent, output_directory, image_format, density, gridsize = job
+    table = worker_table
+
+    plot_options = {
+        'logarithmic': { 'x': False, 'y': False },
+        'trend': 1,
+        'line': 'None',
+        'density': density,
+        'gridsize': gridsize
+    }
+    dataset_options(plot_options, x, 'x')
+    dataset_options(plot_options, y, 'y')
+
+    if extent == 'all':
+        rows = np.arange(len(table))
+        title = 'All Catchments'
+    else:
+        rows = table.fault_rows(extent)
+        title = 'Fault '+str(extent)
+
+    if table.scenario:
+        title = title+' ('+table.scenario+')'
+
+    x_data = table.column(x)[rows]
+    y_data = table.column(y)[rows]
+    known = ~(np.isnan(x_data) | np.isnan(y_data))
+    order = np.argsort(x_data[known], kind='mergesort')
+    x_data = x_data[known][order]
+    y_data = y_data[known][order]
+
+    file_name = plot_file_name(x, y, extent, image_format)
+    result = {'x': x, 'y': y, 'extent': extent, 'n': len(x_data), 'slope': '', 'intercept': '',
+              'r_squared': '', 'loglog': '', 'file': file_name, 'error': ''}
+
+    try:
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        ax = figure.add_subplot(111)
+        x_index = DATANAMES.index(x)
+        y_index = DATANAMES.index(y)
+        fit = draw_plot(ax, x_data, y_data,
+                        DATALABELS[x_index]+' ('+DATAUNITS[x_index]+')',
+                        DATALABELS[y_index]+' ('+DATAUNITS[y_index]+')',
+                        title, plot_options)
+        figure.savefig(os.path.join(output_directory, file_name))
+        if fit:
+            result.update(fit)
+    except Exception as e:
+        result['error'] = str(e)
+
+    return result
+
+
+def parse_extents(extent_option, table):
+    # 'all', 'faults' for every fault, or fault ids
+    extents = []
+    for e in (extent_option or 'all,faults').split(','):
+        e = e.strip()
+        if e == 'all':
+            extents.append('all')
+        elif e == 'faults':
+            extents.extend(sorted(table.faults))
+        elif int(e) in table.faults:
+            extents.append(int(e))
+        else:
+            print('No catchments on fault '+e)
+
+    return extents
+
+
+def write_fit_index(results, output_directory):
+    index_path = os.path.join(output_directory, 'fit_summary.csv')
+    row_headers = ['x', 'y', 'extent', 'n', 'slope', 'intercept', 'r_squared', 'loglog', 'file', 'error']
+
+    with open(index_path, 'wb') as index_file:
+        a = csv.writer(index_file, delimiter=',')
+        a.writerow(row_headers)
+        for r in results:
+            a.writerow([r[h] for h in row_headers])
+
+    return index_path
+
+
+def run_batch_plots(datafile, scenario = None, x_option = None, y_option = None, extent_option = None,
+                    output_directory = None, image_format = 'png', workers = None, density = 'auto',
+                    gridsize = 100):
+    table = load_catchment_table(datafile, scenario)
+
+    datasets = []
+    for option in [x_option, y_option]:
+        names = DATANAMES
+        if option:
+            names = [n.strip() for n in option.split(',')]
+        for n in names:
+            if n not in DATANAMES or not table.has(n):
+                print(n+' - not in this table, skipping')
+        datasets.append([n for n in names if n in DATANAMES and table.has(n)])
+
+    extents = parse_extents(extent_option, table)
+
+    if not output_directory:
+        name = table.scenario or os.path.splitext(basename(datafile))[0]
+        output_directory = os.path.join(os.path.dirname(os.path.realpath(datafile)), 'plots_'+name)
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    jobs = []
+    for extent in extents:
+        for x in datasets[0]:
+            for y in datasets[1]:
+                if x != y:
+                    jobs.append((x, y, extent, output_directory, image_format, density, gridsize))
+
+    workers = workers or multiprocessing.cpu_count()
+    print('Rendering '+str(len(jobs))+' plots with '+str(workers)+' workers')
+
+    pool = multiprocessing.Pool(workers, initializer=init_plot_worker, initargs=(datafile, table.scenario))
+    results = pool.map(render_plot, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+    pool.close()
+    pool.join()
+
+    failed = [r for r in results if r['error']]
+    index_path = write_fit_index(results, output_directory)
+    print(str(len(results) - len(failed))+' plots saved to '+output_directory)
+    if failed:
+        print(str(len(failed))+' plots failed, see '+index_path)
+
+    return index_path
+
+
+def save_fit_matrix(datafile, scenario = None, output_path = None, resamples = 1000):
+    table = load_catchment_table(datafile, scenario)
+    names = [n for n in DATANAMES if table.has(n)]
+
+    print('Fitting '+str(len(names))+' datasets for '+str(len(table.faults))+' faults')
+    records = fit_records(fit_matrix(table, names, resamples = resamples))
+
+    if not output_path:
+        name = table.scenario or os.path.splitext(basename(datafile))[0]
+        output_path = os.path.join(os.path.dirname(os.path.realpath(datafile)), 'fits_'+name+'.csv')
+
+    row_headers = ['kind', 'group', 'x', 'y', 'n', 'slope', 'intercept', 'r_squared']
+    if resamples:
+        row_headers.extend(['slope_low', 'slope_high', 'intercept_low', 'intercept_high'])
+
+    with open(output_path, 'wb') as fits_file:
+        a = csv.writer(fits_file, delimiter=',')
+        a.writerow(row_headers)
+        for r in records:
+            a.writerow([r[h] for h in row_headers])
+
+    print('Fits saved to '+output_path)
+    return output_path
+
+
+def main():
+    app = GISApp()
+
+    app.setup()
+
+    app.run()
+
+    if app.pargs.data:
+        if os.path.exists(app.pargs.data):
+            if app.pargs.fits:
+                save_fit_matrix(app.pargs.data, app.pargs.scenario, app.pargs.output, app.pargs.resamples)
+            elif app.pargs.batch:
+                run_batch_plots(app.pargs.data, app.pargs.scenario, app.pargs.x, app.pargs.y,
+                                app.pargs.extent, app.pargs.output, app.pargs.format, app.pargs.workers,
+                                app.pargs.density, app.pargs.gridsize)
             else:
-                m, b = np.polyfit(x_data, y_data, 1)
-                r_squared = self.get_r_squared(x_data,y_data, m, b)
-                print('r squared '+str(r_squared))
-                x_min = np.amin(x_data)
-                x_max = np.amax(x_data)
-                y_max = np.amax(y_data)
-                slope = m
-                intercept = b
-                anno_x = x_max/3
-                anno_x_t = anno_x+(x_max*0.2)
-                anno_y = y_max/3
-                anno_y_t = anno_y+(y_max*0.2)
-                x_d = np.linspace(np.floor(x_min), np.ceil(x_max))
-                plt.plot(x_d, m*x_d + b, '-')
-                
-            if r_squared:
-                plt.annotate('R$^2$ = '+str(round(r_squared, 3))+'\nSlope ='+str(slope)+
-                '\nIntercept = '+str(intercept),  
-                     xy=(anno_x, anno_y), xycoords='data',
-                     xytext=(anno_x_t,anno_y_t), textcoords='data')
-                 
-        plt.show()
-        
-        
-app = GISApp()
+                plotter = Plotter(app.pargs.data, app.pargs.scenario, app.pargs.density, app.pargs.gridsize)
 
-app.setup()
-    
-app.run()
 
-if app.pargs.data:
-    if os.path.exists(app.pargs.data):
-        plotter = Plotter(app.pargs.data)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Raw and chunked intermediate rasters
+
+Intermediates can be kept as raw little-endian arrays (<name>.raw) with a
+JSON sidecar (<name>.json) holding the shape, dtype, nodata, transform and
+CRS. The next stage maps them straight into memory with np.memmap instead of
+decoding a GeoTIFF, and stages reading the same raster share its pages
+through the OS cache.
+
+Large, mostly empty products (flow accumulation, stream order, watershed
+labels) can instead go in a chunked store (<name>.chunks), a directory of
+zlib compressed tiles with the same sidecar. Tiles that are all nodata are
+not written, integer tiles are stored in the narrowest type that holds
+their values, and bytes are shuffled into planes before compressing. A
+window is read by decompressing only the tiles it touches.
+
+Only the numpy backend reads and writes either format.
+"""
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+
+RAW_EXTENSION = '.raw'
+CHUNKED_EXTENSION = '.chunks'
+FORMATS = ['tif', 'raw']
+
+CHUNK_SIZE = 256
+COMPRESS_LEVEL = 6
+
+# Integer tiles are narrowed to the first of these that fits
+NARROW_TYPES = [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32]
+
+
+def is_raw(path):
+    return str(path).endswith(RAW_EXTENSION)
+
+
+def is_chunked(path):
+    return str(path).endswith(CHUNKED_EXTENSION)
+
+
+def is_stored(path):
+    # In one of the formats here rather than a GeoTIFF
+    return is_raw(path) or is_chunked(path)
+
+
+def sidecar_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def write_raw(path, values, transform, crs, nodata):
+    # transform is the six GDAL-order affine coefficients (a, b, c, d, e, f)
+    dtype = np.dtype(values.dtype).newbyteorder('<')
+    np.ascontiguousarray(values, dtype=dtype).tofile(path)
+
+    meta = {
+        'shape': list(values.shape),
+        'dtype': dtype.str,
+        'nodata': nodata,
+        'transform': [float(t) for t in list(transform)[:6]],
+        'crs': str(crs) if crs else None
+    }
+    with open(sidecar_path(path), 'w') as sidecar:
+        sidecar.write(json.dumps(meta, indent=2))
+
+    return path
+
+
+def read_meta(path):
+    with open(sidecar_path(path)) as sidecar:
+        return json.loads(sidecar.read())
+
+
+def open_raw(path, mode = 'r'):
+    # Zero-copy view of the raster and its sidecar
+    meta = read_meta(path)
+    values = np.memmap(path, dtype=np.dtype(str(meta['dtype'])), mode=mode, shape=tuple(meta['shape']))
+
+    return values, meta
+
+
+def remove_raw(path):
+    for p in [path, sidecar_path(path)]:
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def narrow(block):
+    if block.dtype.kind not in 'iu' or not block.size:
+        return block
+
+    low, high = block.min(), block.max()
+    for t in NARROW_TYPES:
+        info = np.iinfo(t)
+        if info.min <= low and high <= info.max:
+            return block.astype(np.dtype(t).newbyteorder('<'))
+
+    return block
+
+
+def shuffle(block):
+    # Byte planes one after another, so the high bytes of small values
+    # compress to runs of zeros
+    return np.ascontiguousarray(block).view(np.uint8).reshape(-1, block.dtype.itemsize).T.tobytes()
+
+
+def unshuffle(data, dtype, shape):
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(shape)
+
+
+def write_chunked(path, values, transform, crs, nodata, chunk = CHUNK_SIZE):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    rows, cols = values.shape
+    dtype = np.dtype(values.dtype).newbyteorder('<')
+    tiles = {}
+
+    for r0 in range(0, rows, chunk):
+        for c0 in range(0, cols, chunk):
+            block = values[r0:r0 + chunk, c0:c0 + chunk]
+            if nodata is not None and (block == nodata).all():
+                continue
+
+            block = narrow(np.ascontiguousarray(block, dtype=dtype))
+            name = str(r0 // chunk) + '_' + str(c0 // chunk)
+            with open(os.path.join(path, name), 'wb') as tile:
+                tile.write(zlib.compress(shuffle(block), COMPRESS_LEVEL))
+            tiles[name] = block.dtype.str
+
+    meta = {
+        'shape': list(values.shape),
+        'dtype': dtype.str,
+        'nodata': nodata,
+        'transform': [float(t) for t in list(transform)[:6]],
+        'crs': str(crs) if crs else None,
+        'chunk': chunk,
+        'tiles': tiles
+    }
+    with open(sidecar_path(path), 'w') as sidecar:
+        sidecar.write(json.dumps(meta, indent=2, sort_keys=True))
+
+    return path
+
+
+class ChunkedRaster:
+    'Chunked store opened for windowed reads, tiles are read on demand'
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_meta(path)
+        self.shape = tuple(self.meta['shape'])
+        self.dtype = np.dtype(str(self.meta['dtype']))
+        self.nodata = self.meta['nodata']
+        self.chunk = self.meta['chunk']
+
+    def tile(self, i, j):
+        r0, c0 = i * self.chunk, j * self.chunk
+        shape = (min(self.chunk, self.shape[0] - r0), min(self.chunk, self.shape[1] - c0))
+        name = str(i) + '_' + str(j)
+
+        if name not in self.meta['tiles']:
+            return np.zeros(shape, dtype=self.dtype) + (self.nodata if self.nodata is not None else 0)
+
+        with open(os.path.join(self.path, name), 'rb') as tile:
+            data = zlib.decompress(tile.read())
+
+        return unshuffle(data, np.dtype(str(self.meta['tiles'][name])), shape).astype(self.dtype)
+
+    def read(self, r0 = 0, r1 = None, c0 = 0, c1 = None):
+        # Cells [r0:r1, c0:c1], decompressing only the tiles they touch
+        r1 = self.shape[0] if r1 is None else r1
+        c1 = self.shape[1] if c1 is None else c1
+        values = np.empty((r1 - r0, c1 - c0), dtype=self.dtype)
+
+        for i in range(r0 // self.chunk, (r1 - 1) // self.chunk + 1):
+            for j in range(c0 // self.chunk, (c1 - 1) // self.chunk + 1):
+                tr, tc = i * self.chunk, j * self.chunk
+                a0, a1 = max(r0, tr), min(r1, tr + self.chunk)
+                b0, b1 = max(c0, tc), min(c1, tc + self.chunk)
+                values[a0 - r0:a1 - r0, b0 - c0:b1 - c0] = self.tile(i, j)[a0 - tr:a1 - tr, b0 - tc:b1 - tc]
+
+        return values
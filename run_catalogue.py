@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Catalogue of every hydro, watershed and climate batch
+
+Each batch is a row in one SQLite file per project root, with the
+directory it is in, the batch it was made from, a fingerprint of the config
+keys it depends on, hashes of its input files, its status, start and finish
+times and its output paths. Finding a batch to reuse is then an indexed
+query rather than parsing the names of every timestamped directory on disk.
+"""
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+
+from stage_graph import STAGES, config_value, file_fingerprint
+
+
+RUN_KINDS = ['hydro', 'watershed', 'climate']
+
+RUN_STATUSES = ['running', 'complete', 'failed']
+
+# Stage graph stages whose config keys and files each kind of batch reads
+KIND_STAGES = {
+    'hydro': ['hydro'],
+    'watershed': ['faults', 'watersheds'],
+    'climate': ['climate', 'zonal', 'lithology', 'table']
+}
+
+FIELDS = ['id', 'kind', 'project', 'path', 'directory', 'parent', 'scenario', 'config', 'inputs', 'pour_points',
+          'status', 'started', 'finished', 'seconds', 'outputs', 'used']
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def config_fingerprint(config, kind):
+    described = {'config': {}, 'files': {}}
+    for stage in KIND_STAGES[kind]:
+        for k in STAGES[stage]['config']:
+            described['config'][k] = config_value(config, k)
+        for k in STAGES[stage]['files']:
+            described['files'][k] = file_fingerprint(config_value(config, k))
+
+    return hashlib.sha1(json.dumps(described, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def input_hashes(paths):
+    # File fingerprint of each input, by name. Values that aren't paths,
+    # e.g. basic climate numbers, are kept as they are
+    hashes = {}
+    for name, path in paths.items():
+        if isinstance(path, basestring) and os.path.exists(path):
+            hashes[name] = file_fingerprint(path)
+        else:
+            hashes[name] = path
+
+    return hashes
+
+
+def normalise(path):
+    if not path:
+        return path
+
+    return os.path.normcase(os.path.realpath(path))
+
+
+def now():
+    return datetime.datetime.now().strftime(TIME_FORMAT)
+
+
+class RunCatalogue:
+    'Hydro, watershed and climate batches in an SQLite file'
+
+    def __init__(self, path):
+        self.path = path
+        # Scheduled jobs share the file, so wait for each other's writes
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, kind TEXT, project TEXT, '
+                        'path TEXT UNIQUE, directory TEXT, parent TEXT, scenario TEXT, config TEXT, inputs TEXT, '
+                        'pour_points TEXT, status TEXT, started TEXT, finished TEXT, seconds REAL, '
+                        'outputs TEXT, used TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS runs_directory ON runs (directory, status, finished)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS runs_parent ON runs (parent, kind, status, finished)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS runs_project ON runs (project, kind, status, finished)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS runs_pour_points ON runs (pour_points, status, finished)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS runs_scenario ON runs (scenario, started)')
+        self.db.commit()
+
+    def start(self, kind, path, project, config, inputs, parent = None, scenario = None, pour_points = None):
+        # A batch being made, or remade in place. pour_points is the hash
+        # of the pour point file for watershed batches
+        path = normalise(path)
+        values = [kind, project, path, os.path.dirname(path), normalise(parent), scenario, config,
+                  json.dumps(input_hashes(inputs), sort_keys=True), pour_points, 'running', now()]
+        row = self.db.execute('SELECT id FROM runs WHERE path = ?', [path]).fetchone()
+        if row:
+            self.db.execute('UPDATE runs SET kind = ?, project = ?, path = ?, directory = ?, parent = ?, scenario = ?, config = ?, '
+                            'inputs = ?, pour_points = ?, status = ?, started = ?, finished = NULL, seconds = NULL, '
+                            'outputs = NULL WHERE id = ?', values + [row[0]])
+            run_id = row[0]
+        else:
+            run_id = self.db.execute('INSERT INTO runs (kind, project, path, directory, parent, scenario, config, '
+                                     'inputs, pour_points, status, started) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                     values).lastrowid
+        self.db.commit()
+
+        return run_id
+
+    def finish(self, run_id, status = 'complete', outputs = None):
+        started = self.db.execute('SELECT started FROM runs WHERE id = ?', [run_id]).fetchone()[0]
+        finished = now()
+        seconds = (datetime.datetime.strptime(finished, TIME_FORMAT) -
+                   datetime.datetime.strptime(started, TIME_FORMAT)).total_seconds()
+        self.db.execute('UPDATE runs SET status = ?, finished = ?, used = ?, seconds = ?, outputs = ? WHERE id = ?',
+                        [status, finished, finished, seconds, json.dumps(outputs or {}, default=str), run_id])
+        self.db.commit()
+
+    def mark_used(self, path, kind, project, parent = None):
+        # A batch picked to carry on from, so it counts as the last used.
+        # Batches made before the catalogue are added as complete
+        path = normalise(path)
+        if not self.db.execute('UPDATE runs SET used = ? WHERE path = ?', [now(), path]).rowcount:
+            self.db.execute('INSERT INTO runs (kind, project, path, directory, parent, status, used) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            [kind, project, path, os.path.dirname(path), normalise(parent), 'complete', now()])
+        self.db.commit()
+
+    def runs(self, kind = None, project = None, directory = None, parent = None, scenario = None,
+             pour_points = None, status = None, order = 'finished', limit = None):
+        # Matching batches, newest first by finish (or last use) time
+        clauses = []
+        values = []
+        for column, value in [('kind', kind), ('project', project), ('directory', normalise(directory)),
+                              ('parent', normalise(parent)),
+                              ('scenario', scenario), ('pour_points', pour_points), ('status', status)]:
+            if value is not None:
+                clauses.append(column + ' = ?')
+                values.append(value)
+
+        query = 'SELECT ' + ', '.join(FIELDS) + ' FROM runs'
+        if clauses:
+            query = query + ' WHERE ' + ' AND '.join(clauses)
+        query = query + ' ORDER BY ' + ('used' if order == 'used' else 'finished') + ' DESC, id DESC'
+        if limit:
+            query = query + ' LIMIT ' + str(int(limit))
+
+        rows = []
+        for r in self.db.execute(query, values):
+            row = dict(zip(FIELDS, r))
+            row['inputs'] = json.loads(row['inputs'] or '{}')
+            row['outputs'] = json.loads(row['outputs'] or '{}')
+            rows.append(row)
+
+        return rows
+
+    def latest(self, **query):
+        # Newest complete batch matching the query that is still on disk,
+        # None if there isn't one
+        query.setdefault('status', 'complete')
+        for row in self.runs(**query):
+            if os.path.isdir(row['path']):
+                return row
+
+        return None
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Dependency tracking for the workflow stages
+
+Every stage declares the config keys and files it reads and the stages it
+depends on. A stage's fingerprint covers those inputs plus the fingerprints
+of its upstream stages, so a change anywhere only invalidates the stages
+downstream of it.
+"""
+import datetime
+import glob
+import hashlib
+import json
+import os
+
+import yaml
+
+
+# Files smaller than this are hashed by content, larger ones by size and mtime
+CONTENT_HASH_LIMIT = 1024 * 1024
+
+# Stages run once per climate scenario, named e.g. 'zonal:mean_annual'
+SCENARIO_STAGES = ['climate', 'zonal', 'table', 'extract']
+
+STAGES = {
+    'hydro': {
+        'config': ['original_dem', 'projection_code', 'backend', 'intermediates.format', 'intermediates.chunked',
+                   'fill', 'flow_dir', 'flow_acc.flow_data_type', 'flow_acc.flow_weight_raster', 'str_net',
+                   'set_null', 'str_ord'],
+        'files': ['original_dem'],
+        'upstream': []
+    },
+    'faults': {
+        'config': ['fault_path', 'faults', 'pour_points.minimum_height'],
+        'files': ['fault_path'],
+        'upstream': ['hydro']
+    },
+    'watersheds': {
+        'config': ['pour_points.snap_distance', 'fan_toes'],
+        'files': ['fan_toes'],
+        'upstream': ['hydro', 'faults']
+    },
+    'climate': {
+        'config': [],
+        'files': [],
+        'upstream': ['watersheds']
+    },
+    'zonal': {
+        'config': ['original_dem', 'catchment_stats', 'monthly_stats'],
+        'files': [],
+        'upstream': ['climate', 'watersheds']
+    },
+    'lithology': {
+        'config': ['lithology_path', 'lithology_values'],
+        'files': ['lithology_path', 'lithology_values'],
+        'upstream': ['watersheds']
+    },
+    'table': {
+        'config': ['min_area', 'uplift_mm_yr'],
+        'files': [],
+        'upstream': ['zonal', 'lithology', 'faults']
+    },
+    'extract': {
+        'config': [],
+        'files': [],
+        'upstream': ['table']
+    }
+}
+
+
+# Values config keys take when they are left out, so leaving one out and
+# setting it to its default give the same fingerprint
+CONFIG_DEFAULTS = {
+    'backend': 'arcpy',
+    'intermediates.format': 'tif',
+    'intermediates.chunked': []
+}
+
+
+def config_value(config, key):
+    value = config
+    for k in key.split('.'):
+        if not isinstance(value, dict) or k not in value:
+            return CONFIG_DEFAULTS.get(key)
+        value = value[k]
+
+    if value is None:
+        return CONFIG_DEFAULTS.get(key)
+
+    return value
+
+
+def file_fingerprint(path):
+    if not path or not os.path.exists(path):
+        return None
+
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, '*')))
+    elif path.lower().endswith('.shp'):
+        # Shapefiles are spread over several sidecar files
+        files = sorted(glob.glob(os.path.splitext(path)[0] + '.*'))
+    else:
+        files = [path]
+
+    h = hashlib.sha1()
+    for f in files:
+        if not os.path.isfile(f):
+            continue
+        size = os.path.getsize(f)
+        h.update(os.path.basename(f).encode('utf-8'))
+        if size < CONTENT_HASH_LIMIT:
+            with open(f, 'rb') as data:
+                h.update(data.read())
+        else:
+            h.update((str(size) + '_' + str(int(os.path.getmtime(f)))).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+class StageGraph:
+    'Works out which workflow stages need to run again'
+
+    def __init__(self, config, state_path, parent = None, exists = os.path.exists):
+        self.config = config
+        self.state_path = state_path
+        self.parent = parent
+        self.exists = exists
+        self.fingerprints = {}
+        self.extra_inputs = {}
+        self.state = {}
+
+        if os.path.isfile(state_path):
+            f = open(state_path)
+            self.state = yaml.load(f.read()) or {}
+            f.close()
+
+    def add_inputs(self, name, files = None, values = None):
+        # Inputs only known at run time, e.g. pour points or climate directories
+        inputs = self.extra_inputs.setdefault(name, {'files': [], 'values': []})
+        inputs['files'].extend(files or [])
+        inputs['values'].extend(values or [])
+        self.fingerprints.pop(name, None)
+
+    def upstream(self, name):
+        base, _, scenario = name.partition(':')
+        names = []
+        for u in STAGES[base]['upstream']:
+            if scenario and u in SCENARIO_STAGES:
+                u = u + ':' + scenario
+            names.append(u)
+
+        return names
+
+    def describe(self, name):
+        base = name.partition(':')[0]
+        definition = STAGES[base]
+        extra = self.extra_inputs.get(name, {'files': [], 'values': []})
+
+        inputs = {
+            'config': dict((k, config_value(self.config, k)) for k in definition['config']),
+            'files': dict((k, file_fingerprint(config_value(self.config, k))) for k in definition['files']),
+            'upstream': dict((u, self.lookup(u)) for u in self.upstream(name))
+        }
+
+        for path in extra['files']:
+            inputs['files'][path] = file_fingerprint(path)
+        if extra['values']:
+            inputs['values'] = list(extra['values'])
+
+        return inputs
+
+    def fingerprint(self, name):
+        if name not in self.fingerprints:
+            described = json.dumps(self.describe(name), sort_keys=True, default=str)
+            self.fingerprints[name] = hashlib.sha1(described.encode('utf-8')).hexdigest()
+
+        return self.fingerprints[name]
+
+    def lookup(self, name):
+        # Current fingerprint of a stage that may belong to a parent batch
+        if name in self.fingerprints:
+            return self.fingerprints[name]
+        if self.parent is not None and (name in self.parent.fingerprints or name in self.parent.state):
+            return self.parent.lookup(name)
+        if name in self.state:
+            return self.state[name]['fingerprint']
+
+        return None
+
+    def is_current(self, name, outputs = None):
+        record = self.state.get(name)
+        if not record or record['fingerprint'] != self.fingerprint(name):
+            return False
+
+        if outputs is None:
+            outputs = record['outputs']
+
+        for path in outputs.values():
+            if path and not self.exists(path):
+                return False
+
+        return True
+
+    def outputs(self, name):
+        if name in self.state:
+            return self.state[name]['outputs']
+
+        return {}
+
+    def skip(self, name):
+        # Stage not used in this run, downstream stages still need a value
+        self.fingerprints[name] = 'skipped'
+
+    def record(self, name, outputs):
+        self.state[name] = {
+            'fingerprint': self.fingerprint(name),
+            'inputs': self.describe(name),
+            'outputs': outputs,
+            'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+        with open(self.state_path, 'w') as outfile:
+            outfile.write(yaml.dump(self.state, default_flow_style=False))
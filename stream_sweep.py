@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Stream network statistics for many accumulation thresholds at once
+
+A cell is a stream cell at threshold t when its flow accumulation is above
+t, as with str_net.conditional VALUE > t. Every statistic here only depends
+on which side of t a few per-cell values fall, so they are sorted once and
+each threshold is a binary search:
+
+- stream cells and stream length: the cell's own accumulation
+- channel heads: a stream cell whose largest donor is not a stream
+- junctions: a cell whose second largest donor is a stream
+- outlets: stream cells draining off the grid or into nodata
+- fault crossings: stream cells on a fault draining off it
+"""
+import math
+
+import numpy as np
+
+
+def donor_maxima(receiver, accumulation):
+    # Largest and second largest accumulation of the cells draining into
+    # each cell, -inf where there are none
+    first = np.zeros(len(receiver)) - np.inf
+    second = np.zeros(len(receiver)) - np.inf
+
+    donors = np.flatnonzero((receiver >= 0) & np.isfinite(accumulation))
+    r = receiver[donors]
+    a = accumulation[donors]
+    order = np.lexsort((a, r))
+    r, a = r[order], a[order]
+
+    # Donors of a cell are now together, largest last
+    last = np.ones(len(r), dtype=bool)
+    last[:-1] = r[:-1] != r[1:]
+    ends = np.flatnonzero(last)
+    first[r[ends]] = a[ends]
+
+    before = ends - 1
+    shared = before >= 0
+    shared[shared] = r[before[shared]] == r[ends[shared]]
+    second[r[ends[shared]]] = a[before[shared]]
+
+    return first, second
+
+
+def step_lengths(receiver, shape, cell_size):
+    # Length of the D8 step from each cell to its receiver, 0 at outlets
+    cells = np.arange(len(receiver))
+    rows, cols = np.divmod(cells, shape[1])
+    r_rows, r_cols = np.divmod(receiver, shape[1])
+    diagonal = (rows != r_rows) & (cols != r_cols)
+    lengths = np.where(diagonal, math.sqrt(2), 1.0) * cell_size
+
+    return np.where(receiver >= 0, lengths, 0)
+
+
+class ThresholdCounts:
+    'Sorted values answering how many (or how much) lies above a threshold'
+
+    def __init__(self, values, weights = None):
+        finite = np.isfinite(values)
+        order = np.argsort(values[finite], kind='mergesort')
+        self.values = values[finite][order]
+        self.totals = None
+        if weights is not None:
+            weights = weights[finite]
+            # totals[i] is the sum of weights from sorted position i upwards
+            self.totals = np.concatenate([np.cumsum(weights[order][::-1])[::-1], [0]])
+
+    def count(self, threshold):
+        return len(self.values) - int(np.searchsorted(self.values, threshold, side='right'))
+
+    def total(self, threshold):
+        return float(self.totals[np.searchsorted(self.values, threshold, side='right')])
+
+
+def sweep(accumulation, receiver, shape, cell_size, thresholds, crossings = None):
+    # Network statistics for each threshold. accumulation is flat with NaN
+    # outside the grid, crossings marks cells on a fault whose flow leaves it
+    valid = np.isfinite(accumulation)
+    first, second = donor_maxima(receiver, accumulation)
+    lengths = step_lengths(receiver, shape, cell_size)
+
+    streams = ThresholdCounts(accumulation[valid], lengths[valid])
+    heads = ThresholdCounts(first[valid])
+    junctions = ThresholdCounts(second[valid])
+    outlets = ThresholdCounts(accumulation[valid & (receiver < 0)])
+    if crossings is not None:
+        crossings = ThresholdCounts(accumulation[valid & crossings])
+
+    area = valid.sum() * cell_size * cell_size / 1e6
+    results = []
+
+    for t in thresholds:
+        length = streams.total(t) / 1000.0
+        result = {
+            'threshold': t,
+            'stream_cells': streams.count(t),
+            'length_km': length,
+            'drainage_density': length / area if area else float('nan'),
+            # Largest donor above t means the cell continues a stream
+            'channel_heads': streams.count(t) - heads.count(t),
+            'junctions': junctions.count(t),
+            'outlets': outlets.count(t)
+        }
+        if crossings is not None:
+            result['fault_crossings'] = crossings.count(t)
+        results.append(result)
+
+    return results
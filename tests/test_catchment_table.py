@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import catchment_table
+
+
+class ShortRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        with open(self.path, 'w') as f:
+            f.write('ID,A (km^2),R (km)\n'
+                    '1,10.0,0.5\n'
+                    '2,12.0\n'
+                    '3,8.0,0.7\n'
+                    '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_short_rows_are_reported(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            table = catchment_table.load_catchment_table(self.path)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(table.ids.tolist(), [1, 3])
+        self.assertEqual(table.column('relief').tolist(), [0.5, 0.7])
+        # The truncated row is counted, the blank line isn't
+        self.assertIn('Skipping 1 rows with fewer than 3 columns', printed)
+
+
+if __name__ == '__main__':
+    unittest.main()
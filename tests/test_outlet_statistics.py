@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import gis_backend
+import gis_workflow
+
+
+def batch_config(directory):
+    return {
+        'backend': 'numpy',
+        'catchment_stats': 'upstream',
+        'root': directory,
+        'project_name': 'nested',
+        'projection_code': 32611,
+        'pour_points_path': '',
+        'lithology_path': '',
+        'lithology_values': '',
+        'fault_path': '',
+        'scratch': directory,
+        'output': directory,
+        'original_dem': os.path.join(directory, 'dem.tif'),
+        'uplift_mm_yr': 0.1,
+        'min_area': 0,
+        'fan_toes': False,
+        'fill': True,
+        'flow_dir': {},
+        'flow_acc': {},
+        'str_net': {},
+        'set_null': {},
+        'str_ord': {},
+        'faults': {},
+        'pour_points': {},
+        'climates': [],
+        'climate_basic': [],
+        'trace': False
+    }
+
+
+class NestedOutletTest(unittest.TestCase):
+    # Two rows flowing east. Catchment 1 is the west half, draining to a
+    # pour point at the end of the top row's half, which flows on through
+    # catchment 2 to its pour point at the east edge
+
+    def setUp(self):
+        from rasterio.transform import from_origin
+
+        self.directory = tempfile.mkdtemp()
+        config = batch_config(self.directory)
+        self.gbatch = gis_workflow.GISbatch(config, self.directory, gis_workflow.RunSpec({'headless': True}))
+        backend = self.gbatch.backend
+        grid = gis_backend.RasterGrid(from_origin(0, 60, 30, 30), backend.crs, (2, 6))
+
+        dem = np.array([[100, 90, 80, 70, 60, 50],
+                        [95, 85, 75, 65, 55, 45]], dtype=float)
+        backend.write_raster(config['original_dem'], dem, grid)
+
+        self.flow_path = os.path.join(self.directory, 'flow.tif')
+        backend.write_raster(self.flow_path, np.ones((2, 6)), grid, 'int32')
+
+        watersheds = np.array([[1, 1, 1, 2, 2, 2],
+                               [1, 1, 1, 2, 2, 2]], dtype=float)
+        backend.write_raster(os.path.join(self.directory, 'watersheds.tif'), watersheds, grid, 'int32')
+
+        pour_points = np.zeros((2, 6)) + np.nan
+        pour_points[0, 2] = 1
+        pour_points[0, 5] = 2
+        backend.write_raster(os.path.join(self.directory, 'pour_points.tif'), pour_points, grid, 'int32')
+
+        with open(os.path.join(self.directory, 'watershed_paths.yml'), 'w') as f:
+            f.write(yaml.dump({'watersheds': os.path.join(self.directory, 'watersheds.tif'),
+                               'pour_points': os.path.join(self.directory, 'pour_points.tif')}))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_nested_outlet_relief_is_local(self):
+        table = self.gbatch.outlet_statistics(self.directory, self.directory, {'flow_path': self.flow_path}, 'elev',
+                                              self.gbatch.original_dem, os.path.join(self.directory, 'upstream'))
+        rows = dict((int(r[0]), r[1:]) for r in self.gbatch.backend.search_rows(table, ['VALUE', 'MAX', 'MIN', 'RANGE']))
+
+        # Catchment 2's relief is over its own cells, as the zonal path has
+        # it, not the upstream max of 100 from catchment 1
+        self.assertEqual(rows[2], (70.0, 45.0, 25.0))
+        self.assertEqual(rows[1][0], 100.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing, memory and I/O tracing
+
+Wall time, CPU time, memory and bytes read and written are recorded for
+every traced stage and written out as a Chrome trace (chrome://tracing or
+Perfetto), with a per-stage summary alongside.
+
+The operating system only keeps one peak RSS for the whole process, so each
+stage records how far memory rose above its starting RSS: the process peak
+when that was reached during the stage, otherwise the larger of its start
+and end RSS, which is a lower bound. The process peak is kept alongside as
+process_peak_rss.
+"""
+import contextlib
+import datetime
+import functools
+import json
+import os
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def sample_process():
+    times = os.times()
+    sample = {
+        'wall': time.time(),
+        'cpu': times[0] + times[1],
+        'rss': None,
+        'peak_rss': None,
+        'read_bytes': None,
+        'write_bytes': None
+    }
+
+    if psutil is not None:
+        process = psutil.Process()
+        memory = process.memory_info()
+        sample['rss'] = memory.rss
+        # Windows keeps the peak working set, elsewhere fall back to getrusage
+        sample['peak_rss'] = getattr(memory, 'peak_wset', None)
+        try:
+            io = process.io_counters()
+            sample['read_bytes'] = io.read_bytes
+            sample['write_bytes'] = io.write_bytes
+        except (AttributeError, psutil.Error):
+            pass
+
+    if sample['rss'] is None and os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as statm:
+            sample['rss'] = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    if sample['peak_rss'] is None and resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        sample['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    if sample['read_bytes'] is None and os.path.exists('/proc/self/io'):
+        with open('/proc/self/io') as io:
+            for line in io:
+                key, _, value = line.partition(':')
+                if key == 'read_bytes':
+                    sample['read_bytes'] = int(value)
+                elif key == 'write_bytes':
+                    sample['write_bytes'] = int(value)
+
+    return sample
+
+
+def difference(after, before, key):
+    if after[key] is None or before[key] is None:
+        return None
+
+    return after[key] - before[key]
+
+
+def peak_delta(after, before):
+    # How far memory rose above the RSS the stage started at
+    if before['rss'] is None:
+        return None
+
+    if after['peak_rss'] is not None and before['peak_rss'] is not None and after['peak_rss'] > before['peak_rss']:
+        peak = after['peak_rss']
+    else:
+        peak = max(before['rss'], after['rss'] or 0)
+
+    return max(peak - before['rss'], 0)
+
+
+class StageTracer:
+    'Records how long each workflow stage takes and what it costs'
+
+    def __init__(self):
+        self.events = []
+        self.depth = 0
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name, detail = None):
+        before = sample_process()
+        self.depth = self.depth + 1
+        try:
+            yield
+        finally:
+            self.depth = self.depth - 1
+            after = sample_process()
+            self.events.append({
+                'name': name,
+                'detail': detail,
+                'depth': self.depth,
+                'start': before['wall'] - self.start,
+                'wall': after['wall'] - before['wall'],
+                'cpu': after['cpu'] - before['cpu'],
+                'rss_before': before['rss'],
+                'rss': after['rss'],
+                'peak_delta': peak_delta(after, before),
+                'process_peak_rss': after['peak_rss'],
+                'read_bytes': difference(after, before, 'read_bytes'),
+                'write_bytes': difference(after, before, 'write_bytes')
+            })
+
+    def summary(self):
+        # Totals per stage name, in the order stages first finished
+        totals = {}
+        order = []
+        for e in self.events:
+            if e['name'] not in totals:
+                order.append(e['name'])
+                totals[e['name']] = {'name': e['name'], 'calls': 0, 'wall': 0, 'cpu': 0, 'peak_delta': 0,
+                                     'process_peak_rss': 0, 'read_bytes': 0, 'write_bytes': 0}
+            t = totals[e['name']]
+            t['calls'] = t['calls'] + 1
+            t['wall'] = t['wall'] + e['wall']
+            t['cpu'] = t['cpu'] + e['cpu']
+            t['peak_delta'] = max(t['peak_delta'], e['peak_delta'] or 0)
+            t['process_peak_rss'] = max(t['process_peak_rss'], e['process_peak_rss'] or 0)
+            t['read_bytes'] = t['read_bytes'] + (e['read_bytes'] or 0)
+            t['write_bytes'] = t['write_bytes'] + (e['write_bytes'] or 0)
+
+        return [totals[n] for n in order]
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        trace_events = []
+        for e in self.events:
+            args = dict((k, e[k]) for k in ['cpu', 'rss_before', 'rss', 'peak_delta', 'process_peak_rss',
+                                            'read_bytes', 'write_bytes'])
+            if e['detail']:
+                args['detail'] = e['detail']
+            trace_events.append({
+                'name': e['name'],
+                'cat': 'workflow',
+                'ph': 'X',
+                'ts': int(e['start'] * 1000000),
+                'dur': int(e['wall'] * 1000000),
+                'pid': pid,
+                'tid': 0,
+                'args': args
+            })
+
+        return {
+            'traceEvents': sorted(trace_events, key=lambda t: t['ts']),
+            'displayTimeUnit': 'ms',
+            'otherData': {'stages': self.summary()}
+        }
+
+    def save(self, directory):
+        t = datetime.datetime.now()
+        name = 'trace_' + '_'.join(map(str, [t.year, t.month, t.day, t.hour, t.minute, t.second])) + '.json'
+        trace_path = os.path.join(directory, name)
+
+        with open(trace_path, 'w') as outfile:
+            outfile.write(json.dumps(self.chrome_trace(), indent=1))
+
+        return trace_path
+
+    def report(self):
+        print('Stage timings (wall s, cpu s, peak MB above start, process peak MB, read MB, written MB)')
+        for t in self.summary():
+            print('  '+t['name'].ljust(30)+' '.join([
+                ('%.2f' % t['wall']).rjust(9),
+                ('%.2f' % t['cpu']).rjust(9),
+                ('%.1f' % (t['peak_delta'] / 1048576.0)).rjust(9),
+                ('%.1f' % (t['process_peak_rss'] / 1048576.0)).rjust(9),
+                ('%.1f' % (t['read_bytes'] / 1048576.0)).rjust(9),
+                ('%.1f' % (t['write_bytes'] / 1048576.0)).rjust(9)]))
+
+
+def traced(method = None, detail = 0):
+    # Wraps a GISbatch method in a stage of the batch's tracer. The argument
+    # at position detail, if it's a path, labels the call in the trace
+    if method is None:
+        return lambda m: traced(m, detail)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        tracer = getattr(self, 'tracer', None)
+        if tracer is None:
+            return method(self, *args, **kwargs)
+
+        label = None
+        if len(args) > detail and isinstance(args[detail], basestring):
+            label = os.path.basename(args[detail])
+
+        with tracer.stage(method.__name__, label):
+            return method(self, *args, **kwargs)
+
+    return wrapper